@@ -0,0 +1,117 @@
+from logging import Logger, getLogger
+from typing import Tuple, Union
+import errno
+import socket
+import struct
+import sys
+
+# python doesn't expose these linux constants
+IS_LINUX = sys.platform.startswith('linux')
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103 if IS_LINUX else None)
+# the kernel allows at most 64 segments, and the whole buffer has to fit in one (giant) UDP datagram
+MAX_GSO_SEGMENTS = 64
+MAX_GSO_BYTES = 65507
+GSO_SIZE_STRUCT = struct.Struct('=H')
+# errors that mean this socket/route/NIC can't do GSO, rather than a real send error
+GSO_UNSUPPORTED_ERRNOS = (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+def gso_supported(sock: socket.socket):
+	"""Checks if the OS supports UDP generic segmentation offload (Linux 4.18+)"""
+	if UDP_SEGMENT is None or not hasattr(sock, 'sendmsg'):
+		return False
+	try:
+		sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+		return True
+	except OSError:
+		return False
+
+class BatchSender():
+	"""Sends chunks over UDP, batching runs of equal-size chunks into single sendmsg calls with UDP GSO.
+
+	With GSO, the kernel splits one large buffer into many equal-size datagrams (only the last one may be shorter),
+	so we make one syscall per batch instead of one per chunk.
+	If GSO isn't available, or the kernel refuses it, we fall back to one sendto per chunk.
+	"""
+	def __init__(self, sock: socket.socket, send_to: Tuple[str, int], use_gso=True,
+			max_segments=MAX_GSO_SEGMENTS, log: Logger=getLogger('batch_sender')) -> None:
+		"""Creates a batch sender
+
+		Args:
+			sock (socket.socket): The socket to send with (or another Transport, which never uses GSO)
+			send_to (Tuple[str, int]): The IP address, Port to send to
+			use_gso (bool, optional): Set to False to always send one datagram at a time. Defaults to True.
+			max_segments (int, optional): The maximum number of chunks per batch. Defaults to 64 (the kernel's limit).
+			log (Logger, optional): Where to log if we have to fall back.
+		"""
+		self.sock = sock
+		self.send_to = send_to
+		self.use_gso = use_gso and gso_supported(sock)
+		self.max_segments = min(max_segments, MAX_GSO_SEGMENTS)
+		self.log = log
+		self.buffer = bytearray()
+		self.segment_size = 0
+		self.segments = 0
+		# stats
+		self.syscalls = 0
+		self.frames_sent = 0
+		self.bytes_sent = 0
+
+	def send(self, chunk: Union[bytes, bytearray, memoryview]):
+		"""Queues a chunk to be sent. It may not be sent until `flush` is called
+
+		Returns:
+			int: The number of bytes actually put on the wire by this call
+		"""
+		if not self.use_gso:
+			self.sock.sendto(chunk, self.send_to)
+			self.syscalls += 1
+			self.frames_sent += 1
+			self.bytes_sent += len(chunk)
+			return len(chunk)
+		size = len(chunk)
+		sent = 0
+		if self.segments > 0 and size > self.segment_size:
+			sent += self.flush()
+		if self.segments == 0:
+			self.segment_size = size
+		self.buffer += chunk
+		self.segments += 1
+		# only the last segment of a batch may be shorter than the rest
+		if (size < self.segment_size or self.segments >= self.max_segments
+				or len(self.buffer) + self.segment_size > MAX_GSO_BYTES):
+			sent += self.flush()
+		return sent
+
+	def flush(self):
+		"""Sends everything queued
+
+		Returns:
+			int: The number of bytes sent
+		"""
+		if self.segments == 0:
+			return 0
+		sent = len(self.buffer)
+		try:
+			if self.segments == 1:
+				self.sock.sendto(self.buffer, self.send_to)
+			else:
+				self.sock.sendmsg([self.buffer],
+					[(SOL_UDP, UDP_SEGMENT, GSO_SIZE_STRUCT.pack(self.segment_size))],
+					0, self.send_to)
+			self.syscalls += 1
+		except OSError as e:
+			if e.errno not in GSO_UNSUPPORTED_ERRNOS:
+				raise
+			self.log.warning(f'UDP GSO failed ({e}), falling back to sending one datagram at a time')
+			self.use_gso = False
+			view = memoryview(self.buffer)
+			for offset in range(0, len(self.buffer), self.segment_size):
+				self.sock.sendto(view[offset:offset + self.segment_size], self.send_to)
+				self.syscalls += 1
+			view.release()
+		self.frames_sent += self.segments
+		self.bytes_sent += sent
+		del self.buffer[:]
+		self.segments = 0
+		return sent
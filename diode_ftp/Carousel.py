@@ -0,0 +1,166 @@
+from collections import deque
+from os import PathLike
+from pathlib import Path
+from typing import Any, Callable, Deque, FrozenSet, Iterable, NamedTuple, Optional
+from diode_ftp.BatchSender import BatchSender
+from diode_ftp.pacer import TokenBucket
+from logging import getLogger
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_AGE = 60 * 60
+DEFAULT_MAX_TRANSFERS = 16
+
+CarouselEntry = NamedTuple('CarouselEntry', [
+	('path', Path),
+	('hash', bytes),
+	('size', int),
+	# time.time() when it was added
+	('added', float),
+	# the relative paths of the files in the tar
+	('files', FrozenSet[Path])])
+
+class Carousel():
+	"""Keeps the tars of recent transfers, and sends them again whenever the link would otherwise be idle.
+
+	If the receiver missed chunks of a transfer, it can't ask for them, so without this it only gets the files
+	once they change again. The receiver drops chunks of transfers it already completed, so rebroadcasting
+	only costs spare bandwidth.
+
+	A transfer leaves the carousel once it is older than `max_age`, once there are more than `max_transfers`
+	or `max_bytes` of newer ones, or as soon as a newer transfer has any of the same files in it
+	(so a receiver that missed it can't bring back old versions of those files).
+	The tars are dropped when the carousel is closed, or when the sender restarts.
+	"""
+	def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_age: float=DEFAULT_MAX_AGE,
+			max_transfers=DEFAULT_MAX_TRANSFERS, directory: Optional[PathLike]=None) -> None:
+		"""Creates an (empty) carousel
+
+		Args:
+			max_bytes (int, optional): The most bytes of tars to keep. Defaults to 256 MiB.
+			max_age (float, optional): Drop transfers older than this many seconds. Defaults to an hour.
+			max_transfers (int, optional): The most transfers to keep. Defaults to 16.
+			directory (Optional[PathLike], optional): Where to keep the tars. Don't put it in the synced folder,
+				or the tars will be synced too. Defaults to None, a new temporary directory.
+		"""
+		self.dir = Path(tempfile.mkdtemp(prefix='diode_carousel_') if directory is None else directory)
+		# a temporary directory is ours to remove, a given one isn't
+		self.temporary = directory is None
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.max_transfers = max_transfers
+		self.log = getLogger('carousel')
+		# oldest first
+		self.entries: Deque[CarouselEntry] = deque()
+		# the transfer we are rebroadcasting, and its chunk iterator
+		self.current: Optional[CarouselEntry] = None
+		self.context: Any = None
+		self.chunks: Any = None
+		self.dir.mkdir(parents=True, exist_ok=True)
+		# we don't know what was in tars from before a restart, so they could bring back old versions of files
+		for leftover in self.dir.glob('*.tar'):
+			os.unlink(leftover)
+		# stats
+		self.bytes_sent = 0
+
+	@property
+	def total_bytes(self):
+		return sum(entry.size for entry in self.entries)
+
+	def add(self, tar_path: PathLike, tar_hash: bytes, files: Iterable[Path]):
+		"""Takes over a tar that was just sent, moving it into the carousel"""
+		files = frozenset(files)
+		for entry in list(self.entries):
+			if not entry.files.isdisjoint(files) or entry.hash == tar_hash:
+				self.log.debug(f'{entry.hash.hex()} was superseded by {tar_hash.hex()}')
+				self.drop(entry)
+		path = self.dir / f'{tar_hash.hex()}.tar'
+		shutil.move(str(tar_path), str(path))
+		self.entries.append(CarouselEntry(path, tar_hash, path.stat().st_size, time.time(), files))
+		self.evict()
+
+	def evict(self, now: Optional[float] = None):
+		"""Drops transfers that are too old, or don't fit"""
+		now = time.time() if now is None else now
+		while len(self.entries) > 0 and (now - self.entries[0].added > self.max_age
+				or len(self.entries) > self.max_transfers or self.total_bytes > self.max_bytes):
+			self.drop(self.entries[0])
+
+	def drop(self, entry: CarouselEntry):
+		self.entries.remove(entry)
+		if entry is self.current:
+			self.stop_current()
+		try:
+			os.unlink(entry.path)
+		except OSError:
+			pass
+
+	def stop_current(self):
+		if self.context is not None:
+			self.context.__exit__(None, None, None)
+		self.current = None
+		self.context = None
+		self.chunks = None
+
+	def next_chunk(self, get_chunker: Callable[[Path, bytes, int], Any]):
+		"""Gets the next chunk to rebroadcast. Goes through every chunk of the newest transfer, then the next newest, and so on
+
+		Args:
+			get_chunker (Callable[[Path, bytes, int], FileChunker]): Creates the chunker for a tar (from its path, hash and size),
+				so it is chunked the same way it was sent
+
+		Returns:
+			Union[bytes, memoryview, None]: The chunk, or None if the carousel is empty
+		"""
+		for _ in range(len(self.entries) + 1):
+			if self.current is None:
+				if len(self.entries) == 0:
+					return None
+				self.start(self.entries[-1], get_chunker)
+			chunk = next(self.chunks, None)
+			if chunk is not None:
+				return chunk
+			# on to the next newest, wrapping around to the newest
+			i = self.entries.index(self.current)
+			following = self.entries[i - 1] if i > 0 else self.entries[-1]
+			self.stop_current()
+			self.start(following, get_chunker)
+		return None
+
+	def start(self, entry: CarouselEntry, get_chunker: Callable[[Path, bytes, int], Any]):
+		self.current = entry
+		# the chunks are sent before we read the next one, so they can share a buffer
+		self.context = get_chunker(entry.path, entry.hash, entry.size).chunk_iterator(zero_copy=True)
+		self.chunks = self.context.__enter__()
+
+	def rebroadcast(self, sender: BatchSender, pacer: TokenBucket, seconds: float,
+			get_chunker: Callable[[Path, bytes, int], Any]):
+		"""Rebroadcasts chunks for up to `seconds` (sleeping if there is nothing to send)
+
+		Returns:
+			int: The number of bytes sent
+		"""
+		deadline = time.monotonic() + seconds
+		self.evict()
+		total_bytes = 0
+		while time.monotonic() < deadline:
+			chunk = self.next_chunk(get_chunker)
+			if chunk is None:
+				time.sleep(max(deadline - time.monotonic(), 0))
+				break
+			total_bytes += len(chunk)
+			pacer.consume(sender.send(chunk))
+		pacer.consume(sender.flush())
+		self.bytes_sent += total_bytes
+		return total_bytes
+
+	def close(self):
+		"""Stops rebroadcasting and deletes the tars (and the directory, if it was a temporary one)"""
+		self.stop_current()
+		for entry in list(self.entries):
+			self.drop(entry)
+		if self.temporary:
+			shutil.rmtree(self.dir, ignore_errors=True)
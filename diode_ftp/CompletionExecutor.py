@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger, getLogger
+from threading import BoundedSemaphore, Condition
+from typing import Callable, Dict, FrozenSet, Iterable, Optional
+
+DEFAULT_WORKERS = 2
+# each queued job holds a completed tar (and its hasher), so the queue can't be allowed to grow without bound
+DEFAULT_MAX_PENDING = 64
+
+class CompletionExecutor():
+	"""Handles completed transfers on a small pool of threads, so the frame loop never waits for a tar to be
+	hashed and extracted.
+
+	Each job has two steps. `prepare` (e.g. hashing the tar and listing what it writes) runs as soon as a thread
+	is free, and returns the paths the job will write to. `apply` (e.g. extracting the tar) then waits until
+	every job submitted before it that writes to any of the same paths is done. So two tars with the same file
+	are always extracted in the order they completed, while unrelated tars are handled in parallel.
+
+	The ordering only holds between jobs of one executor, i.e. within one process. The shards of a ShardedReceiver
+	each have their own, so two tars with the same file that land on different shards can be extracted in either order.
+	"""
+	def __init__(self, workers=DEFAULT_WORKERS, log: Optional[Logger]=None, max_pending=DEFAULT_MAX_PENDING) -> None:
+		"""Starts the pool
+
+		Args:
+			workers (int, optional): The most jobs to handle at once. Defaults to 2.
+			log (Optional[Logger], optional): Where to log failed jobs. Defaults to None.
+			max_pending (int, optional): The most jobs that can be queued or running. Once there are this many,
+				`submit` blocks until one finishes. Defaults to 64.
+		"""
+		# jobs are started in the order they were submitted, so a job only ever waits for jobs that are already running
+		self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='diode-completion')
+		self.log = log or getLogger('completion_executor')
+		self.lock = Condition()
+		# job number -> the paths it writes to (None until its prepare step is done), for every unfinished job
+		self.claims: Dict[int, Optional[FrozenSet[str]]] = {}
+		self.next_job = 0
+		self.slots = BoundedSemaphore(max_pending)
+		# stats
+		self.completed = 0
+		self.failed = 0
+
+	def submit(self, prepare: Callable[[], Iterable[str]], apply: Callable[[], None]):
+		"""Queues a job. Blocks while `max_pending` jobs are already queued or running, which holds up the
+		frame loop (and lets the socket buffer absorb the burst) rather than queueing tars without limit
+
+		Args:
+			prepare (Callable[[], Iterable[str]]): Runs in parallel with other jobs, and returns the paths the job writes to
+			apply (Callable[[], None]): Runs once no earlier job that writes to the same paths is unfinished
+		"""
+		if not self.slots.acquire(blocking=False):
+			self.log.warning('Too many completed transfers are waiting to be extracted, waiting for one to finish')
+			self.slots.acquire()
+		with self.lock:
+			job = self.next_job
+			self.next_job += 1
+			self.claims[job] = None
+		self.pool.submit(self.run, job, prepare, apply)
+
+	def run(self, job: int, prepare: Callable[[], Iterable[str]], apply: Callable[[], None]):
+		try:
+			claims = frozenset(prepare())
+			with self.lock:
+				self.claims[job] = claims
+				self.lock.notify_all()
+				self.lock.wait_for(lambda: self.is_clear(job, claims))
+			apply()
+			self.completed += 1
+		except Exception:
+			self.failed += 1
+			self.log.exception('Failed to handle a completed transfer')
+		finally:
+			with self.lock:
+				del self.claims[job]
+				self.lock.notify_all()
+			self.slots.release()
+
+	def is_clear(self, job: int, claims: FrozenSet[str]):
+		for other, other_claims in self.claims.items():
+			if other >= job:
+				continue
+			if other_claims is None or not other_claims.isdisjoint(claims):
+				return False
+		return True
+
+	@property
+	def pending(self):
+		"""The number of jobs that are queued or running"""
+		with self.lock:
+			return len(self.claims)
+
+	def wait(self):
+		"""Waits for every job submitted so far to finish"""
+		with self.lock:
+			last = self.next_job
+			self.lock.wait_for(lambda: all(job >= last for job in self.claims))
+
+	def shutdown(self):
+		"""Finishes the queued jobs, and stops the pool"""
+		self.pool.shutdown(wait=True)
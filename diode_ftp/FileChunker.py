@@ -1,50 +1,119 @@
 from os import PathLike
 from os.path import getsize
-from typing import Iterable, Iterator
-from diode_ftp.header import HEADER_SIZE, create_header, hash_file, Header
+from typing import Iterable, Iterator, List, Optional, Union
+from diode_ftp.header import HEADER_SIZE, HEADER_STRUCT, create_header, hash_file, Header
+from diode_ftp.fec import FecEncoder, FecParams, pack_fec_offset
+
+DEFAULT_FEC_BLOCK_SIZE = 32
 
 class FileChunker(Iterable):
 	"""Represents the chunking of a file"""
 
-	def __init__(self, file_path: PathLike, chunk_size: int=1400) -> None:
+	def __init__(self, file_path: PathLike, chunk_size: int=1400,
+			fec_repairs: int=0, fec_block_size: int=DEFAULT_FEC_BLOCK_SIZE,
+			file_hash: Optional[bytes]=None, file_size: Optional[int]=None) -> None:
 		"""Creates a file chunker
 
 		Args:
 			file_path (PathLike): Path to the file you would like to chunk
 			chunk_size (int, optional): The maximum size of each chunk (including the 48-byte header). Defaults to 1400, roughly the Ethernet-IPV4-UDP max packet size.
+			fec_repairs (int, optional): Number of FEC repair chunks to add to each block of data chunks.
+				The receiver can rebuild a block from any `fec_block_size` of its chunks. Defaults to 0 (no FEC).
+			fec_block_size (int, optional): Number of data chunks in each FEC block. Defaults to 32.
+			file_hash (Optional[bytes], optional): The SHA-1 of the file, if you already know it. Saves reading the whole file to hash it.
+			file_size (Optional[int], optional): The size of the file, if you already know it.
 		"""
 		assert chunk_size > HEADER_SIZE
 		self.chunk_data_size = chunk_size - HEADER_SIZE
-		self.total_chunks = ((getsize(file_path) + self.chunk_data_size - 1) // self.chunk_data_size)
+		self.file_size = getsize(file_path) if file_size is None else file_size
+		self.total_chunks = ((self.file_size + self.chunk_data_size - 1) // self.chunk_data_size)
 		self.file_path = file_path
-		self.hash = hash_file(file_path)
-	def chunk_iterator(self):
+		self.hash = hash_file(file_path) if file_hash is None else file_hash
+		self.fec_repairs = fec_repairs
+		self.fec_block_size = fec_block_size
+		if fec_repairs > 0:
+			# validates the parameters up front
+			self.fec_offset = pack_fec_offset(FecParams(fec_block_size, fec_repairs, self.file_size))
+	@property
+	def total_frames(self):
+		"""The number of chunks the iterator yields, including FEC repair chunks"""
+		if self.fec_repairs == 0:
+			return self.total_chunks
+		num_blocks = (self.total_chunks + self.fec_block_size - 1) // self.fec_block_size
+		return self.total_chunks + num_blocks * self.fec_repairs
+	def chunk_iterator(self, zero_copy=False):
 		"""Gets the chunk iterator for the file
 
+		Args:
+			zero_copy (bool, optional): Reuse a single buffer for every chunk instead of allocating new ones.
+				Each chunk is then a memoryview that is only valid until the next chunk is read,
+				so send it (or copy it) straight away. Defaults to False.
+
 		Returns:
-			Iterator[bytes]: An iterator object which will go through chunk by chunk
+			Iterator[Union[bytes, memoryview]]: An iterator object which will go through chunk by chunk
 		"""
-		return self.__iter__()
+		return FileChunkIterator(self, zero_copy)
 	def __iter__(self):
 		return FileChunkIterator(self)
 
-class FileChunkIterator(Iterator[bytes]):
-	def __init__(self, owner: FileChunker) -> None:
+class FileChunkIterator(Iterator[Union[bytes, memoryview]]):
+	def __init__(self, owner: FileChunker, zero_copy=False) -> None:
 		self.owner = owner
+		self.zero_copy = zero_copy
+		self.pending_repairs: List[bytes] = []
+		self.encoder = FecEncoder(owner.fec_repairs, owner.chunk_data_size) if owner.fec_repairs > 0 else None
+		self.block = 0
 	def __enter__(self):
-		self.file = open(self.owner.file_path, 'rb', buffering=self.owner.chunk_data_size)
+		if self.zero_copy:
+			# read straight from the OS into our buffer, there's no point double-buffering
+			self.file = open(self.owner.file_path, 'rb', buffering=0)
+			self.buffer = bytearray(HEADER_SIZE + self.owner.chunk_data_size)
+			self.view = memoryview(self.buffer)
+			self.payload = self.view[HEADER_SIZE:]
+		else:
+			self.file = open(self.owner.file_path, 'rb', buffering=self.owner.chunk_data_size)
 		return self
 	def __exit__(self, exception_type, exception_value, exception_traceback):
 		self.file.close()
 		self.file = None
 	def __next__(self):
 		assert self.file != None, "File Chunk Iterator can only be run within a `with` statement"
+		if len(self.pending_repairs) > 0:
+			return self.pending_repairs.pop(0)
+		if self.zero_copy:
+			return self.next_zero_copy()
 		offset = self.file.tell()
 		file_data = self.file.read(self.owner.chunk_data_size)
 		if len(file_data) == 0:
 			raise StopIteration()
+		index = offset // self.owner.chunk_data_size
+		if self.encoder is not None:
+			self.encoder.add(file_data)
+			if self.encoder.count == self.owner.fec_block_size or index == self.owner.total_chunks - 1:
+				self.queue_repairs()
 		return create_header(
 			Header(self.owner.hash,
 				offset,
-				offset // self.owner.chunk_data_size,
-				self.owner.total_chunks)) + file_data
\ No newline at end of file
+				index,
+				self.owner.total_chunks)) + file_data
+	def next_zero_copy(self):
+		offset = self.file.tell()
+		length = self.file.readinto(self.payload)
+		if length == 0:
+			raise StopIteration()
+		index = offset // self.owner.chunk_data_size
+		HEADER_STRUCT.pack_into(self.buffer, 0, self.owner.hash, offset, index, self.owner.total_chunks)
+		if self.encoder is not None:
+			self.encoder.add(self.payload[:length])
+			if self.encoder.count == self.owner.fec_block_size or index == self.owner.total_chunks - 1:
+				self.queue_repairs()
+		return self.view[:HEADER_SIZE + length]
+	def queue_repairs(self):
+		first_index = self.owner.total_chunks + self.block * self.owner.fec_repairs
+		for j, repair in enumerate(self.encoder.finish()):
+			self.pending_repairs.append(create_header(
+				Header(self.owner.hash,
+					self.owner.fec_offset,
+					first_index + j,
+					self.owner.total_chunks)) + repair)
+		self.block += 1
\ No newline at end of file
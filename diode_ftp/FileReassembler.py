@@ -1,18 +1,33 @@
 from diode_ftp.header import HEADER_SIZE, hash_file, parse_header
-from typing import Callable, Union
+from diode_ftp.fdcache import FileDescriptorCache, pread, pwrite
+from diode_ftp.fec import FecBlockState, unpack_fec_offset
+from diode_ftp.bitset import bitset
+from typing import Callable, Dict, Set, Union
 from os import PathLike
+import os
 
 class FileReassembler():
 	"""Reassembles a chunked file"""
 
-	def __init__(self, get_file_by_hash: Callable[[bytes], PathLike]) -> None:
+	def __init__(self, get_file_by_hash: Callable[[bytes], PathLike], max_open_files=32) -> None:
 		"""Instantiates a new File Reassembler
 
 		Args:
 			get_file_by_hash (Callable[[bytes], PathLike]): A function which will return a file path for a given hash.
-				The file will be opened in 'a+b' mode. You must ensure the parent director(ies) exist
+				The file will be created if it does not exist. You must ensure the parent director(ies) exist.
+				If the file is sent with FEC, repair chunks are stored next to it, in the same path with '.fec' appended
+			max_open_files (int, optional): The number of files to keep open between chunks. Defaults to 32.
+				Files are closed once they complete (or when we need to make room), so call `close` when you are done
+				if you stop partway through a file.
 		"""
 		self.get_file_by_hash = get_file_by_hash
+		# received data chunks and FEC state of each file we are reassembling
+		self.received: Dict[bytes, bitset] = {}
+		self.fec: Dict[bytes, FecBlockState] = {}
+		# hashes of the files we have completed, so we can drop duplicate chunks
+		self.complete: Set[bytes] = set()
+		self.file_sizes: Dict[bytes, int] = {}
+		self.files = FileDescriptorCache(max_open_files)
 	def accept_chunk(self, chunk: Union[bytes, memoryview], check_for_complete=True):
 		"""Accepts a chunk and writes it to the associated file
 		Args:
@@ -26,7 +41,8 @@ class FileReassembler():
 
 		Returns:
 			bool: Always False if check_for_complete is False.
-				Otherwise, True if the file is completed by this chunk
+				Otherwise, True if the file is completed by this chunk (and hashes correctly).
+				Duplicate chunks are ignored without being written, and return False
 		"""
 		if len(chunk) < HEADER_SIZE:
 			raise RuntimeError('Recieved a chunk without a header')
@@ -35,10 +51,70 @@ class FileReassembler():
 			chunk = memoryview(chunk)
 		header = parse_header(chunk[0:HEADER_SIZE])
 		data = chunk[HEADER_SIZE:]
+		if header.hash in self.complete:
+			# we already have the whole file, so this is a duplicate
+			return False
 		path = self.get_file_by_hash(header.hash)
+		received = self.received.get(header.hash)
+		if received is None:
+			received = self.received[header.hash] = bitset(header.total)
+		fec = self.fec.get(header.hash)
 
-		# TODO: this code naively just writes whatever data it recieves. We can optimize layer
-		with open(path, mode='a+b') as f:
-			f.seek(header.offset)
-			f.write(data)
-		return check_for_complete and (hash_file(path) == header.hash)
\ No newline at end of file
+		if header.index >= header.total:
+			# FEC repair chunk
+			if fec is None:
+				fec = FecBlockState(header.total, unpack_fec_offset(header.offset), len(data))
+				self.fec[header.hash] = fec
+			location = fec.accept_repair(header.index)
+			if location is None:
+				return False
+			repair_fd = self.files.get((header.hash, 'fec'), self.get_repair_file(path),
+				fec.received_repairs.len * fec.symbol_size)
+			pwrite(repair_fd, data, fec.repair_offset(*location))
+			block = location[0]
+		else:
+			if received[header.index]:
+				# duplicate chunk, no need to write it again
+				return False
+			if header.index == header.total - 1:
+				# the last chunk tells us exactly how big the file is
+				self.file_sizes[header.hash] = header.offset + len(data)
+			pwrite(self.files.get(header.hash, path, header.total * len(data)), data, header.offset)
+			received[header.index] = True
+			block = header.index // fec.params.block_size if fec is not None else None
+		if fec is not None:
+			self.rebuild_block(header.hash, path, received, fec, block)
+		if len(received) < header.total:
+			return False
+		# every chunk has arrived, so this is the only time we need to read the file back
+		self.mark_complete(header.hash, path)
+		return check_for_complete and (hash_file(path) == header.hash)
+	def mark_complete(self, hash: bytes, path: PathLike):
+		del self.received[hash]
+		self.complete.add(hash)
+		# trim off any preallocated space past the end of the file
+		self.files.truncate(hash, path, self.file_sizes.pop(hash))
+		self.files.close(hash)
+		if hash in self.fec:
+			del self.fec[hash]
+			self.files.close((hash, 'fec'))
+			try:
+				os.unlink(self.get_repair_file(path))
+			except FileNotFoundError:
+				pass
+	def get_repair_file(self, path: PathLike):
+		return str(path) + '.fec'
+	def rebuild_block(self, hash: bytes, path: PathLike, received: bitset, fec: FecBlockState, block: int):
+		data_fd = self.files.get(hash, path, fec.params.file_size)
+		repair_fd = self.files.get((hash, 'fec'), self.get_repair_file(path))
+		rebuilt = fec.try_rebuild(block, received,
+			lambda i: pread(data_fd, fec.symbol_size, i * fec.symbol_size),
+			lambda offset: pread(repair_fd, fec.symbol_size, offset))
+		for index, chunk in rebuilt.items():
+			pwrite(data_fd, chunk, index * fec.symbol_size)
+			received[index] = True
+		if received[fec.total - 1]:
+			self.file_sizes[hash] = fec.params.file_size
+	def close(self):
+		"""Closes any files we still have open"""
+		self.files.close_all()
@@ -1,30 +1,54 @@
-from diode_ftp.bitset import bitset
 from os import PathLike
 import os
-from typing import Set, Tuple, Union
+from contextlib import nullcontext
+from typing import ContextManager, Dict, List, Optional, Tuple, Union
 from pathlib import Path
 import tarfile
 import asyncio
-from diode_ftp.header import HEADER_SIZE, Header, hash_file, parse_header
+from diode_ftp.header import HEADER_SIZE, MANIFEST_INDEX, STREAM_TOTAL, Header, hash_file, parse_header
+from diode_ftp.fdcache import FileDescriptorCache, pread, pwrite
+from diode_ftp.ReceiverState import ReceiverState, TransferState
+from diode_ftp.ReceiveEngine import FrameBatch, ReceiveEngine
+from diode_ftp.dedup import BlockStore, deduplicated_destinations, is_dedup_member, restore_deduplicated
+from diode_ftp.compression import compressed_destination, extract_compressed, is_compressed_member
+from diode_ftp.CompletionExecutor import DEFAULT_MAX_PENDING, DEFAULT_WORKERS, CompletionExecutor
+from diode_ftp.PrefixHasher import PrefixHasher
+from diode_ftp.metrics import MetricsRegistry
+import socket
 from logging import getLogger
-import shelve
-from threading import Thread
-from queue import SimpleQueue
+from threading import Lock, Thread
+import time
+from queue import Empty, SimpleQueue
+
+# deduplicated tars read blocks that earlier tars added to the block store, so they are extracted in order
+BLOCK_STORE_CLAIM = '.diode_blocks'
 
 class FolderReceiver(asyncio.DatagramProtocol):
 	"""Synchronizes a folder on the reception side.
 		Uses Asyncio to reduce idle resource usage"""
 	def __init__(self, folder: PathLike,
-			delete_tars: bool = True) -> None:
+			delete_tars: bool = True, state_name: str = 'receiver', start_worker: bool = True,
+			extract_lock: Optional[ContextManager] = None, completion_workers = DEFAULT_WORKERS,
+			max_pending_completions = DEFAULT_MAX_PENDING) -> None:
 		"""Creates a Folder Receiver.
 		Unlike FolderSender, this is implemented as an asyncio protocol.
 		You will need to use asyncio methods to set your socket and port.
 
-		In the folder, we will automatically create a python shelf named .receiver_sync_data
+		In the folder, we will automatically create .receiver_state and .receiver_journal to keep track of transfers.
+		If the sender deduplicates files, we also keep every block we receive in .diode_blocks (indexed by .diode_block_index)
 
 		Args:
 			folder (PathLike): The folder you want to sync to
 			delete_tars (bool, optional): Deletes tars after they have completed. Defaults to True.
+			state_name (str, optional): The name of the state files (see ReceiverState). Defaults to 'receiver'.
+			start_worker (bool, optional): Start the worker thread that handles queued frames. Defaults to True.
+			extract_lock (Optional[ContextManager], optional): Held while extracting tars, if other processes
+				extract into the same folder (see ShardedReceiver). The block store is then only kept open while it is held.
+				Defaults to None.
+			completion_workers (int, optional): The most completed tars to verify and extract at once, off the frame loop.
+				Tars that write to the same files are still extracted in the order they completed. Defaults to 2.
+			max_pending_completions (int, optional): The most completed tars that can wait to be extracted. Once there are
+				this many, the worker stops handling frames until one is done. Defaults to 64.
 
 		Raises:
 			ValueError: The folder to sync to doesn't exist
@@ -35,13 +59,34 @@ class FolderReceiver(asyncio.DatagramProtocol):
 			raise ValueError("The sync folder doesn't exist!")
 		self.delete_tars = delete_tars
 		self.log = getLogger(str(folder))
-		self.queue: SimpleQueue[memoryview] = SimpleQueue()
+		self.state = ReceiverState(self.root, name=state_name)
+		self.state.forget_missing(self.has_partial_files)
+		self.block_store: Optional[BlockStore] = None
+		self.extract_lock = extract_lock
+		self.completions = CompletionExecutor(completion_workers, self.log, max_pending_completions)
+		# the worker takes either single frames, or batches of frames from a ReceiveEngine
+		self.queue: SimpleQueue[Union[memoryview, FrameBatch]] = SimpleQueue()
 		self.worker = FolderReceiverWorker(self)
-		self.worker.start()
+		if start_worker:
+			self.worker.start()
 	def connection_made(self, transport) -> None:
 		self.transport = transport
-	def shelf(self):
-		return shelve.open(str(self.root / '.receiver_sync_data'))
+	def start_engine(self, local_addr: Tuple[str, int], **engine_kwargs):
+		"""Receives on a dedicated thread with a ReceiveEngine, instead of through asyncio.
+		Use this when you need to receive more packets per second than asyncio can keep up with
+
+		Args:
+			local_addr (Tuple[str, int]): The address to bind to
+			**engine_kwargs: Passed on to ReceiveEngine (e.g. rcvbuf, pool_size, max_frame_size, batch_size)
+
+		Returns:
+			ReceiveEngine: The started engine. Use `stats()` on it to see kernel vs application drops
+		"""
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(local_addr)
+		self.engine = ReceiveEngine(self, sock, **engine_kwargs)
+		self.engine.start()
+		return self.engine
 	def datagram_received(self, frame: bytes, addr: Tuple[str, int]) -> None:
 		if(len(frame) < HEADER_SIZE):
 			self.log.warn(f'Received a too-small frame from {addr}')
@@ -50,6 +95,42 @@ class FolderReceiver(asyncio.DatagramProtocol):
 		self.queue.put(frame_data)
 	def get_tar_path(self, header: Header):
 		return self.root / f'{header.hash.hex()}.tar'
+	def get_repair_path(self, header: Header):
+		return self.root / f'{header.hash.hex()}.fec'
+	def get_block_store(self):
+		"""Gets the store of blocks for rebuilding deduplicated files, creating it if needed"""
+		if self.block_store is None:
+			self.block_store = BlockStore(self.root)
+		return self.block_store
+	def close_block_store(self):
+		if self.block_store is not None:
+			self.block_store.close()
+			self.block_store = None
+	def has_partial_files(self, hash: bytes):
+		header = Header(hash, 0, 0, 0)
+		return self.get_tar_path(header).exists() or self.get_repair_path(header).exists()
+	def register_metrics(self, registry: MetricsRegistry):
+		"""Exposes this receiver's stats (read when they are scraped)"""
+		worker = self.worker
+		registry.add('diode_receiver_frames_received_total', 'counter', 'Frames handled', lambda: worker.frames_received)
+		registry.add('diode_receiver_bytes_received_total', 'counter', 'Bytes handled, including headers', lambda: worker.bytes_received)
+		registry.add('diode_receiver_duplicate_frames_total', 'counter', 'Frames dropped because we already had them',
+			lambda: worker.duplicate_frames)
+		registry.add('diode_receiver_complete_frames_total', 'counter', 'Frames dropped because their transfer was already complete',
+			lambda: worker.complete_frames)
+		registry.add('diode_receiver_bytes_written_total', 'counter', 'Bytes written to partial transfers', lambda: worker.bytes_written)
+		registry.add('diode_receiver_transfers_completed_total', 'counter', 'Transfers completed', lambda: worker.transfers_completed)
+		registry.add('diode_receiver_extraction_seconds', 'summary', 'Time spent extracting completed tars',
+			lambda: (worker.extraction_seconds, worker.extractions))
+		registry.add('diode_receiver_extraction_failures_total', 'counter', 'Completed tars that could not be extracted',
+			lambda: self.completions.failed)
+		registry.add('diode_receiver_queue_depth', 'gauge', 'Frames (or batches of frames) waiting for the worker', self.queue.qsize)
+		registry.add('diode_receiver_active_transfers', 'gauge', 'Transfers in progress', lambda: len(self.state.transfers))
+		registry.add('diode_receiver_pending_extractions', 'gauge', 'Completed tars waiting to be extracted',
+			lambda: self.completions.pending)
+		engine: Optional[ReceiveEngine] = getattr(self, 'engine', None)
+		if engine is not None:
+			registry.add_stats('diode_receive_engine', engine.stats, 'Receive engine stat')
 
 
 class FolderReceiverWorker(Thread):
@@ -57,71 +138,255 @@ class FolderReceiverWorker(Thread):
 		super().__init__()
 		self.owner = owner
 		self.daemon = True
+		# the tarballs (and FEC repair files) we are writing to, keyed by transfer hash
+		self.files = FileDescriptorCache()
+		# hashes the contiguous prefix of each transfer as it arrives, keyed by transfer hash
+		self.hashers: Dict[bytes, PrefixHasher] = {}
+		# stats
+		self.frames_received = 0
+		self.bytes_received = 0
+		self.duplicate_frames = 0
+		self.complete_frames = 0
+		self.bytes_written = 0
+		self.transfers_completed = 0
+		# extractions run on the completion threads
+		self.extraction_lock = Lock()
+		self.extraction_seconds = 0.0
+		self.extractions = 0
 	def connection_made(self, transport) -> None:
 		self.transport = transport
 	def run(self) -> None:
-		# to reduce overhead of processing already-completed files, we cache the hashes of
-		# already done files in known_complete
-		known_complete: Set[bytes] = set()
-		while frame_data := self.owner.queue.get():
-			# this is the critical loop. Any cool ideas u got to reduce this execution time goes here
-			# TODO: speed up critical loop
-			header = parse_header(frame_data[0:HEADER_SIZE])
-			chunk_data = frame_data[HEADER_SIZE:]
-			file_complete = False
-
-			# now we check the known_complete set to check if the file is complete with 0 filesystem access
-			if header.hash in known_complete:
+		state = self.owner.state
+		queue = self.owner.queue
+		while True:
+			try:
+				frame_data = queue.get(timeout=state.flush_interval)
+			except Empty:
+				# nothing is coming in, so it's a good time to persist our state
+				state.flush()
 				continue
+			if not frame_data:
+				break
+			if isinstance(frame_data, FrameBatch):
+				for frame in frame_data:
+					self.handle_frame(frame)
+				frame_data.release()
+			else:
+				self.handle_frame(frame_data)
+			if queue.empty():
+				state.idle()
+		self.files.close_all()
+		self.owner.completions.shutdown()
+		state.close()
+	def handle_frame(self, frame_data: memoryview):
+		# this is the critical loop. Any cool ideas u got to reduce this execution time goes here
+		header = parse_header(frame_data[0:HEADER_SIZE])
+		chunk_data = frame_data[HEADER_SIZE:]
+		self.frames_received += 1
+		self.bytes_received += len(frame_data)
 
-			with self.owner.shelf() as db:
-				# If a hash yields "true", then the file with that hash is complete.
-				# Else, it yields a set of the indicies already received
-				chunk_set: Union[bool, bitset] = db.get(header.hash.hex(), bitset(header.total))
-				if isinstance(chunk_set, bool):
-					# add to cache. We want to restrict the size of known_complete to not run out of ram
-					if len(known_complete) > 10:
-						known_complete = set([header.hash])
-					else:
-						known_complete.add(header.hash)
-					self.owner.log.debug('Received a chunk for a file we already completed')
-					continue
-				if chunk_set[header.index]:
-					self.owner.log.debug('Received a chunk that we already have')
-					continue
-				tarball_path = self.owner.get_tar_path(header)
-				self.write_chunk(header, chunk_data, tarball_path)
-				chunk_set[header.index] = True
-				num_chunks = len(chunk_set)
-				if num_chunks == header.total:
-					db[header.hash.hex()] = True
-					file_complete = True
-				else:
-					db[header.hash.hex()] = chunk_set
-			if not file_complete:
-				pct_prev = int(100 * (num_chunks - 1) / header.total) if num_chunks > 0 else 0
-				pct_complete = int(100 * num_chunks / header.total)
-				if pct_prev // 10 != pct_complete // 10:
-					self.owner.log.info(f'Received {pct_complete}% of {header.hash.hex()}')
-				self.owner.log.debug(f'Received {num_chunks}/{header.total} total chunks for {header.hash.hex()}')
-				continue
+		# completed transfers are tracked in memory, so this needs no filesystem access
+		if self.owner.state.is_complete(header.hash):
+			self.owner.log.debug('Received a chunk for a file we already completed')
+			self.complete_frames += 1
+			return
+		completed = self.accept_chunk(header, chunk_data)
+		if completed is not None:
+			self.transfers_completed += 1
+			tarball_path = self.owner.get_tar_path(header)
 			self.owner.log.info(f'{header.hash.hex()} Complete')
-			self.extract_tarball(tarball_path)
-			self.owner.log.info(f'Extracted tarball {str(tarball_path)}')
-			self.handle_received(tarball_path)
+			# hashing and extracting a big tar takes a while, so it's done off the frame loop
+			expected_hash = completed.expected_hash
+			hasher = self.hashers.pop(header.hash, None)
+			self.owner.completions.submit(lambda: self.prepare_tarball(tarball_path, expected_hash, hasher),
+				lambda: self.finish_tarball(tarball_path))
+	def accept_chunk(self, header: Header, chunk_data: memoryview):
+		"""Writes a chunk and updates the transfer's state
+
+		Returns:
+			Optional[TransferState]: The transfer, if it is completed by this chunk
+		"""
+		state = self.owner.state
+		transfer = state.get_transfer(header)
+		tarball_path = self.owner.get_tar_path(header)
+		block = None
+		if header.index == MANIFEST_INDEX:
+			# the end of a streamed transfer, which finally tells us how big it is and what it should hash to
+			if not state.mark_manifest(header, bytes(chunk_data[:20])):
+				self.owner.log.debug('Received a manifest that we already have')
+				self.duplicate_frames += 1
+				return None
+		elif header.total == STREAM_TOTAL:
+			if header.index < transfer.received.len and transfer.received[header.index]:
+				self.owner.log.debug('Received a chunk that we already have')
+				self.duplicate_frames += 1
+				return None
+			if transfer.total > 0 and header.index >= transfer.total:
+				self.owner.log.warning(f'Received a chunk past the end of stream {header.hash.hex()}')
+				return None
+			# we don't know how big the stream is, so there's nothing to preallocate
+			pwrite(self.files.get(header.hash, tarball_path), chunk_data, header.offset)
+			self.bytes_written += len(chunk_data)
+			state.mark_chunk(header, header.index)
+			self.hash_chunk(header, transfer, chunk_data)
+		elif header.index >= header.total:
+			# FEC repair chunk
+			location = state.mark_repair(header, len(chunk_data))
+			if location is None:
+				self.owner.log.debug('Received a repair chunk that we already have')
+				self.duplicate_frames += 1
+				return None
+			fec = transfer.fec
+			repair_fd = self.files.get((header.hash, 'fec'), self.owner.get_repair_path(header),
+				fec.received_repairs.len * fec.symbol_size)
+			pwrite(repair_fd, chunk_data, fec.repair_offset(*location))
+			self.bytes_written += len(chunk_data)
+			block = location[0]
+		else:
+			if transfer.received[header.index]:
+				self.owner.log.debug('Received a chunk that we already have')
+				self.duplicate_frames += 1
+				return None
+			self.write_chunk(header, chunk_data, tarball_path)
+			file_size = header.offset + len(chunk_data) if header.index == header.total - 1 else None
+			state.mark_chunk(header, header.index, file_size)
+			self.hash_chunk(header, transfer, chunk_data)
+			block = header.index // transfer.fec.params.block_size if transfer.fec is not None else None
+		num_prev = len(transfer.received) - 1
+		if transfer.fec is not None and block is not None:
+			rebuilt = self.rebuild_block(header, transfer, block, tarball_path)
+			if rebuilt > 0:
+				self.owner.log.info(f'Rebuilt {rebuilt} lost chunks of {header.hash.hex()} with FEC')
+				self.hash_chunk(header, transfer, None)
+		num_chunks = len(transfer.received)
+		# streamed transfers have a total of 0 until we get their manifest
+		if transfer.total == 0:
+			self.owner.log.debug(f'Received {num_chunks} chunks so far for stream {header.hash.hex()}')
+			return None
+		if num_chunks == transfer.total:
+			self.close_transfer(header, transfer)
+			state.mark_complete(header.hash)
+			return transfer
+		pct_prev = int(100 * max(num_prev, 0) / transfer.total)
+		pct_complete = int(100 * num_chunks / transfer.total)
+		if pct_prev // 10 != pct_complete // 10:
+			self.owner.log.info(f'Received {pct_complete}% of {header.hash.hex()}')
+		self.owner.log.debug(f'Received {num_chunks}/{transfer.total} total chunks for {header.hash.hex()}')
+		return None
+	def hash_chunk(self, header: Header, transfer: TransferState, chunk_data: Optional[memoryview]):
+		"""Feeds the transfer's prefix hash with a chunk that arrived (or just the chunks already on disk, if None)"""
+		hasher = self.hashers.get(header.hash)
+		if hasher is None:
+			hasher = self.hashers[header.hash] = PrefixHasher()
+		if chunk_data is not None:
+			hasher.learn_chunk_size(header.offset, header.index)
+			hasher.update(header.index, header.offset, chunk_data)
+		if hasher.next_index < transfer.received.len and transfer.received[hasher.next_index]:
+			tarball_path = self.owner.get_tar_path(header)
+			# regular transfers are preallocated past their last chunk, so `finish` hashes that one
+			end = transfer.total - 1 if transfer.total > 0 else transfer.received.len
+			hasher.catch_up(transfer.received, end,
+				lambda length, offset: pread(self.files.get(header.hash, tarball_path), length, offset))
 	def write_chunk(self, header: Header, data: memoryview, file: Path):
-		with open(str(file), mode='a+b') as f:
-			f.seek(header.offset)
-			f.write(data)
-	def extract_tarball(self, tar_file: Path, validate_hash=True):
-		if validate_hash:
+		if header.index == header.total - 1:
+			# the last chunk tells us exactly how big the file is
+			size = header.offset + len(data)
+		else:
+			size = header.total * len(data)
+		pwrite(self.files.get(header.hash, file, size), data, header.offset)
+		self.bytes_written += len(data)
+	def close_transfer(self, header: Header, transfer: TransferState):
+		"""Closes the files of a completed transfer, and trims off any preallocated space"""
+		if transfer.file_size is not None:
+			self.files.truncate(header.hash, self.owner.get_tar_path(header), transfer.file_size)
+		self.files.close(header.hash)
+		if transfer.fec is not None:
+			self.files.close((header.hash, 'fec'))
+			repair_path = self.owner.get_repair_path(header)
+			if repair_path.exists():
+				os.unlink(repair_path)
+	def rebuild_block(self, header: Header, transfer: TransferState, block: int, file: Path):
+		"""Uses FEC to rebuild any lost chunks of the block, if we have enough chunks
+
+		Returns:
+			int: The number of rebuilt chunks
+		"""
+		fec = transfer.fec
+		data_fd = self.files.get(header.hash, file, fec.params.file_size)
+		repair_fd = self.files.get((header.hash, 'fec'), self.owner.get_repair_path(header))
+		rebuilt = fec.try_rebuild(block, transfer.received,
+			lambda i: pread(data_fd, fec.symbol_size, i * fec.symbol_size),
+			lambda offset: pread(repair_fd, fec.symbol_size, offset))
+		for index, chunk in rebuilt.items():
+			pwrite(data_fd, chunk, index * fec.symbol_size)
+			self.bytes_written += len(chunk)
+			file_size = fec.params.file_size if index == header.total - 1 else None
+			self.owner.state.mark_chunk(header, index, file_size)
+		return len(rebuilt)
+	def verify_tarball(self, tar_file: Path, expected_hash: Optional[bytes]=None, hasher: Optional[PrefixHasher]=None):
+		if hasher is not None:
+			# most of it was hashed as it arrived
+			file_hash = hasher.finish(tar_file).hex()
+			self.owner.log.debug(f'Hashed {hasher.from_memory} bytes of {tar_file} as they arrived, and {hasher.from_disk} from disk')
+		else:
 			file_hash = hash_file(tar_file).hex()
-			expected_hash = tar_file.stem
-			if file_hash != expected_hash:
-				self.owner.log.warn(f'TARBALL HAS ALL REQUIRED CHUNKS, BUT HASHES DO NOT MATCH! (expect {tar_file} to hash to {file_hash})')
-		tarball = tarfile.open(tar_file, format=tarfile.GNU_FORMAT)
-		tarball.extractall(self.owner.root)
-		tarball.close()
+		# streamed tars are named by their transfer ID, so their hash comes from the manifest
+		expected_hex = expected_hash.hex() if expected_hash is not None else tar_file.stem
+		if file_hash != expected_hex:
+			self.owner.log.warn(f'TARBALL HAS ALL REQUIRED CHUNKS, BUT HASHES DO NOT MATCH! (expect {tar_file} to hash to {file_hash})')
+	def get_destinations(self, tar_file: Path):
+		"""Gets the paths (relative to the root) that extracting a tar writes to"""
+		destinations: List[str] = []
+		with tarfile.open(tar_file, format=tarfile.GNU_FORMAT) as tarball:
+			members = tarball.getmembers()
+			for member in members:
+				if is_compressed_member(member):
+					destinations.append(compressed_destination(member))
+				elif not is_dedup_member(member):
+					destinations.append(member.name)
+			if any(is_dedup_member(m) for m in members):
+				destinations.extend(deduplicated_destinations(tarball))
+				destinations.append(BLOCK_STORE_CLAIM)
+		return [os.path.normpath(d) for d in destinations]
+	def prepare_tarball(self, tar_file: Path, expected_hash: Optional[bytes]=None, hasher: Optional[PrefixHasher]=None):
+		"""Verifies a completed tar (on a completion thread)
+
+		Args:
+			tar_file (Path): The tar
+			expected_hash (Optional[bytes], optional): What it should hash to. Defaults to None (the hash in its name).
+			hasher (Optional[PrefixHasher], optional): The hash of its prefix, so far. Defaults to None (hash the whole file).
+
+		Returns:
+			List[str]: The paths it writes to, so tars with the same files are extracted in order
+		"""
+		self.verify_tarball(tar_file, expected_hash, hasher)
+		return self.get_destinations(tar_file)
+	def finish_tarball(self, tar_file: Path):
+		start = time.monotonic()
+		self.extract_tarball(tar_file, validate_hash=False)
+		with self.extraction_lock:
+			self.extraction_seconds += time.monotonic() - start
+			self.extractions += 1
+		self.owner.log.info(f'Extracted tarball {str(tar_file)}')
+		self.handle_received(tar_file)
+	def extract_tarball(self, tar_file: Path, validate_hash=True, expected_hash: Optional[bytes]=None):
+		if validate_hash:
+			self.verify_tarball(tar_file, expected_hash)
+		with self.owner.extract_lock or nullcontext():
+			tarball = tarfile.open(tar_file, format=tarfile.GNU_FORMAT)
+			members = tarball.getmembers()
+			tarball.extractall(self.owner.root,
+				members=[m for m in members if not is_dedup_member(m) and not is_compressed_member(m)])
+			for member in members:
+				if is_compressed_member(member):
+					extract_compressed(tarball, member, self.owner.root)
+			if any(is_dedup_member(m) for m in members):
+				rebuilt = restore_deduplicated(tarball, self.owner.root, self.owner.get_block_store(), self.owner.log)
+				self.owner.log.info(f'Rebuilt {rebuilt} deduplicated files')
+				if self.owner.extract_lock is not None:
+					# other processes add to the block store too, so we can't keep it open
+					self.owner.close_block_store()
+			tarball.close()
 	def handle_received(self, tarball: Path):
 		if self.owner.delete_tars:
 			os.unlink(tarball)
\ No newline at end of file
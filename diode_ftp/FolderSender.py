@@ -1,44 +1,102 @@
 from os import PathLike
 import os
-from typing import Callable, Dict, Iterable, NamedTuple, List, Optional, Set, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, NamedTuple, List, Optional, Set, Tuple, Union
 from pathlib import Path
 import socket
 from glob import iglob
 import tarfile
 import tempfile
-from diode_ftp.FileChunker import FileChunker
+from diode_ftp.FileChunker import DEFAULT_FEC_BLOCK_SIZE, FileChunker
+from diode_ftp.BatchSender import BatchSender
+from diode_ftp.pacer import TokenBucket, set_kernel_pacing
+from diode_ftp.header import HashingWriter
+from diode_ftp.StreamingChunker import StreamingChunker
+from diode_ftp.RepeatedChunker import RepeatedChunker
+from diode_ftp.dedup import DEFAULT_MAX_BLOCK_AGE, DEFAULT_MIN_FILE_SIZE, BlockIndex, DedupTarWriter
+from diode_ftp.compression import Compressor
+from diode_ftp.metadata import FileMetadata, get_all_file_metadata, get_file_metadata
+from diode_ftp.ScanCache import ScanCache
+from diode_ftp.Carousel import Carousel
+from diode_ftp.SentStore import SentStore
+from diode_ftp.TransferScheduler import Transfer, TransferScheduler
+from diode_ftp.transport import Transport
+from diode_ftp.metrics import MetricsRegistry
 import time
-from logging import getLogger
-import shelve
-from gitignore_parser.gitignore_parser import parse_gitignore
+from logging import DEBUG, getLogger
 from si_prefix import si_format
 
-FileMetadata = NamedTuple('FileMetadata', [('path', Path), ('size', int), ('mtime', float)])
 default_sender_log = getLogger('folder_sender')
 
 class FolderSender():
 	"""Synchronizes a folder on the transmission side"""
 	def __init__(self, folder: PathLike,
-			send_to: Tuple[str, int], transmit_socket: Optional[socket.socket] = None,
+			send_to: Tuple[str, int], transmit_socket: Optional[Union[socket.socket, Transport]] = None,
 			chunk_size = 1400,
-			max_bytes_per_second = 20000, transmit_repeats=2) -> None:
+			max_bytes_per_second = 20000, transmit_repeats=2,
+			fec_repairs = 0, fec_block_size = DEFAULT_FEC_BLOCK_SIZE,
+			batch_send = False, burst_bytes = 0, kernel_pacing = False,
+			streaming = False, stream_repeat_delay = 1024,
+			dedup = False, dedup_min_file_size = DEFAULT_MIN_FILE_SIZE, dedup_max_age = DEFAULT_MAX_BLOCK_AGE,
+			compressor: Optional[Compressor] = None, scan_cache: Optional[ScanCache] = None,
+			scheduler: Optional[TransferScheduler] = None,
+			repeat_separation: Optional[int] = None, repeat_separation_seconds = 0.0, shuffle_window = 0,
+			carousel: Optional[Carousel] = None) -> None:
 		"""Create a new Folder Sender.
 
-		In the folder, we will automatically create a python shelf named .sender_sync_data
+		In the folder, we will automatically create an SQLite database named .sender_sent.sqlite to track the files we've sent
 
 		Args:
 			folder (PathLike): The folder you want to sync
 			send_to (Tuple[str, int]): The IP address, Port that you want to sync to
-			transmit_socket (Optional[socket.socket], optional): The socket to use for transmission.
-				If you have an existing socket you want to use, pass it here.
+			transmit_socket (Optional[Union[socket.socket, Transport]], optional): The socket to use for transmission.
+				If you have an existing socket you want to use, pass it here. You can also pass another Transport,
+				e.g. a QueueTransport to sync within a process, or a CaptureTransport to record what is sent.
 				Otherwise, leave it to None to custom create a new socket. Defaults to None.
 			chunk_size (int, optional): The maximum size for each chunk. Try to fit it in your MTU. Defaults to 1400.
 			max_bytes_per_second (int, optional): Bandwidth limit. Set it to 0 for unlimited bandwidth. Defaults to 20000.
 			transmit_repeats (int, optional): Number of times to retransmit each chunk. Defaults to 2.
+				When using FEC, you will usually want to set this to 1.
+			fec_repairs (int, optional): Number of FEC repair chunks to add per block of chunks. Defaults to 0 (no FEC).
+			fec_block_size (int, optional): Number of chunks in each FEC block. Defaults to 32.
+			batch_send (bool, optional): Batch chunks into single sendmsg calls with Linux UDP GSO, so the kernel
+				splits them into datagrams. Falls back to one sendto per chunk where GSO isn't available. Defaults to False.
+			burst_bytes (int, optional): The most bytes the pacer lets out back to back. Defaults to 0 (20ms worth of data).
+			kernel_pacing (bool, optional): Also ask the kernel to pace the socket with SO_MAX_PACING_RATE.
+				Needs the fq qdisc on the outgoing interface. Defaults to False.
+			streaming (bool, optional): Send the tar as it is created, instead of writing it to a temporary file first.
+				The tar's hash is sent in a manifest at the end. Can't be used with FEC. Defaults to False.
+			stream_repeat_delay (int, optional): When streaming, how many chunks to wait before repeating a chunk. Defaults to 1024.
+			dedup (bool, optional): Split files into content-defined blocks, and only send blocks we haven't sent before.
+				The blocks we've sent are kept in .sender_block_index. Defaults to False.
+			dedup_min_file_size (int, optional): Files smaller than this are always sent whole. Defaults to 64 KiB.
+			dedup_max_age (float, optional): Send blocks again once this many seconds have passed since they were last sent,
+				so files stop depending on a tar that may have been lost. Defaults to a day.
+			compressor (Optional[Compressor], optional): Compresses files (other than deduplicated ones) with this,
+				e.g. Compressor('lzma'). The receiver decompresses them as it extracts the tar. Defaults to None.
+			scan_cache (Optional[ScanCache], optional): Find changed files with this, instead of walking and
+				statting the whole folder every sync. Defaults to None.
+			scheduler (Optional[TransferScheduler], optional): Split changed files into transfers by priority
+				(see .diodepriority), and send them interleaved instead of one tar at a time.
+				Each sync then only sends for the scheduler's time slice, so keep calling `perform_sync`
+				while `has_pending_transfers()`. Defaults to None.
+			repeat_separation (Optional[int], optional): Interleave the repeats of a tar, so two copies of a chunk are
+				at least this many chunks apart, instead of sending one whole copy after another. Defaults to None (a whole copy).
+			repeat_separation_seconds (float, optional): Also keep two copies of a chunk at least this many seconds apart,
+				so a fade can't take out both. Defaults to 0.
+			shuffle_window (int, optional): Shuffle the chunks of each copy of a tar, moving them by up to this many places.
+				Defaults to 0 (no shuffling).
+			carousel (Optional[Carousel], optional): Keep recent tars in this carousel instead of deleting them,
+				and rebroadcast them while there is nothing new to send (see `idle`). Can't be used with streaming. Defaults to None.
 
 		Raises:
-			ValueError: Raises if the path to sync doesn't exist
+			ValueError: Raises if the path to sync doesn't exist, or streaming is used with FEC, repeat scheduling or a carousel
 		"""
+		if streaming and fec_repairs > 0:
+			raise ValueError("Streaming transfers don't support FEC")
+		if streaming and (repeat_separation is not None or repeat_separation_seconds > 0 or shuffle_window > 0):
+			raise ValueError('Streaming transfers space out their repeats with stream_repeat_delay')
+		if streaming and carousel is not None:
+			raise ValueError("Streaming transfers don't leave a tar behind to rebroadcast")
 		self.root = Path(folder).resolve()
 		if not self.root.exists() or not self.root.is_dir():
 			raise ValueError("The sync folder doesn't exist or is not a directory!")
@@ -50,101 +108,348 @@ class FolderSender():
 		self.chunk_size = chunk_size
 		self.max_bytes_per_sec = max_bytes_per_second
 		self.transmit_repeats = transmit_repeats
+		self.fec_repairs = fec_repairs
+		self.fec_block_size = fec_block_size
+		self.batch_send = batch_send
+		self.pacer = TokenBucket(max_bytes_per_second, burst_bytes)
+		self.streaming = streaming
+		self.stream_repeat_delay = stream_repeat_delay
+		self.block_index = BlockIndex(self.root / '.sender_block_index', dedup_max_age) if dedup else None
+		# numbers the scheduler's transfers, so each one's staged blocks are committed when it is sent
+		self.transfers_created = 0
+		self.dedup_min_file_size = dedup_min_file_size
+		self.compressor = compressor
+		self.scan_cache = scan_cache
+		self.scheduler = scheduler
+		self.repeat_separation = repeat_separation
+		self.repeat_separation_seconds = repeat_separation_seconds
+		self.shuffle_window = shuffle_window
+		self.carousel = carousel
+		self.sent = SentStore(self.root / '.sender_sent.sqlite')
+		if self.sent.is_empty():
+			# carry over what older versions sent, so we don't send everything again
+			self.sent.import_shelf(self.root / '.sender_sync_data')
 		self.log = getLogger(str(folder))
+		if kernel_pacing and (not isinstance(self.sock, socket.socket) or not set_kernel_pacing(self.sock, max_bytes_per_second, self.log)):
+			self.log.warning('Kernel pacing is not available, only pacing in userspace')
+		# every send goes through this one sender, so it also counts every frame we send
+		self.batch_sender = BatchSender(self.sock, self.send_to, use_gso=batch_send, log=self.log)
+		# stats
+		self.syncs = 0
+		self.files_sent = 0
+		self.scan_seconds = 0.0
+		self.scans = 0
+		self.tar_seconds = 0.0
+		self.tars_built = 0
 
 		diodeinclude_path = self.root / '.diodeinclude'
 		if diodeinclude_path.exists():
 			self.log.warning('A .diodeinclude file was found in the directory, will on send files matched by the include')
 		self.log.warning(f'Network parameters: Chunk size of {chunk_size} bytes @ {si_format(max_bytes_per_second, precision=0)}bytes/s')
+		if fec_repairs > 0:
+			self.log.warning(f'FEC enabled: {fec_repairs} repair chunks per {fec_block_size} chunks')
 	
-	def perform_sync(self):
+	def perform_sync(self, changed_paths: Optional[Iterable[Path]] = None):
 		"""You may want to override this method if you would like to add intermediate steps
 			For example, you may want to GZIP all the files before sending them.
+
+		Args:
+			changed_paths (Optional[Iterable[Path]], optional): Only check these (absolute) paths for changes,
+				e.g. the paths from a FolderWatcher. Defaults to None, which walks the whole folder.
 		"""
-		all_metadata = get_all_file_metadata(self.root)
-		with self.shelf() as db:
-			sent_files: Set[FileMetadata] = db.get('sent', set())
+		self.syncs += 1
+		scan_start = time.monotonic()
+		if changed_paths is not None:
+			all_metadata = get_file_metadata(self.root, changed_paths)
+		elif self.scan_cache is not None:
+			# only files that changed since the last scan, but that's all we need to compare against the 'sent' set
+			all_metadata = self.scan_cache.scan().changed
+			self.log.debug(f'Scan listed {self.scan_cache.dirs_listed} directories, reused {self.scan_cache.dirs_reused}')
+		else:
+			all_metadata = get_all_file_metadata(self.root)
 		# new files are detected rsync style:
-		# we do a comparison of the previous 'sent' set and the new set of file metdata
+		# we do a comparison of the sent-file store and the new set of file metdata
 		# any changes in mtime, path, or file size will trigger a retransmission
-		changed_files = all_metadata - sent_files
+		changed_files = self.sent.changed(all_metadata)
+		self.scan_seconds += time.monotonic() - scan_start
+		self.scans += 1
+		if self.scheduler is not None:
+			self.schedule_files([f for f in changed_files if not self.scheduler.is_in_flight(f)])
+			return
 		if len(changed_files) == 0:
 			self.log.debug('no new files found')
+			if self.scan_cache is not None:
+				self.scan_cache.commit()
 			return
 		self.log.info(f'Found {len(changed_files)} changed files')
-		self.log.debug(f'Changed files:  {changed_files}')
+		if self.log.isEnabledFor(DEBUG):
+			self.log.debug(f'Changed files:  {changed_files}')
 		
 		renamer_to_file = {
 			lambda p: (self.root / p, str(p)): changed_files
 		}
-		tar_path, included = tarball_files(renamer_to_file)
+		if self.streaming:
+			included = self.stream_files(renamer_to_file)
+			self.forget_unsent(changed_files, included)
+			self.mark_sent(included)
+			return
+		tar_path, included, tar_hash, tar_size = self.build_tarball(renamer_to_file)
 		self.log.debug(f'Created new tarball: {tar_path}')
-		chunker = self.get_chunker(tar_path)
-		transmit_chunks(chunker, self.sock, self.send_to, self.max_bytes_per_sec, self.transmit_repeats, self.log)
+		chunker, repeats = self.schedule_repeats(self.get_chunker(tar_path, tar_hash, tar_size))
+		transmit_chunks(chunker, self.sock, self.send_to, self.max_bytes_per_sec, repeats, self.log,
+			batch_send=self.batch_send, pacer=self.pacer, sender=self.batch_sender)
 		self.log.info(f'Transmitted tarball: {tar_path} (hash: {chunker.hash.hex()})')
 
 		# do cleanup
-		with self.shelf() as db:
-			db['sent'] = included.union(sent_files)
-		self.handle_sent(tar_path)
-
-	def shelf(self):
-		return shelve.open(str(self.root / '.sender_sync_data'))
-	def get_chunker(self, file: Path):
-		return FileChunker(file, chunk_size=self.chunk_size)
-	def handle_sent(self, tarball: Path):
+		self.forget_unsent(changed_files, included)
+		self.mark_sent(included)
+		self.handle_sent(tar_path, chunker.hash, included)
+
+	def schedule_files(self, changed_files: List[FileMetadata]):
+		"""Queues the changed files in the scheduler, and sends for one time slice"""
+		if len(changed_files) > 0:
+			self.log.info(f'Found {len(changed_files)} changed files')
+			if self.log.isEnabledFor(DEBUG):
+				self.log.debug(f'Changed files:  {changed_files}')
+		for priority, files in self.scheduler.plan(changed_files):
+			self.scheduler.add(self.create_transfer(files, priority))
+		if self.scheduler.is_idle():
+			self.log.debug('no new files found')
+		else:
+			self.scheduler.run(self.batch_sender, self.pacer, self.idle if self.carousel is not None else None)
+		if self.scheduler.is_idle():
+			# only now is everything we scanned (and every block we staged) on the wire
+			self.commit_indexes()
+
+	def create_transfer(self, files: List[FileMetadata], priority: int):
+		renamer_to_file = {
+			lambda p: (self.root / p, str(p)): files
+		}
+		self.transfers_created += 1
+		stage_key = self.transfers_created
+		if self.streaming:
+			def on_streamed(transfer: Transfer):
+				self.log.info(f'Streamed transfer {transfer.chunker.transfer_id.hex()} (hash: {transfer.chunker.hash.hex()})')
+				self.forget_unsent(files, transfer.chunker.result)
+				self.mark_sent(transfer.chunker.result, commit=False)
+				self.commit_blocks(stage_key)
+			# the streaming chunker sends its own repeats
+			return Transfer(lambda: self.get_streaming_chunker(renamer_to_file, stage_key), 1, files, priority, on_streamed)
+		tarball: Optional[Tarball] = None
+		def start():
+			nonlocal tarball
+			tarball = self.build_tarball(renamer_to_file, stage_key)
+			self.log.info(f'Sending {len(files)} files with priority {priority} in tarball: {tarball.path}')
+			# while we wait for a repeat to be due, the scheduler can send other transfers
+			return self.schedule_repeats(self.get_chunker(tarball.path, tarball.hash, tarball.size), blocking=False)[0]
+		def on_sent(transfer: Transfer):
+			self.log.info(f'Transmitted tarball: {tarball.path} (hash: {tarball.hash.hex()})')
+			self.forget_unsent(files, tarball.included)
+			self.mark_sent(tarball.included, commit=False)
+			self.commit_blocks(stage_key)
+			self.handle_sent(tarball.path, tarball.hash, tarball.included)
+		return Transfer(start, 1 if self.repeats_are_scheduled() else self.transmit_repeats, files, priority, on_sent)
+
+	def has_pending_transfers(self):
+		"""Checks if the scheduler still has transfers to send"""
+		return self.scheduler is not None and not self.scheduler.is_idle()
+
+	def get_streaming_chunker(self, resolver_to_file: Dict['ResolveAbsoluteAndAliasFunc', Iterable[FileMetadata]], stage_key: Any = None):
+		produce = lambda f: write_tarball(f, resolver_to_file, self.block_index, self.dedup_min_file_size, self.compressor, stage_key)
+		return StreamingChunker(produce, chunk_size=self.chunk_size, repeats=self.transmit_repeats, repeat_delay=self.stream_repeat_delay)
+
+	def stream_files(self, resolver_to_file: Dict['ResolveAbsoluteAndAliasFunc', Iterable[FileMetadata]]):
+		"""Tars the files straight onto the wire, without writing a temporary tar first
+
+		Returns:
+			Set[FileMetadata]: The files that made it into the tar
+		"""
+		chunker = self.get_streaming_chunker(resolver_to_file)
+		self.log.info(f'Streaming transfer {chunker.transfer_id.hex()}')
+		# the streaming chunker sends its own repeats
+		transmit_chunks(chunker, self.sock, self.send_to, self.max_bytes_per_sec, 1, self.log,
+			batch_send=self.batch_send, pacer=self.pacer, sender=self.batch_sender)
+		self.log.info(f'Streamed transfer {chunker.transfer_id.hex()} (hash: {chunker.hash.hex()})')
+		return chunker.result
+
+	def build_tarball(self, resolver_to_file: Dict['ResolveAbsoluteAndAliasFunc', Iterable[FileMetadata]], stage_key: Any = None):
+		start = time.monotonic()
+		tarball = tarball_files(resolver_to_file, block_index=self.block_index,
+			dedup_min_file_size=self.dedup_min_file_size, compressor=self.compressor, stage_key=stage_key)
+		self.tar_seconds += time.monotonic() - start
+		self.tars_built += 1
+		return tarball
+	def mark_sent(self, sent_files: Set[FileMetadata], commit=True):
+		self.sent.mark_sent(sent_files)
+		self.files_sent += len(sent_files)
+		if commit:
+			self.commit_indexes()
+	def forget_unsent(self, files: Iterable[FileMetadata], included: Set[FileMetadata]):
+		# files we couldn't read were left out of the tar, so the scan cache has to keep reporting them
+		if self.scan_cache is not None:
+			self.scan_cache.forget(f.path for f in files if f not in included)
+	def commit_indexes(self):
+		self.commit_blocks()
+		if self.scan_cache is not None:
+			self.scan_cache.commit()
+	def commit_blocks(self, stage_key: Any = None):
+		# the blocks in the tar we just sent can be left out of future tars
+		if self.block_index is not None:
+			self.block_index.commit(stage_key)
+	def get_chunker(self, file: Path, file_hash: Optional[bytes] = None, file_size: Optional[int] = None):
+		return FileChunker(file, chunk_size=self.chunk_size,
+			fec_repairs=self.fec_repairs, fec_block_size=self.fec_block_size,
+			file_hash=file_hash, file_size=file_size)
+	def repeats_are_scheduled(self):
+		return self.repeat_separation is not None or self.repeat_separation_seconds > 0 or self.shuffle_window > 0
+	def schedule_repeats(self, chunker: FileChunker, blocking=True):
+		"""Wraps a chunker to space out (and shuffle) its repeats, if we were asked to
+
+		Returns:
+			Tuple[Union[FileChunker, RepeatedChunker], int]: The chunker to send, and how many times to send it
+		"""
+		if not self.repeats_are_scheduled():
+			return chunker, self.transmit_repeats
+		return RepeatedChunker(chunker, self.transmit_repeats, self.repeat_separation, self.repeat_separation_seconds,
+			self.shuffle_window, blocking=blocking), 1
+	def handle_sent(self, tarball: Path, tar_hash: Optional[bytes] = None, included: Iterable[FileMetadata] = ()):
+		if self.carousel is not None and tar_hash is not None:
+			self.log.debug(f'Keeping {tarball} to rebroadcast')
+			self.carousel.add(tarball, tar_hash, [f.path for f in included])
+			return
 		self.log.debug(f'Deleting: {tarball}')
 		os.unlink(tarball)
+	def idle(self, seconds: float):
+		"""Waits for up to `seconds` while there's nothing new to send.
+		With a carousel, the time is spent rebroadcasting recent transfers instead"""
+		if self.carousel is None:
+			time.sleep(seconds)
+			return
+		self.carousel.rebroadcast(self.batch_sender, self.pacer, seconds, self.get_chunker)
+	def close(self):
+		"""Releases what the sender holds on to between syncs, like the carousel's tars and the compressor's workers"""
+		if self.carousel is not None:
+			self.carousel.close()
+		if self.compressor is not None:
+			self.compressor.close()
+	def active_transfers(self):
+		if self.scheduler is None:
+			return 0
+		return sum(len(transfers) for transfers in self.scheduler.classes.values())
+	def register_metrics(self, registry: MetricsRegistry):
+		"""Exposes this sender's stats (read when they are scraped)"""
+		sender = self.batch_sender
+		registry.add('diode_sender_frames_sent_total', 'counter', 'Frames sent', lambda: sender.frames_sent)
+		registry.add('diode_sender_bytes_sent_total', 'counter', 'Bytes sent, including headers', lambda: sender.bytes_sent)
+		registry.add('diode_sender_syscalls_total', 'counter', 'Send syscalls made', lambda: sender.syscalls)
+		registry.add('diode_sender_syncs_total', 'counter', 'Syncs performed', lambda: self.syncs)
+		registry.add('diode_sender_files_sent_total', 'counter', 'Files sent', lambda: self.files_sent)
+		registry.add('diode_sender_scan_seconds', 'summary', 'Time spent finding changed files',
+			lambda: (self.scan_seconds, self.scans))
+		registry.add('diode_sender_tar_build_seconds', 'summary', 'Time spent building tars',
+			lambda: (self.tar_seconds, self.tars_built))
+		registry.add('diode_sender_active_transfers', 'gauge', 'Transfers waiting to be sent', self.active_transfers)
 
 ResolveAbsoluteAndAliasFunc = Callable[[Path], Tuple[Union[str, Path], str]]
+Tarball = NamedTuple('Tarball', [('path', Path), ('included', Set[FileMetadata]), ('hash', bytes), ('size', int)])
 def tarball_files(resolver_to_file: Dict[ResolveAbsoluteAndAliasFunc, Iterable[FileMetadata]],
-			tar_dir: Path=None):
-	included: Set[FileMetadata] = set()
+			tar_dir: Path=None, block_index: Optional[BlockIndex]=None, dedup_min_file_size=DEFAULT_MIN_FILE_SIZE,
+			compressor: Optional[Compressor]=None, stage_key: Any=None):
+	"""Tars files into a temporary file, hashing the tar as it is written.
+	Files can be deduplicated and compressed on the way in (see write_tarball)
+
+	Returns:
+		Tarball: The path to the tar, the files that made it in, and the tar's SHA-1 and size
+	"""
 	with tempfile.NamedTemporaryFile('wb', suffix='.tar', delete=False, dir=tar_dir) as f:
-		with tarfile.open(fileobj=f, mode='w', format=tarfile.GNU_FORMAT) as tarball:
-			for resolver, files in resolver_to_file.items():
-				for file in files:
-					try:
-						absolute_path, alias_name = resolver(file.path)
+		writer = HashingWriter(f)
+		included = write_tarball(writer, resolver_to_file, block_index, dedup_min_file_size, compressor, stage_key)
+		f.close()
+		return Tarball(Path(f.name), included, writer.digest(), writer.size)
+
+def write_tarball(fileobj, resolver_to_file: Dict[ResolveAbsoluteAndAliasFunc, Iterable[FileMetadata]],
+		block_index: Optional[BlockIndex]=None, dedup_min_file_size=DEFAULT_MIN_FILE_SIZE,
+		compressor: Optional[Compressor]=None, stage_key: Any=None):
+	"""Writes files as a tar into a file-like object
+
+	Args:
+		fileobj: The file-like object to write to
+		resolver_to_file (Dict[ResolveAbsoluteAndAliasFunc, Iterable[FileMetadata]]): The files to tar, and how to find and name them
+		block_index (Optional[BlockIndex], optional): If given, files of at least dedup_min_file_size are sent as recipes
+			of content-defined blocks, leaving out blocks in the index. The new blocks are staged in the index,
+			to be committed once the tar is sent. Defaults to None.
+		dedup_min_file_size (int, optional): The smallest file to deduplicate. Defaults to 64 KiB.
+		compressor (Optional[Compressor], optional): If given, the other regular files are compressed with it. Defaults to None.
+		stage_key (Any, optional): The key to stage the new blocks under, to commit them once this tar is sent
+			(see BlockIndex.stage). Defaults to None.
+
+	Returns:
+		Set[FileMetadata]: The files that made it into the tar
+	"""
+	included: Set[FileMetadata] = set()
+	to_compress: Dict[str, Tuple[FileMetadata, Union[str, Path]]] = {}
+	with tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT) as tarball:
+		deduper = DedupTarWriter(tarball, block_index, dedup_min_file_size, stage_key=stage_key) if block_index is not None else None
+		for resolver, files in resolver_to_file.items():
+			for file in files:
+				try:
+					absolute_path, alias_name = resolver(file.path)
+					if deduper is not None and deduper.add(absolute_path, alias_name):
+						included.add(file)
+					elif compressor is not None and os.path.isfile(absolute_path) and not os.path.islink(absolute_path):
+						# compressed all at once later, so the process pool can work on them in parallel
+						to_compress[alias_name] = (file, absolute_path)
+					else:
 						tarball.add(absolute_path, arcname=alias_name)
 						included.add(file)
-					except OSError:
-						pass
-		f.close()
-		return Path(f.name), included
+				except OSError:
+					pass
+		if deduper is not None:
+			deduper.finish()
+			default_sender_log.info(f'Deduplicated {si_format(deduper.bytes_deduped, precision=0)}bytes '
+				f'out of {si_format(deduper.bytes_in, precision=0)}bytes in big files')
+		if compressor is not None:
+			for alias_name in compressor.add_to_tar(tarball, [(path, alias) for alias, (_, path) in to_compress.items()]):
+				included.add(to_compress[alias_name][0])
+			default_sender_log.info(f'Compression: {compressor.stats}')
+	return included
+
+def transmit_chunks(chunker: FileChunker, sock: Union[socket.socket, Transport], send_to: Tuple[str, int], max_bytes_per_sec=0, num_repeats=2, log=default_sender_log,
+		batch_send=False, pacer: Optional[TokenBucket] = None, sender: Optional[BatchSender] = None):
+	"""Sends every chunk of a file, num_repeats times
 
-def transmit_chunks(chunker: FileChunker, sock: socket.socket, send_to: Tuple[str, int], max_bytes_per_sec=0, num_repeats=2, log=default_sender_log):
+	Args:
+		chunker (FileChunker): The file to send
+		sock (Union[socket.socket, Transport]): The socket (or transport) to send with
+		send_to (Tuple[str, int]): The IP address, Port to send to
+		max_bytes_per_sec (int, optional): Bandwidth limit, 0 for unlimited. Defaults to 0.
+		num_repeats (int, optional): Number of times to send each chunk. Defaults to 2.
+		log (Logger, optional): The logger to use.
+		batch_send (bool, optional): Batch chunks into single sendmsg calls with Linux UDP GSO, where available. Defaults to False.
+		pacer (Optional[TokenBucket], optional): The pacer to rate-limit with. Pass one in to share the budget across calls.
+			Defaults to None, which creates one for max_bytes_per_sec.
+		sender (Optional[BatchSender], optional): The sender to send with, e.g. to keep its frame counts across calls.
+			Defaults to None, which creates one for sock.
+	"""
 	total_bytes = 0
 	start_time = time.monotonic()
+	if sender is None:
+		sender = BatchSender(sock, send_to, use_gso=batch_send, log=log)
+	if pacer is None:
+		pacer = TokenBucket(max_bytes_per_sec)
+	if batch_send and not sender.use_gso:
+		log.warning('UDP GSO is not available, sending one datagram at a time')
+	# formatting a debug message for every chunk is surprisingly expensive, so only do it if someone's listening
+	log_chunks = log.isEnabledFor(DEBUG)
 	for copy in range(0, num_repeats):
 		log.info(f'Sending copy {copy+1}/{num_repeats}')
-		with chunker.chunk_iterator() as chunks:
+		# the chunks are sent (or copied into a batch) straight away, so they can share a buffer
+		with chunker.chunk_iterator(zero_copy=True) as chunks:
 			for chunk_idx, chunk in enumerate(chunks):
 				total_bytes += len(chunk)
-				sock.sendto(chunk, send_to)
-				if max_bytes_per_sec != 0:
-					time.sleep(len(chunk) / max_bytes_per_sec)
-				log.debug(f'Sent copy {copy+1}/{num_repeats} of chunk {chunk_idx}')
+				pacer.consume(sender.send(chunk))
+				if log_chunks:
+					log.debug(f'Sent copy {copy+1}/{num_repeats} of chunk {chunk_idx}')
+		pacer.consume(sender.flush())
 		total_time = time.monotonic() - start_time
 		log.info(f'Sent {si_format(total_bytes, precision=0)}bytes in {total_time}s ({si_format(total_bytes / (total_time+0.0001))}bytes/s)')
-
-def get_all_file_metadata(root: Path, rel_to_root=True, find_diodeinclude=True, ignore_hidden=True, follow_links=True):
-	def file_to_metadata(file_path_str: str):
-		file_path = Path(file_path_str)
-		stat = file_path.stat()
-		return FileMetadata(Path(file_path).relative_to(root) if rel_to_root else file_path.resolve(), stat.st_size, stat.st_mtime)
-	
-	metadata: Set[FileMetadata] = set()
-	matcher = None
-	if find_diodeinclude:
-		diodeignore_path = root / '.diodeinclude'
-		if diodeignore_path.exists():
-			matcher = parse_gitignore(diodeignore_path, root)
-	for dir_name, _, files in os.walk(root, followlinks=follow_links):
-		if ignore_hidden:
-			files = filter(lambda p: not p.startswith('.'), files)
-		if matcher is not None:
-			files = filter(lambda p: matcher(os.path.join(dir_name, p)), files)
-		files_metadata = map(lambda p: file_to_metadata(os.path.join(dir_name, p)), files)
-		metadata.update(files_metadata)
-	return metadata
\ No newline at end of file
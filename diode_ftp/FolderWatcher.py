@@ -0,0 +1,133 @@
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Optional, Set
+from diode_ftp.inotify import (IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE_SELF, IN_IGNORED, IN_ISDIR,
+	IN_MODIFY, IN_MOVE_SELF, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW, Inotify)
+from logging import getLogger
+import os
+import time
+
+# what we watch every directory for
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+	| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+class FolderWatcher():
+	"""Watches a folder (recursively) with inotify, and collects the files that changed.
+
+	Instead of walking the whole tree every interval, the sender waits on `wait_for_changes`,
+	which returns as soon as the changed files have settled (no events for `settle` seconds).
+	Every `rescan_interval` seconds, or if the kernel's event queue overflows, it asks for a full rescan instead,
+	as a safety net for events we missed.
+	"""
+	def __init__(self, folder: PathLike, settle=1.0, max_delay=30.0, rescan_interval=600.0, ignore_hidden=True) -> None:
+		"""Starts watching a folder. Linux only (check `inotify_supported()` first)
+
+		Args:
+			folder (PathLike): The folder to watch
+			settle (float, optional): Wait until files haven't changed for this many seconds before syncing. Defaults to 1.0.
+			max_delay (float, optional): Sync after this many seconds even if files keep changing. Defaults to 30.0.
+			rescan_interval (float, optional): Ask for a full rescan this often (seconds). Defaults to 600.0.
+			ignore_hidden (bool, optional): Ignore changes to hidden files, like the sender's own state. Defaults to True.
+		"""
+		self.root = Path(folder).resolve()
+		self.settle = settle
+		self.max_delay = max_delay
+		self.rescan_interval = rescan_interval
+		self.ignore_hidden = ignore_hidden
+		self.log = getLogger(str(folder))
+		self.inotify = Inotify()
+		self.watches: Dict[int, Path] = {}
+		self.dirty: Set[Path] = set()
+		self.first_dirty: Optional[float] = None
+		self.last_event = 0.0
+		# the first sync is always a full scan
+		self.needs_rescan = True
+		self.last_rescan = time.monotonic()
+		self.watch_tree(self.root)
+
+	def watch_tree(self, folder: Path, mark_dirty=False):
+		"""Watches a directory and everything under it. If mark_dirty is set, every file in it is marked as changed
+		(e.g. a directory that was just moved in)"""
+		for dir_name, _, files in os.walk(folder, followlinks=True):
+			try:
+				wd = self.inotify.add_watch(dir_name, WATCH_MASK)
+				self.watches[wd] = Path(dir_name)
+			except OSError as e:
+				# most likely fs.inotify.max_user_watches, so we have to fall back on rescans
+				self.log.warning(f'Could not watch {dir_name} ({e}), relying on periodic rescans')
+			if mark_dirty:
+				for file in files:
+					self.mark_dirty(Path(dir_name) / file)
+
+	def mark_dirty(self, path: Path):
+		if self.ignore_hidden and path.name.startswith('.'):
+			return
+		self.last_event = time.monotonic()
+		if self.first_dirty is None:
+			self.first_dirty = self.last_event
+		self.dirty.add(path)
+
+	def handle_events(self, timeout: float):
+		for event in self.inotify.read_events(timeout):
+			if event.mask & IN_Q_OVERFLOW:
+				self.log.warning('inotify queue overflowed, doing a full rescan')
+				self.needs_rescan = True
+				continue
+			folder = self.watches.get(event.wd)
+			if folder is None:
+				continue
+			if event.mask & IN_IGNORED:
+				del self.watches[event.wd]
+				continue
+			if event.mask & (IN_DELETE_SELF | IN_MOVE_SELF) or event.name == '':
+				continue
+			path = folder / event.name
+			if event.mask & IN_ISDIR:
+				if event.mask & (IN_CREATE | IN_MOVED_TO):
+					self.watch_tree(path, mark_dirty=True)
+			else:
+				self.mark_dirty(path)
+
+	def wait_for_changes(self, timeout: Optional[float] = None):
+		"""Blocks until it's time to sync
+
+		Args:
+			timeout (Optional[float], optional): Give up after this many seconds, and return no changes.
+				Defaults to None, which waits as long as it takes.
+
+		Returns:
+			Optional[Set[Path]]: The absolute paths of the files that changed, or None if the whole folder should be rescanned
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		polled = False
+		while True:
+			now = time.monotonic()
+			if now - self.last_rescan >= self.rescan_interval:
+				self.needs_rescan = True
+			if self.needs_rescan:
+				self.needs_rescan = False
+				self.last_rescan = now
+				self.dirty = set()
+				self.first_dirty = None
+				return None
+			if self.first_dirty is not None:
+				settled = now - self.last_event >= self.settle
+				overdue = now - self.first_dirty >= self.max_delay
+				if settled or overdue:
+					dirty = self.dirty
+					self.dirty = set()
+					self.first_dirty = None
+					return dirty
+				wait = min(self.settle - (now - self.last_event), self.max_delay - (now - self.first_dirty))
+			else:
+				wait = self.rescan_interval - (now - self.last_rescan)
+			if deadline is not None:
+				# read whatever is waiting at least once, even with no time left
+				if now >= deadline and polled:
+					return set()
+				wait = min(wait, deadline - now)
+			self.handle_events(max(wait, 0))
+			polled = True
+
+	def close(self):
+		self.inotify.close()
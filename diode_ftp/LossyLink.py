@@ -0,0 +1,166 @@
+from typing import List, NamedTuple, Optional, Tuple
+from logging import getLogger
+from threading import Event, Thread
+import heapq
+import random
+import select
+import socket
+import time
+
+MAX_DATAGRAM = 65535
+# the most datagrams to read in a row before delivering the ones that are due
+DRAIN_BATCH = 64
+
+Impairments = NamedTuple('Impairments', [
+	# chance of losing any datagram
+	('loss', float),
+	# Gilbert-Elliott burst loss: the chance of the link going bad (per datagram), and of it recovering.
+	# While it is bad, datagrams are lost with chance `burst_loss`. 0 disables burst loss
+	('burst_enter', float),
+	('burst_exit', float),
+	('burst_loss', float),
+	# chance of holding a datagram back by `reorder_delay` seconds, so the ones after it overtake it
+	('reorder', float),
+	('reorder_delay', float),
+	# chance of delivering a datagram twice
+	('duplicate', float),
+	# the link's rate in bytes per second (0 is unlimited). Datagrams queue up behind each other,
+	# and are dropped if they would wait longer than `max_queue_delay` seconds
+	('rate', float),
+	('max_queue_delay', float)])
+
+def make_impairments(loss=0.0, burst_enter=0.0, burst_exit=1.0, burst_loss=1.0, reorder=0.0, reorder_delay=0.005,
+		duplicate=0.0, rate=0.0, max_queue_delay=0.05):
+	"""Creates Impairments, with everything off by default"""
+	return Impairments(loss, burst_enter, burst_exit, burst_loss, reorder, reorder_delay, duplicate, rate, max_queue_delay)
+
+class GilbertElliott():
+	"""A two-state model of bursty loss: the link flips between a good state (no loss) and a bad state (lossy).
+	The average burst lasts 1 / exit_chance datagrams, and the link is bad enter / (enter + exit) of the time"""
+	def __init__(self, enter_chance: float, exit_chance: float, bad_loss=1.0, rng: Optional[random.Random]=None) -> None:
+		self.enter_chance = enter_chance
+		self.exit_chance = exit_chance
+		self.bad_loss = bad_loss
+		self.rng = rng or random.Random()
+		self.bad = False
+	def lose(self):
+		"""Steps the model for one datagram
+
+		Returns:
+			bool: True if the datagram is lost
+		"""
+		if self.bad:
+			if self.rng.random() < self.exit_chance:
+				self.bad = False
+		elif self.rng.random() < self.enter_chance:
+			self.bad = True
+		return self.bad and self.rng.random() < self.bad_loss
+
+class LossyLink(Thread):
+	"""A UDP proxy that forwards datagrams to a destination through a simulated bad link, for testing and benchmarks.
+
+	Send to `link.address`, and datagrams come out at `destination` with the configured loss, burst loss,
+	reordering, duplication and rate cap.
+	"""
+	def __init__(self, destination: Tuple[str, int], impairments: Impairments = make_impairments(),
+			local_addr: Tuple[str, int] = ('127.0.0.1', 0), seed: Optional[int] = None) -> None:
+		"""Binds the proxy (call `start` to run it)
+
+		Args:
+			destination (Tuple[str, int]): Where to forward datagrams to
+			impairments (Impairments, optional): What to do to them. Defaults to nothing.
+			local_addr (Tuple[str, int], optional): The address to receive on. Defaults to any port on localhost.
+			seed (Optional[int], optional): Seeds the random impairments, for repeatable runs. Defaults to None.
+		"""
+		super().__init__(daemon=True, name='lossy-link')
+		self.destination = destination
+		self.impairments = impairments
+		self.rng = random.Random(seed)
+		self.bursts = GilbertElliott(impairments.burst_enter, impairments.burst_exit, impairments.burst_loss, self.rng)
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+		self.sock.bind(local_addr)
+		self.sock.setblocking(False)
+		self.address: Tuple[str, int] = self.sock.getsockname()
+		self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.stopping = Event()
+		self.log = getLogger('lossy_link')
+		# (delivery time, sequence number, datagram), soonest first
+		self.pending: List[Tuple[float, int, bytes]] = []
+		self.seq = 0
+		# when the simulated link finishes sending what is queued on it
+		self.link_free_at = 0.0
+		# stats
+		self.received = 0
+		self.delivered = 0
+		self.lost = 0
+		self.burst_lost = 0
+		self.queue_drops = 0
+		self.reordered = 0
+		self.duplicated = 0
+
+	def run(self) -> None:
+		while not self.stopping.is_set():
+			now = time.monotonic()
+			while len(self.pending) > 0 and self.pending[0][0] <= now:
+				_, _, datagram = heapq.heappop(self.pending)
+				self.out.sendto(datagram, self.destination)
+				self.delivered += 1
+			timeout = 0.05 if len(self.pending) == 0 else max(min(self.pending[0][0] - now, 0.05), 0)
+			readable, _, _ = select.select([self.sock], [], [], timeout)
+			if readable:
+				self.drain(time.monotonic())
+		self.sock.close()
+		self.out.close()
+
+	def drain(self, now: float):
+		# one select per datagram can't keep up at high packet rates
+		for _ in range(DRAIN_BATCH):
+			try:
+				datagram = self.sock.recv(MAX_DATAGRAM)
+			except BlockingIOError:
+				return
+			self.accept(datagram, now)
+
+	def accept(self, datagram: bytes, now: float):
+		"""Decides what happens to a datagram, and schedules its delivery"""
+		self.received += 1
+		imp = self.impairments
+		# the burst model steps on every datagram, whether or not it's lost for another reason
+		if self.bursts.lose():
+			self.burst_lost += 1
+			return
+		if self.rng.random() < imp.loss:
+			self.lost += 1
+			return
+		copies = 2 if self.rng.random() < imp.duplicate else 1
+		self.duplicated += copies - 1
+		for _ in range(copies):
+			deliver_at = now
+			if imp.rate > 0:
+				start = max(now, self.link_free_at)
+				if start - now > imp.max_queue_delay:
+					self.queue_drops += 1
+					continue
+				self.link_free_at = start + len(datagram) / imp.rate
+				deliver_at = self.link_free_at
+			if self.rng.random() < imp.reorder:
+				self.reordered += 1
+				deliver_at += imp.reorder_delay
+			heapq.heappush(self.pending, (deliver_at, self.seq, datagram))
+			self.seq += 1
+
+	def stats(self):
+		return {
+			'received': self.received,
+			'delivered': self.delivered,
+			'lost': self.lost,
+			'burst_lost': self.burst_lost,
+			'queue_drops': self.queue_drops,
+			'reordered': self.reordered,
+			'duplicated': self.duplicated,
+		}
+
+	def stop(self):
+		self.stopping.set()
+		self.join(1)
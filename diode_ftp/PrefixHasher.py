@@ -0,0 +1,86 @@
+from os import PathLike
+from typing import Callable, Optional, Union
+from diode_ftp.bitset import bitset
+import hashlib
+
+# the most bytes we read back from disk per chunk received, so filling a big gap doesn't stall the frame loop
+MAX_CATCH_UP = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+class PrefixHasher():
+	"""Hashes a transfer as it arrives, so checking it once it completes only has to hash the tail.
+
+	SHA-1 has to be fed in order, so we hash the contiguous prefix of the transfer: whenever the next chunk
+	we need arrives, we hash it straight from memory. Chunks that arrived early are already on disk, so once the gap
+	before them is filled, we read them back (a few MiB at a time, see MAX_CATCH_UP).
+
+	The last chunk of a regular transfer is never read back, since the file is preallocated past the end of it
+	until the transfer is closed. `finish` hashes whatever is left from disk.
+	The hash state isn't saved, so after a restart the prefix is read back from disk instead.
+	"""
+	def __init__(self) -> None:
+		self.sha1 = hashlib.sha1()
+		# the number of bytes (and chunks) hashed so far
+		self.hashed = 0
+		self.next_index = 0
+		# the size of every chunk but the last, once we know it
+		self.chunk_size: Optional[int] = None
+		# stats
+		self.from_memory = 0
+		self.from_disk = 0
+
+	def learn_chunk_size(self, offset: int, index: int):
+		if self.chunk_size is None and index > 0:
+			self.chunk_size = offset // index
+
+	def update(self, index: int, offset: int, data: Union[bytes, memoryview]):
+		"""Hashes a chunk that just arrived, if it's the next one we need"""
+		if index != self.next_index or offset != self.hashed:
+			return
+		self.sha1.update(data)
+		self.hashed += len(data)
+		self.from_memory += len(data)
+		self.next_index += 1
+
+	def catch_up(self, received: bitset, end: int, read: Callable[[int, int], bytes], budget=MAX_CATCH_UP):
+		"""Reads back and hashes the chunks after the prefix that are already on disk
+
+		Args:
+			received (bitset): The chunks we have
+			end (int): Stop before this chunk
+			read (Callable[[int, int], bytes]): Reads (length, offset) from the transfer's file
+			budget (int, optional): The most bytes to read. Defaults to MAX_CATCH_UP.
+		"""
+		if self.chunk_size is None or self.chunk_size == 0 or self.hashed != self.next_index * self.chunk_size:
+			# a short read left us in the middle of a chunk, so leave the rest to `finish`
+			return
+		count = 0
+		limit = min(end, received.len)
+		while self.next_index + count < limit and count * self.chunk_size < budget and received[self.next_index + count]:
+			count += 1
+		remaining = count * self.chunk_size
+		while remaining > 0:
+			data = read(min(remaining, READ_SIZE), self.hashed)
+			if len(data) == 0:
+				break
+			self.sha1.update(data)
+			self.hashed += len(data)
+			self.from_disk += len(data)
+			remaining -= len(data)
+		self.next_index += count
+
+	def finish(self, path: PathLike):
+		"""Hashes the rest of the (completed) transfer from disk
+
+		Returns:
+			bytes: The hash of the whole transfer
+		"""
+		with open(path, 'rb') as f:
+			f.seek(self.hashed)
+			while True:
+				data = f.read(READ_SIZE)
+				if not data:
+					break
+				self.sha1.update(data)
+				self.from_disk += len(data)
+		return self.sha1.digest()
@@ -0,0 +1,173 @@
+from collections import deque
+from diode_ftp.header import HEADER_SIZE
+from logging import getLogger
+from threading import Thread
+from typing import Deque, List, Optional
+import select
+import socket
+import struct
+import sys
+
+# python doesn't expose these linux constants
+IS_LINUX = sys.platform.startswith('linux')
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if IS_LINUX else None)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33 if IS_LINUX else None)
+RXQ_OVFL_STRUCT = struct.Struct('=I')
+
+class FrameBatch(list):
+	"""A batch of frames read by the ReceiveEngine. The frames are views into the engine's buffer pool,
+	so they are only valid until `release` is called"""
+	def __init__(self, engine: 'ReceiveEngine') -> None:
+		super().__init__()
+		self.engine = engine
+		self.slots: List[int] = []
+	def release(self):
+		"""Returns the batch's buffers to the pool"""
+		self.engine.free_slots.extend(self.slots)
+		self.slots = []
+		self.clear()
+
+class ReceiveEngine(Thread):
+	"""Drains a UDP socket on a dedicated thread, and hands batches of frames to a FolderReceiver.
+
+	Compared to asyncio's datagram_received, this avoids a Python callback and a fresh `bytes` per datagram:
+	frames are read with recvmsg_into/recvfrom_into into a pool of preallocated buffers,
+	and everything already waiting in the socket is handed to the worker as one batch.
+	"""
+	def __init__(self, receiver, sock: socket.socket, rcvbuf=8 * 1024 * 1024,
+			pool_size=4096, max_frame_size=9216, batch_size=256) -> None:
+		"""Creates a receive engine. Call `start()` to start receiving
+
+		Args:
+			receiver (FolderReceiver): The receiver to hand frames to
+			sock (socket.socket): A bound UDP socket
+			rcvbuf (int, optional): The socket receive buffer size to ask the kernel for. Defaults to 8 MiB.
+				Linux caps this at net.core.rmem_max unless we are privileged.
+			pool_size (int, optional): The number of frame buffers to preallocate. Defaults to 4096.
+			max_frame_size (int, optional): The largest frame we can receive. Larger frames are dropped. Defaults to 9216.
+			batch_size (int, optional): The maximum number of frames in a batch. Defaults to 256.
+		"""
+		super().__init__()
+		self.daemon = True
+		self.receiver = receiver
+		self.sock = sock
+		self.max_frame_size = max_frame_size
+		self.batch_size = batch_size
+		self.running = True
+		self.log = getLogger('receive_engine')
+
+		self.arena = memoryview(bytearray(pool_size * max_frame_size))
+		self.slots = [self.arena[i * max_frame_size:(i + 1) * max_frame_size] for i in range(pool_size)]
+		self.free_slots: Deque[int] = deque(range(pool_size))
+		self.scratch = bytearray(max_frame_size)
+
+		# stats
+		self.frames_received = 0
+		self.bytes_received = 0
+		self.batches = 0
+		self.kernel_drops: Optional[int] = None
+		self.app_drops = 0
+		self.truncated_frames = 0
+		self.runt_frames = 0
+
+		self.set_rcvbuf(rcvbuf)
+		self.use_recvmsg = hasattr(sock, 'recvmsg_into') and SO_RXQ_OVFL is not None
+		if self.use_recvmsg:
+			try:
+				sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+				self.kernel_drops = 0
+			except OSError:
+				self.use_recvmsg = False
+		self.sock.setblocking(False)
+
+	def set_rcvbuf(self, rcvbuf: int):
+		try:
+			if SO_RCVBUFFORCE is not None:
+				self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+			else:
+				raise PermissionError()
+		except OSError:
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+		actual = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+		if actual < rcvbuf:
+			self.log.warning(f'Asked for a {rcvbuf} byte receive buffer, but only got {actual}. Consider raising net.core.rmem_max')
+
+	def stats(self):
+		"""Gets the engine's counters
+
+		Returns:
+			Dict[str, int]: The counters. kernel_drops counts datagrams the kernel dropped because the socket buffer was full
+				(None if the OS can't tell us). app_drops counts datagrams we read but had to drop
+				because every buffer in the pool was in use
+		"""
+		return {
+			'frames_received': self.frames_received,
+			'bytes_received': self.bytes_received,
+			'batches': self.batches,
+			'kernel_drops': self.kernel_drops,
+			'app_drops': self.app_drops,
+			'truncated_frames': self.truncated_frames,
+			'runt_frames': self.runt_frames,
+			'free_buffers': len(self.free_slots),
+		}
+
+	def stop(self):
+		self.running = False
+
+	def recv_into(self, buf: memoryview):
+		"""Reads a single datagram. Raises BlockingIOError if there are none
+
+		Returns:
+			Tuple[int, bool]: The number of bytes read, and whether the datagram was truncated
+		"""
+		if self.use_recvmsg:
+			nbytes, ancdata, flags, _ = self.sock.recvmsg_into([buf], socket.CMSG_SPACE(RXQ_OVFL_STRUCT.size))
+			for level, kind, data in ancdata:
+				if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+					# the kernel gives us the total number of drops on this socket
+					self.kernel_drops = RXQ_OVFL_STRUCT.unpack(data[:RXQ_OVFL_STRUCT.size])[0]
+			return nbytes, (flags & getattr(socket, 'MSG_TRUNC', 0)) != 0
+		nbytes, _ = self.sock.recvfrom_into(buf)
+		return nbytes, nbytes == len(buf)
+
+	def read_batch(self):
+		"""Reads everything already waiting in the socket (up to batch_size frames) into a batch"""
+		batch = FrameBatch(self)
+		for _ in range(self.batch_size):
+			if len(self.free_slots) > 0:
+				slot = self.free_slots.popleft()
+				buf = self.slots[slot]
+			else:
+				slot = None
+				buf = memoryview(self.scratch)
+			try:
+				nbytes, truncated = self.recv_into(buf)
+			except (BlockingIOError, InterruptedError):
+				if slot is not None:
+					self.free_slots.appendleft(slot)
+				break
+			if slot is None:
+				self.app_drops += 1
+				continue
+			self.frames_received += 1
+			self.bytes_received += nbytes
+			if truncated or nbytes < HEADER_SIZE:
+				if truncated:
+					self.truncated_frames += 1
+				else:
+					self.runt_frames += 1
+				self.free_slots.appendleft(slot)
+				continue
+			batch.append(buf[:nbytes])
+			batch.slots.append(slot)
+		return batch
+
+	def run(self) -> None:
+		while self.running:
+			readable, _, _ = select.select([self.sock], [], [], 0.5)
+			if len(readable) == 0:
+				continue
+			batch = self.read_batch()
+			if len(batch) > 0:
+				self.batches += 1
+				self.receiver.queue.put(batch)
@@ -0,0 +1,215 @@
+from diode_ftp.bitset import bitset
+from diode_ftp.fec import FecBlockState, unpack_fec_offset
+from diode_ftp.header import MANIFEST_INDEX, STREAM_TOTAL, Header
+from os import PathLike
+import os
+from pathlib import Path
+from typing import Callable, Dict, Optional, Set
+import pickle
+import struct
+import time
+
+# journal records: type, hash, index, total, offset, symbol size, expected hash
+# for data chunks, offset is the file size if the chunk tells us it (0 otherwise)
+# for manifests, the expected hash is the SHA-1 of the stream (zeros otherwise)
+JOURNAL_STRUCT = struct.Struct('!c20sIIQI20s')
+RECORD_CHUNK = b'C'
+RECORD_REPAIR = b'R'
+RECORD_MANIFEST = b'M'
+RECORD_COMPLETE = b'D'
+
+class TransferState():
+	"""In-memory state of a transfer we are receiving"""
+	def __init__(self, total: int, expected_hash: Optional[bytes] = None) -> None:
+		# streaming transfers don't know their total (or hash) until their manifest arrives
+		self.total = total
+		self.expected_hash = expected_hash
+		# set once a streaming transfer's manifest has been applied
+		self.has_manifest = False
+		self.received = bitset(total)
+		self.fec: Optional[FecBlockState] = None
+		# known once the last chunk arrives (or is rebuilt)
+		self.file_size: Optional[int] = None
+
+def new_transfer(hash: bytes, total: int):
+	if total == STREAM_TOTAL:
+		return TransferState(0)
+	# regular transfers are named by their hash
+	return TransferState(total, hash)
+
+def apply_manifest(transfer: TransferState, total: int, file_size: int, stream_hash: bytes):
+	transfer.total = total
+	transfer.file_size = file_size
+	transfer.expected_hash = stream_hash
+	transfer.has_manifest = True
+	transfer.received.resize(total)
+
+class ReceiverState():
+	"""Keeps the receiver's transfer state in memory, and persists it with an append-only journal.
+
+	Every change is appended to the journal as a small fixed-size record (buffered, see `flush`).
+	Once the journal grows past `compact_after` records, the whole state is pickled into a snapshot
+	and the journal is truncated. On startup, we load the snapshot and replay the journal on top of it.
+	"""
+	def __init__(self, root: PathLike, flush_after=1024, flush_interval=1.0, compact_after=100000, name='receiver') -> None:
+		"""Loads (or creates) the receiver state in a folder
+
+		Args:
+			root (PathLike): The receiver's folder. We create .receiver_state and .receiver_journal in here
+			flush_after (int, optional): Flush the journal after this many records. Defaults to 1024.
+			flush_interval (float, optional): Flush the journal at least this often (seconds) when records are pending. Defaults to 1.0.
+			compact_after (int, optional): Compact the journal into a snapshot after this many records. Defaults to 100000.
+			name (str, optional): Names the state files (.<name>_state and .<name>_journal), so several receivers
+				(e.g. the shards of a ShardedReceiver) can keep their own state in one folder. Defaults to 'receiver'.
+		"""
+		self.root = Path(root)
+		self.snapshot_path = self.root / f'.{name}_state'
+		self.journal_path = self.root / f'.{name}_journal'
+		self.flush_after = flush_after
+		self.flush_interval = flush_interval
+		self.compact_after = compact_after
+		self.transfers: Dict[bytes, TransferState] = {}
+		self.complete: Set[bytes] = set()
+		self.pending: bytearray = bytearray()
+		self.pending_records = 0
+		self.journal_records = 0
+		self.last_flush = time.monotonic()
+		self.load()
+		self.journal = open(self.journal_path, 'ab', buffering=0)
+
+	def load(self):
+		if self.snapshot_path.exists():
+			with open(self.snapshot_path, 'rb') as f:
+				self.transfers, self.complete = pickle.load(f)
+		if self.journal_path.exists():
+			with open(self.journal_path, 'rb') as f:
+				journal = f.read()
+			# a crash can leave a torn record at the end, which we ignore
+			usable = len(journal) - len(journal) % JOURNAL_STRUCT.size
+			for record in JOURNAL_STRUCT.iter_unpack(memoryview(journal)[:usable]):
+				self.replay(*record)
+				self.journal_records += 1
+
+	def replay(self, kind: bytes, hash: bytes, index: int, total: int, offset: int, symbol_size: int, expected_hash: bytes):
+		if kind == RECORD_COMPLETE:
+			self.transfers.pop(hash, None)
+			self.complete.add(hash)
+			return
+		if hash in self.complete:
+			return
+		transfer = self.transfers.get(hash)
+		if transfer is None:
+			# a manifest carries the stream's real total, but it is still a stream
+			transfer = self.transfers[hash] = new_transfer(hash, STREAM_TOTAL if kind == RECORD_MANIFEST else total)
+		if kind == RECORD_CHUNK:
+			transfer.received.resize(index + 1)
+			transfer.received[index] = True
+			if offset != 0:
+				transfer.file_size = offset
+		elif kind == RECORD_MANIFEST:
+			apply_manifest(transfer, total, offset, expected_hash)
+		elif kind == RECORD_REPAIR:
+			if transfer.fec is None:
+				transfer.fec = FecBlockState(total, unpack_fec_offset(offset), symbol_size)
+			transfer.fec.accept_repair(index)
+
+	def forget_missing(self, has_partial_files: Callable[[bytes], bool]):
+		"""Drops state for incomplete transfers whose partial files have gone missing,
+		so they will be received from scratch
+
+		Args:
+			has_partial_files (Callable[[bytes], bool]): Checks if the partial files for a transfer hash still exist
+		"""
+		for hash in list(self.transfers.keys()):
+			if not has_partial_files(hash):
+				del self.transfers[hash]
+
+	def is_complete(self, hash: bytes):
+		return hash in self.complete
+	def get_transfer(self, header: Header):
+		"""Gets the state for an incomplete transfer, creating it if needed"""
+		transfer = self.transfers.get(header.hash)
+		if transfer is None:
+			# the manifest can be the first chunk of a stream we see, and it carries the stream's real total
+			total = STREAM_TOTAL if header.index == MANIFEST_INDEX else header.total
+			transfer = self.transfers[header.hash] = new_transfer(header.hash, total)
+		return transfer
+
+	def mark_chunk(self, header: Header, index: int, file_size: Optional[int] = None):
+		"""Marks a data chunk as received
+
+		Args:
+			header (Header): The header of the chunk (or, for a rebuilt chunk, of the chunk that triggered the rebuild)
+			index (int): The index of the chunk
+			file_size (Optional[int], optional): The size of the whole file, if this chunk tells us. Defaults to None.
+		"""
+		transfer = self.transfers[header.hash]
+		if header.total == STREAM_TOTAL:
+			transfer.received.resize(index + 1)
+		transfer.received[index] = True
+		if file_size is not None:
+			transfer.file_size = file_size
+		self.append(RECORD_CHUNK, header.hash, index, header.total, file_size or 0)
+	def mark_repair(self, header: Header, symbol_size: int):
+		"""Marks an FEC repair chunk as received
+
+		Returns:
+			Tuple[int, int]: (block, repair number within the block), or None if we already had it
+		"""
+		transfer = self.transfers[header.hash]
+		if transfer.fec is None:
+			transfer.fec = FecBlockState(header.total, unpack_fec_offset(header.offset), symbol_size)
+		location = transfer.fec.accept_repair(header.index)
+		if location is not None:
+			self.append(RECORD_REPAIR, header.hash, header.index, header.total, header.offset, symbol_size)
+		return location
+	def mark_manifest(self, header: Header, stream_hash: bytes):
+		"""Records the manifest of a streaming transfer
+
+		Returns:
+			bool: False if we already had the manifest
+		"""
+		transfer = self.get_transfer(header)
+		if transfer.has_manifest:
+			return False
+		apply_manifest(transfer, header.total, header.offset, stream_hash)
+		self.append(RECORD_MANIFEST, header.hash, header.index, header.total, header.offset, expected_hash=stream_hash)
+		return True
+	def mark_complete(self, hash: bytes):
+		self.transfers.pop(hash, None)
+		self.complete.add(hash)
+		self.append(RECORD_COMPLETE, hash)
+		# completing a transfer is rare, and we really don't want to receive it again after a crash
+		self.flush()
+
+	def append(self, kind: bytes, hash: bytes, index=0, total=0, offset=0, symbol_size=0, expected_hash=bytes(20)):
+		self.pending += JOURNAL_STRUCT.pack(kind, hash, index, total, offset, symbol_size, expected_hash)
+		self.pending_records += 1
+		if self.pending_records >= self.flush_after:
+			self.flush()
+	def idle(self):
+		"""Call when there is a lull in traffic. Flushes the journal if it has been a while"""
+		if self.pending_records > 0 and time.monotonic() - self.last_flush >= self.flush_interval:
+			self.flush()
+	def flush(self):
+		if self.pending_records > 0:
+			self.journal.write(self.pending)
+			self.journal_records += self.pending_records
+			self.pending = bytearray()
+			self.pending_records = 0
+		self.last_flush = time.monotonic()
+		if self.journal_records >= self.compact_after:
+			self.compact()
+	def compact(self):
+		"""Writes the whole state to a snapshot, then empties the journal"""
+		tmp_path = self.snapshot_path.with_suffix('.tmp')
+		with open(tmp_path, 'wb') as f:
+			pickle.dump((self.transfers, self.complete), f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.snapshot_path)
+		self.journal.truncate(0)
+		self.journal_records = 0
+	def close(self):
+		self.flush()
+		self.journal.close()
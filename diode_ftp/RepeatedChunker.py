@@ -0,0 +1,197 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import random
+import time
+
+# returned by a non-blocking iterator when no chunk is due yet
+NOT_READY: Any = object()
+# the longest we sleep at once while waiting for a repeat to be due
+MAX_WAIT = 0.1
+
+class RepeatedChunker(Iterable):
+	"""Sends every chunk of another chunker several times, with the copies spread far apart.
+
+	Sending copy 1 of every chunk and then copy 2 straight after means a fade (or a full buffer) that is longer than
+	the gap between the copies wipes out both. Instead, the passes over the file are interleaved with a head start:
+	a chunk's copy in one pass only goes out once the pass before it sent that chunk at least `separation`
+	chunks and `separation_seconds` seconds ago. Each pass can also be shuffled (within a window), so a loss
+	pattern that repeats doesn't line up with the same chunks every pass. The separation holds for each chunk,
+	however it was shuffled.
+
+	If nothing else is left to send, the chunk separation is relaxed (we can't make chunks out of thin air),
+	but the time separation never is: we wait for it.
+	"""
+	def __init__(self, chunker, repeats: int=2, separation: Optional[int]=None, separation_seconds=0.0,
+			shuffle_window=0, blocking=True, seed: Optional[int]=None) -> None:
+		"""Wraps a chunker
+
+		Args:
+			chunker (FileChunker): The chunker to repeat. It is iterated once per pass
+			repeats (int, optional): The number of times to send each chunk. Defaults to 2.
+			separation (Optional[int], optional): The least number of chunks between two copies of a chunk.
+				Defaults to None, a whole pass.
+			separation_seconds (float, optional): The least time between two copies of a chunk. Defaults to 0.
+			shuffle_window (int, optional): Shuffle each pass, moving chunks by up to this many places. Defaults to 0 (in order).
+			blocking (bool, optional): Sleep until the next chunk is due. If False, the iterator returns NOT_READY instead,
+				so the caller can send something else in the meantime. Defaults to True.
+			seed (Optional[int], optional): Seeds the shuffle. Defaults to None.
+		"""
+		self.chunker = chunker
+		self.repeats = repeats
+		self.separation = chunker.total_frames if separation is None else separation
+		self.separation_seconds = separation_seconds
+		self.shuffle_window = shuffle_window
+		self.blocking = blocking
+		self.rng = random.Random(seed)
+	@property
+	def hash(self):
+		return self.chunker.hash
+	@property
+	def total_frames(self):
+		return self.chunker.total_frames * self.repeats
+	def chunk_iterator(self, zero_copy=False):
+		"""Gets the chunk iterator for every pass
+
+		Args:
+			zero_copy (bool, optional): Passed on to the chunker (unless we shuffle, which has to hold on to chunks).
+				Each chunk is only valid until the next one is read. Defaults to False.
+
+		Returns:
+			Iterator[Union[bytes, memoryview]]: An iterator over every copy of every chunk
+		"""
+		return RepeatIterator(self, zero_copy)
+	def __iter__(self):
+		return self.chunk_iterator()
+
+class PassState():
+	"""One pass over the chunker"""
+	def __init__(self, context, window: int) -> None:
+		self.context = context
+		self.chunks = context.__enter__()
+		# without a shuffle we only look one chunk ahead
+		self.window = max(window, 1)
+		self.copy = window > 0
+		# (index in the file's order, chunk) of the chunks we've read but not sent
+		self.buffer: List[Tuple[int, Any]] = []
+		self.read = 0
+		self.exhausted = False
+		self.done = False
+		# index -> (sequence number, time) of the chunks we sent that the next pass hasn't sent its copy of yet
+		self.sent: Dict[int, Tuple[int, float]] = {}
+	def fill(self):
+		while not self.exhausted and len(self.buffer) < self.window:
+			chunk = next(self.chunks, None)
+			if chunk is None:
+				self.exhausted = True
+			else:
+				# a shuffled chunk is held while others are read, so it can't share the chunker's buffer
+				self.buffer.append((self.read, bytes(chunk) if self.copy else chunk))
+				self.read += 1
+	def take(self, i: int):
+		self.buffer[i], self.buffer[-1] = self.buffer[-1], self.buffer[i]
+		return self.buffer.pop()
+	def close(self):
+		self.done = True
+		self.context.__exit__(None, None, None)
+
+class RepeatIterator(Iterator[Any]):
+	def __init__(self, owner: RepeatedChunker, zero_copy=False) -> None:
+		self.owner = owner
+		self.zero_copy = zero_copy and owner.shuffle_window == 0
+		self.passes: List[Optional[PassState]] = [None] * owner.repeats
+		self.turn = 0
+		# the number of chunks we've sent
+		self.seq = 0
+		self.wait_until = 0.0
+	def __enter__(self):
+		return self
+	def __exit__(self, exception_type, exception_value, exception_traceback):
+		for state in self.passes:
+			if state is not None and not state.done:
+				state.close()
+	def __next__(self):
+		chunk = self.poll()
+		while chunk is NOT_READY and self.owner.blocking:
+			time.sleep(min(max(self.wait_until - time.monotonic(), 0), MAX_WAIT))
+			chunk = self.poll()
+		return chunk
+	def poll(self):
+		"""Gets the next chunk that is due
+
+		Returns:
+			Union[bytes, memoryview]: The chunk, or NOT_READY if we have to wait for one to be due
+
+		Raises:
+			StopIteration: Every pass is done
+		"""
+		while True:
+			now = time.monotonic()
+			self.wait_until = float('inf')
+			relaxed: Optional[Tuple[int, int]] = None
+			pending = False
+			for attempt in range(self.owner.repeats):
+				k = (self.turn + attempt) % self.owner.repeats
+				state = self.passes[k]
+				if state is not None and state.done:
+					continue
+				pending = True
+				prev = self.passes[k - 1] if k > 0 else None
+				if k > 0 and (prev is None or (len(prev.sent) == 0 and not prev.done)):
+					# a pass can't get ahead of the one before it
+					continue
+				state = self.open(k)
+				state.fill()
+				if len(state.buffer) == 0:
+					state.close()
+					# that pass just finished, look again
+					break
+				due, late = self.due_chunks(state, prev, now)
+				if len(due) > 0:
+					self.turn = k + 1
+					return self.emit(k, due[self.owner.rng.randrange(len(due))] if len(due) > 1 else due[0], now)
+				if relaxed is None and len(late) > 0:
+					relaxed = (k, late[0])
+			else:
+				if not pending:
+					raise StopIteration()
+				if relaxed is None:
+					return NOT_READY
+				return self.emit(*relaxed, now)
+	def due_chunks(self, state: PassState, prev: Optional[PassState], now: float):
+		"""Finds the buffered chunks of a pass that can be sent, going by when the pass before it sent its copy of each
+
+		Returns:
+			Tuple[List[int], List[int]]: The positions in the buffer of the chunks that are due, and of the chunks
+				that would be due if not for the chunk separation (which we relax when nothing else can be sent)
+		"""
+		if prev is None:
+			return list(range(len(state.buffer))), []
+		due: List[int] = []
+		late: List[int] = []
+		for i, (index, _) in enumerate(state.buffer):
+			sent = prev.sent.get(index)
+			if sent is None:
+				# the pass before hasn't sent it yet
+				continue
+			seq, sent_at = sent
+			if now - sent_at < self.owner.separation_seconds:
+				self.wait_until = min(self.wait_until, sent_at + self.owner.separation_seconds)
+			elif self.seq - seq < self.owner.separation:
+				late.append(i)
+			else:
+				due.append(i)
+		return due, late
+	def open(self, k: int):
+		state = self.passes[k]
+		if state is None:
+			context = self.owner.chunker.chunk_iterator(zero_copy=self.zero_copy)
+			state = self.passes[k] = PassState(context, self.owner.shuffle_window)
+		return state
+	def emit(self, k: int, i: int, now: float):
+		state = self.passes[k]
+		index, chunk = state.take(i)
+		if k > 0:
+			self.passes[k - 1].sent.pop(index, None)
+		if k < self.owner.repeats - 1:
+			state.sent[index] = (self.seq, now)
+		self.seq += 1
+		return chunk
@@ -0,0 +1,190 @@
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from diode_ftp.metadata import FileMetadata, get_diodeinclude_matcher
+from gitignore_parser.gitignore_parser import GitignoreMatcher
+import os
+import pickle
+import time
+
+# a directory modified this close to when we listed it may have changed again within the same mtime tick,
+# so we don't trust its mtime until it is older than this (like git's "racy" index entries)
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+class DirState():
+	"""What we saw in a directory the last time we listed it"""
+	def __init__(self, mtime_ns: int, listed_ns: int) -> None:
+		self.mtime_ns = mtime_ns
+		self.listed_ns = listed_ns
+		# name -> (size, mtime)
+		self.files: Dict[str, Tuple[int, float]] = {}
+		self.subdirs: List[str] = []
+	def unchanged(self, mtime_ns: int):
+		return mtime_ns == self.mtime_ns and mtime_ns < self.listed_ns - RACY_NS
+
+ScanDiff = NamedTuple('ScanDiff', [
+	# new or modified files since the last committed scan
+	('changed', Set[FileMetadata]),
+	# relative paths of files that disappeared since the last committed scan
+	('removed', Set[Path])])
+
+class ScanCache():
+	"""Finds what changed in a folder since the last scan, without re-listing directories that haven't changed.
+
+	We keep the listing of every directory, keyed by its mtime. A directory's mtime changes whenever entries are
+	created, deleted or renamed in it, so if it hasn't changed we can reuse its old listing instead of reading it again.
+	Editing a file in place doesn't touch its directory's mtime though, so by default we still stat the files in
+	unchanged directories (one syscall each, instead of a listing plus a stat and some path juggling per file).
+	If files are only ever added (e.g. new log files, never rewritten), set `verify_files=False` to skip that too,
+	and then scanning costs one stat per directory.
+
+	The cache is kept in .sender_scan_cache, and only updated by `commit` (once the changes have been sent),
+	so changes are reported again if a sync fails.
+	"""
+	def __init__(self, folder: PathLike, verify_files=True, find_diodeinclude=True, ignore_hidden=True, follow_links=True) -> None:
+		"""Loads (or creates) the scan cache for a folder
+
+		Args:
+			folder (PathLike): The folder to scan
+			verify_files (bool, optional): Stat files in unchanged directories, to catch files edited in place. Defaults to True.
+			find_diodeinclude (bool, optional): Only report files matched by the .diodeinclude, if there is one. Defaults to True.
+			ignore_hidden (bool, optional): Don't report hidden files. Defaults to True.
+			follow_links (bool, optional): Follow symlinked directories. Defaults to True.
+		"""
+		self.root = Path(folder).resolve()
+		self.path = self.root / '.sender_scan_cache'
+		self.verify_files = verify_files
+		self.find_diodeinclude = find_diodeinclude
+		self.ignore_hidden = ignore_hidden
+		self.follow_links = follow_links
+		self.dirs: Dict[str, DirState] = {}
+		self.include_stamp: Optional[Tuple[int, int]] = None
+		if self.path.exists():
+			try:
+				with open(self.path, 'rb') as f:
+					self.dirs, self.include_stamp = pickle.load(f)
+			except Exception:
+				# a crash while saving can leave a torn cache. It's only a cache, so start over
+				self.dirs, self.include_stamp = {}, None
+		# the result of the latest scan, saved by commit
+		self.pending: Optional[Tuple[Dict[str, DirState], Optional[Tuple[int, int]]]] = None
+		# relative paths that commit should leave marked as changed
+		self.forgotten: Set[Path] = set()
+		# stats for the latest scan
+		self.dirs_listed = 0
+		self.dirs_reused = 0
+		self.files_statted = 0
+
+	def scan(self):
+		"""Scans the folder, and compares it to the last committed scan
+
+		Returns:
+			ScanDiff: The files that were added, modified or removed
+		"""
+		self.dirs_listed = self.dirs_reused = self.files_statted = 0
+		include_stamp = self.get_include_stamp()
+		# if the .diodeinclude changed, files we skipped before might be wanted now
+		old_dirs = self.dirs if include_stamp == self.include_stamp else {}
+		new_dirs: Dict[str, DirState] = {}
+		matcher = get_diodeinclude_matcher(self.root) if self.find_diodeinclude else None
+		self.scan_dir('', self.root, old_dirs, new_dirs, matcher)
+		self.pending = (new_dirs, include_stamp)
+
+		def wanted(rel_dir: str, name: str):
+			if self.ignore_hidden and name.startswith('.'):
+				return False
+			return matcher is None or matcher.match(os.path.join(rel_dir, name))
+		changed: Set[FileMetadata] = set()
+		removed: Set[Path] = set()
+		for rel_dir, state in new_dirs.items():
+			old = old_dirs.get(rel_dir)
+			for name, (size, mtime) in state.files.items():
+				if old is not None and old.files.get(name) == (size, mtime):
+					continue
+				if wanted(rel_dir, name):
+					changed.add(FileMetadata(Path(rel_dir, name), size, mtime))
+			if old is not None:
+				removed.update(Path(rel_dir, name) for name in old.files if name not in state.files)
+		for rel_dir, old in old_dirs.items():
+			if rel_dir not in new_dirs:
+				removed.update(Path(rel_dir, name) for name in old.files)
+		return ScanDiff(changed, removed)
+
+	def scan_dir(self, rel_dir: str, path: Path, old_dirs: Dict[str, DirState], new_dirs: Dict[str, DirState],
+			matcher: Optional[GitignoreMatcher]):
+		try:
+			mtime_ns = os.stat(path).st_mtime_ns
+		except OSError:
+			return
+		old = old_dirs.get(rel_dir)
+		if old is not None and old.unchanged(mtime_ns):
+			self.dirs_reused += 1
+			state = old
+			if self.verify_files:
+				state = DirState(old.mtime_ns, old.listed_ns)
+				state.subdirs = old.subdirs
+				for name in old.files:
+					try:
+						stat = os.stat(os.path.join(path, name))
+					except OSError:
+						continue
+					self.files_statted += 1
+					state.files[name] = (stat.st_size, stat.st_mtime)
+		else:
+			self.dirs_listed += 1
+			state = DirState(mtime_ns, time.time_ns())
+			try:
+				with os.scandir(path) as entries:
+					for entry in entries:
+						try:
+							if entry.is_dir(follow_symlinks=self.follow_links):
+								state.subdirs.append(entry.name)
+							elif entry.is_file():
+								stat = entry.stat()
+								self.files_statted += 1
+								state.files[entry.name] = (stat.st_size, stat.st_mtime)
+						except OSError:
+							pass
+			except OSError:
+				return
+		new_dirs[rel_dir] = state
+		for name in state.subdirs:
+			sub_dir = os.path.join(rel_dir, name)
+			# skip directories the .diodeinclude can't match anything in
+			if matcher is None or matcher.could_match_under(sub_dir):
+				self.scan_dir(sub_dir, path / name, old_dirs, new_dirs, matcher)
+
+	def get_include_stamp(self):
+		try:
+			stat = os.stat(self.root / '.diodeinclude')
+			return (stat.st_mtime_ns, stat.st_size)
+		except OSError:
+			return None
+
+	def forget(self, paths: Iterable[Path]):
+		"""Keeps files out of the next commit, so they're reported again by later scans (e.g. files we couldn't read)
+
+		Args:
+			paths (Iterable[Path]): The files' paths, relative to the folder
+		"""
+		self.forgotten.update(paths)
+
+	def commit(self):
+		"""Saves the latest scan, so its changes won't be reported again (except for files passed to `forget`)"""
+		if self.pending is None:
+			return
+		self.dirs, self.include_stamp = self.pending
+		self.pending = None
+		for path in self.forgotten:
+			state = self.dirs.get(os.path.dirname(path))
+			if state is None or path.name not in state.files:
+				continue
+			# a (size, mtime) no file can have, and re-list the directory so the file gets statted even without verify_files
+			state.files[path.name] = (-1, -1.0)
+			state.mtime_ns = -1
+		self.forgotten.clear()
+		# rewrite the file in place: creating and renaming a temporary file would change the root's mtime,
+		# and we'd have to re-list it on every scan
+		with open(self.path, 'r+b' if self.path.exists() else 'wb') as f:
+			pickle.dump((self.dirs, self.include_stamp), f)
+			f.truncate()
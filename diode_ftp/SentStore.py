@@ -0,0 +1,89 @@
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Iterator, List
+from diode_ftp.metadata import FileMetadata
+import os
+import shelve
+import sqlite3
+
+# below this many files, looking each one up is cheaper than walking the whole table
+LOOKUP_THRESHOLD = 4096
+
+def path_key(path: Path):
+	# paths are stored as bytes, so undecodable file names survive, and so we sort exactly like SQLite does
+	return os.fsencode(str(path))
+
+class SentStore():
+	"""Remembers the metadata of every file we have sent, in an SQLite database keyed by relative path.
+
+	Finding changed files is a merge of the (sorted) scan against the table, which SQLite walks in key order,
+	so the store never has to be loaded into memory. Marking files as sent only writes their rows.
+	"""
+	def __init__(self, path: PathLike) -> None:
+		"""Opens (or creates) a sent-file store
+
+		Args:
+			path (PathLike): The database file
+		"""
+		# the sender may sync from a different thread than it was created on, but never from two at once
+		self.db = sqlite3.connect(str(path), check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS sent (path BLOB PRIMARY KEY, size INTEGER, mtime REAL) WITHOUT ROWID')
+		self.db.commit()
+
+	def is_empty(self):
+		return self.db.execute('SELECT 1 FROM sent LIMIT 1').fetchone() is None
+
+	def changed(self, files: Iterable[FileMetadata]) -> List[FileMetadata]:
+		"""Finds the files that are new, or have changed (size or mtime) since we sent them
+
+		Args:
+			files (Iterable[FileMetadata]): The files to check, with paths relative to the folder
+
+		Returns:
+			List[FileMetadata]: The files that need to be sent
+		"""
+		files = sorted(files, key=lambda f: path_key(f.path))
+		if len(files) <= LOOKUP_THRESHOLD:
+			return [f for f in files if self.get(f.path) != (f.size, f.mtime)]
+		return list(self.merge(files))
+
+	def get(self, path: Path):
+		row = self.db.execute('SELECT size, mtime FROM sent WHERE path = ?', (path_key(path),)).fetchone()
+		return None if row is None else tuple(row)
+
+	def merge(self, files: List[FileMetadata]) -> Iterator[FileMetadata]:
+		"""Merges files (sorted by path key) against the table"""
+		rows = self.db.execute('SELECT path, size, mtime FROM sent ORDER BY path')
+		row = rows.fetchone()
+		for file in files:
+			key = path_key(file.path)
+			while row is not None and row[0] < key:
+				row = rows.fetchone()
+			if row is None or row[0] != key or (row[1], row[2]) != (file.size, file.mtime):
+				yield file
+
+	def mark_sent(self, files: Iterable[FileMetadata]):
+		"""Records that files were sent"""
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO sent (path, size, mtime) VALUES (?, ?, ?)',
+				((path_key(f.path), f.size, f.mtime) for f in files))
+
+	def import_shelf(self, shelf_path: PathLike):
+		"""Imports the 'sent' set from the shelf older versions kept in .sender_sync_data"""
+		try:
+			with shelve.open(str(shelf_path), 'r') as db:
+				sent = db.get('sent', set())
+		except Exception:
+			return 0
+		# the old set could have many entries for the same path, so keep the newest
+		newest = {}
+		for file in sent:
+			if file.path not in newest or file.mtime >= newest[file.path].mtime:
+				newest[file.path] = file
+		self.mark_sent(newest.values())
+		return len(newest)
+
+	def close(self):
+		self.db.close()
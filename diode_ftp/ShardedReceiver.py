@@ -0,0 +1,224 @@
+from os import PathLike
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+from diode_ftp.header import HEADER_SIZE
+from diode_ftp.FolderReceiver import FolderReceiver, FolderReceiverWorker
+from diode_ftp.ReceiveEngine import FrameBatch, ReceiveEngine
+from logging import getLogger
+from multiprocessing import get_context
+import asyncio
+import os
+import socket
+import struct
+
+DEFAULT_RING_SLOTS = 4096
+DEFAULT_MAX_FRAME_SIZE = 9216
+# the producer's and consumer's counters are on separate cache lines, so they don't fight over them
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+RING_HEADER_SIZE = 128
+COUNTER_STRUCT = struct.Struct('=Q')
+LENGTH_STRUCT = struct.Struct('=I')
+
+class FrameRing():
+	"""A single-producer, single-consumer ring of frames in shared memory.
+
+	The producer copies each frame into the next free slot and then bumps the head counter.
+	The consumer handles frames straight out of their slots, and bumps the tail counter once it's done with each.
+	After a batch of frames, the producer rings the doorbell (a semaphore), which wakes up the consumer
+	and also acts as a memory barrier between the two processes.
+	"""
+	def __init__(self, ctx, slots=DEFAULT_RING_SLOTS, max_frame_size=DEFAULT_MAX_FRAME_SIZE) -> None:
+		"""Allocates a ring
+
+		Args:
+			ctx (multiprocessing.context.BaseContext): The multiprocessing context the consumer will be started with
+			slots (int, optional): The number of frames the ring can hold. Defaults to 4096.
+			max_frame_size (int, optional): The largest frame the ring can hold. Defaults to 9216.
+		"""
+		self.slots = slots
+		self.max_frame_size = max_frame_size
+		self.slot_size = LENGTH_STRUCT.size + max_frame_size
+		self.array = ctx.RawArray('B', RING_HEADER_SIZE + slots * self.slot_size)
+		self.doorbell = ctx.Semaphore(0)
+		# each side keeps its own counter, and only reads the other side's from shared memory
+		self.head = 0
+		self.tail = 0
+		self.attach()
+	def attach(self):
+		self.view = memoryview(self.array).cast('B')
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['view']
+		return state
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.attach()
+	def push(self, frame: Union[bytes, memoryview]):
+		"""Copies a frame into the ring (producer only)
+
+		Returns:
+			bool: False if the ring was full (or the frame too big), and the frame was dropped
+		"""
+		length = len(frame)
+		if length > self.max_frame_size:
+			return False
+		if self.head - COUNTER_STRUCT.unpack_from(self.view, TAIL_OFFSET)[0] >= self.slots:
+			return False
+		offset = RING_HEADER_SIZE + (self.head % self.slots) * self.slot_size
+		LENGTH_STRUCT.pack_into(self.view, offset, length)
+		offset += LENGTH_STRUCT.size
+		self.view[offset:offset + length] = frame
+		self.head += 1
+		COUNTER_STRUCT.pack_into(self.view, HEAD_OFFSET, self.head)
+		return True
+	def ring(self):
+		"""Wakes up the consumer (producer only)"""
+		self.doorbell.release()
+	def wait(self, timeout: Optional[float] = None):
+		"""Waits for the doorbell (consumer only)
+
+		Returns:
+			bool: False if we timed out
+		"""
+		return self.doorbell.acquire(timeout=timeout)
+	def frames(self) -> Iterator[memoryview]:
+		"""Yields every frame in the ring (consumer only). Each frame's slot is freed when the next one is read,
+		so handle it before asking for the next"""
+		head = COUNTER_STRUCT.unpack_from(self.view, HEAD_OFFSET)[0]
+		while self.tail < head:
+			offset = RING_HEADER_SIZE + (self.tail % self.slots) * self.slot_size
+			length = LENGTH_STRUCT.unpack_from(self.view, offset)[0]
+			offset += LENGTH_STRUCT.size
+			yield self.view[offset:offset + length]
+			self.tail += 1
+			COUNTER_STRUCT.pack_into(self.view, TAIL_OFFSET, self.tail)
+
+def run_shard(folder: str, shard: int, ring: FrameRing, stopping, extract_lock, delete_tars: bool):
+	"""The main loop of a shard's process. Each shard keeps its own receiver state (.receiver_shard<n>_state and journal)"""
+	receiver = FolderReceiver(folder, delete_tars, state_name=f'receiver_shard{shard}', start_worker=False,
+		extract_lock=extract_lock)
+	worker = FolderReceiverWorker(receiver)
+	state = receiver.state
+	while not stopping.is_set():
+		if not ring.wait(state.flush_interval):
+			# nothing is coming in, so it's a good time to persist our state
+			state.flush()
+			continue
+		for frame in ring.frames():
+			worker.handle_frame(frame)
+		state.idle()
+	worker.files.close_all()
+	receiver.completions.shutdown()
+	receiver.close_block_store()
+	state.close()
+
+class ShardedReceiver(asyncio.DatagramProtocol):
+	"""Receives into a folder with a pool of worker processes, so receiving can use more than one core.
+
+	Frames are sharded by their transfer hash, so every transfer is handled by the same process,
+	which owns its state (and its journal). The receiving thread only copies each frame into its shard's ring
+	in shared memory. Tars are extracted one at a time (across every shard), since they write to the same folder.
+	Each shard extracts its own tars in the order they completed, but there is no order between shards:
+	if two tars that write the same file complete close together on different shards, either can be extracted last.
+
+	Like FolderReceiver, this can be used as an asyncio protocol, or fed by a ReceiveEngine with `start_engine`.
+	Keep the number of shards the same for a folder: with a different number, transfers land on different shards,
+	which don't know what the old ones had received.
+	"""
+	def __init__(self, folder: PathLike, shards: Optional[int] = None, delete_tars: bool = True,
+			ring_slots=DEFAULT_RING_SLOTS, max_frame_size=DEFAULT_MAX_FRAME_SIZE) -> None:
+		"""Starts the shard processes
+
+		Args:
+			folder (PathLike): The folder you want to sync to
+			shards (Optional[int], optional): The number of worker processes. Defaults to None (one per CPU).
+			delete_tars (bool, optional): Deletes tars after they have completed. Defaults to True.
+			ring_slots (int, optional): The number of frames each shard's ring can hold. Defaults to 4096.
+			max_frame_size (int, optional): The largest frame we can receive. Defaults to 9216.
+
+		Raises:
+			ValueError: The folder to sync to doesn't exist
+		"""
+		super().__init__()
+		self.root = Path(folder).resolve()
+		if not self.root.exists():
+			raise ValueError("The sync folder doesn't exist!")
+		self.log = getLogger(str(folder))
+		# the shards must not inherit our threads (or sockets), so they are spawned rather than forked
+		ctx = get_context('spawn')
+		num_shards = shards if shards is not None else (os.cpu_count() or 1)
+		self.rings = [FrameRing(ctx, ring_slots, max_frame_size) for _ in range(num_shards)]
+		self.stopping = ctx.Event()
+		self.extract_lock = ctx.Lock()
+		self.processes = [ctx.Process(target=run_shard, daemon=True, name=f'diode-shard-{i}',
+			args=(str(self.root), i, ring, self.stopping, self.extract_lock, delete_tars))
+			for i, ring in enumerate(self.rings)]
+		for process in self.processes:
+			process.start()
+		self.engine: Optional[ReceiveEngine] = None
+		# frames we dropped because a shard's ring was full
+		self.ring_drops = [0] * num_shards
+		self.runt_frames = 0
+		# a ReceiveEngine hands its batches to `receiver.queue.put`
+		self.queue = self
+	def connection_made(self, transport) -> None:
+		self.transport = transport
+	def start_engine(self, local_addr: Tuple[str, int], **engine_kwargs):
+		"""Receives on a dedicated thread with a ReceiveEngine, instead of through asyncio (see FolderReceiver.start_engine)
+
+		Returns:
+			ReceiveEngine: The started engine
+		"""
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(local_addr)
+		self.engine = ReceiveEngine(self, sock, **engine_kwargs)
+		self.engine.start()
+		return self.engine
+	def shard_of(self, frame: Union[bytes, memoryview]):
+		# transfer hashes (and stream IDs) are already uniformly distributed
+		return int.from_bytes(frame[:4], 'big') % len(self.rings)
+	def dispatch(self, frame: Union[bytes, memoryview]):
+		shard = self.shard_of(frame)
+		if not self.rings[shard].push(frame):
+			self.ring_drops[shard] += 1
+			return None
+		return shard
+	def put(self, batch: FrameBatch):
+		"""Shards a batch of frames from a ReceiveEngine"""
+		woken: List[bool] = [False] * len(self.rings)
+		for frame in batch:
+			shard = self.dispatch(frame)
+			if shard is not None:
+				woken[shard] = True
+		batch.release()
+		for shard, ring in enumerate(self.rings):
+			if woken[shard]:
+				ring.ring()
+	def datagram_received(self, frame: bytes, addr: Tuple[str, int]) -> None:
+		if len(frame) < HEADER_SIZE:
+			self.runt_frames += 1
+			self.log.warning(f'Received a too-small frame from {addr}')
+			return
+		shard = self.dispatch(frame)
+		if shard is not None:
+			self.rings[shard].ring()
+	def stats(self):
+		"""Gets the receiver's counters, including the engine's if there is one
+
+		Returns:
+			Dict[str, Any]: The counters. ring_drops counts frames we dropped because a shard's ring was full, per shard
+		"""
+		stats = dict(self.engine.stats()) if self.engine is not None else {}
+		stats['ring_drops'] = list(self.ring_drops)
+		stats['shards_alive'] = sum(1 for p in self.processes if p.is_alive())
+		return stats
+	def stop(self, timeout: float = 5.0):
+		"""Stops receiving, and waits for the shards to save their state"""
+		if self.engine is not None:
+			self.engine.stop()
+		self.stopping.set()
+		for ring in self.rings:
+			ring.ring()
+		for process in self.processes:
+			process.join(timeout)
@@ -0,0 +1,148 @@
+from collections import deque
+from diode_ftp.header import HEADER_SIZE, MANIFEST_INDEX, STREAM_TOTAL, HashingWriter, Header, create_header
+from queue import Queue
+from threading import Thread
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional
+import os
+
+class ChunkPipe():
+	"""A write-only file that cuts everything written to it into chunks, and hands them to a StreamingChunker"""
+	def __init__(self, owner: 'StreamingChunker') -> None:
+		self.owner = owner
+		self.buffer = bytearray()
+		self.offset = 0
+		self.index = 0
+	def write(self, data):
+		self.buffer += data
+		size = self.owner.chunk_data_size
+		while len(self.buffer) >= size:
+			self.emit(bytes(self.buffer[:size]))
+			del self.buffer[:size]
+		return len(data)
+	def tell(self):
+		return self.offset + len(self.buffer)
+	def flush(self):
+		pass
+	def close(self):
+		if len(self.buffer) > 0:
+			self.emit(bytes(self.buffer))
+			self.buffer = bytearray()
+	def emit(self, data: bytes):
+		header = Header(self.owner.transfer_id, self.offset, self.index, STREAM_TOTAL)
+		self.owner.frames.put(create_header(header) + data)
+		self.offset += len(data)
+		self.index += 1
+
+class StreamingChunker(Iterable):
+	"""Chunks a stream of data as it is produced, so we can start sending before it is finished.
+
+	Since we can't know the stream's hash (or its length) up front, its chunks are identified by a random
+	transfer ID instead, and the stream ends with a manifest chunk carrying its SHA-1 and chunk count.
+	The producer runs on a background thread, and is throttled to how fast the chunks are consumed.
+
+	Because the stream can only be produced once, repeats are sent from memory:
+	each chunk is repeated after `repeat_delay` newer chunks have gone out.
+	"""
+	def __init__(self, produce: Callable[[Any], Any], chunk_size: int=1400, repeats: int=1,
+			repeat_delay: int=1024, manifest_repeats: int=3, queue_depth: int=256) -> None:
+		"""Creates a streaming chunker
+
+		Args:
+			produce (Callable[[file], Any]): Writes the stream into the file-like object it is given (e.g. creating a tar).
+				Whatever it returns ends up in `result` once the stream is done
+			chunk_size (int, optional): The maximum size of each chunk (including the header). Defaults to 1400.
+			repeats (int, optional): Number of times to send each chunk. Defaults to 1.
+			repeat_delay (int, optional): Number of chunks to wait before repeating a chunk. Defaults to 1024.
+			manifest_repeats (int, optional): Number of times to send the manifest. Defaults to 3.
+			queue_depth (int, optional): Number of chunks the producer can get ahead of us by. Defaults to 256.
+		"""
+		assert chunk_size > HEADER_SIZE + 20, 'The manifest needs to fit in a chunk'
+		self.produce = produce
+		self.chunk_data_size = chunk_size - HEADER_SIZE
+		self.repeats = repeats
+		self.repeat_delay = repeat_delay
+		self.manifest_repeats = manifest_repeats
+		self.transfer_id = os.urandom(20)
+		self.frames: 'Queue[Optional[bytes]]' = Queue(queue_depth)
+		self.error: Optional[BaseException] = None
+		# filled in once the stream is done
+		self.result: Any = None
+		self.hash: Optional[bytes] = None
+		self.size = 0
+		self.total_chunks = 0
+	def chunk_iterator(self, zero_copy=False):
+		"""Gets the chunk iterator for the stream. Can only be used once
+
+		Args:
+			zero_copy (bool, optional): Ignored, streamed chunks are never reused. Defaults to False.
+
+		Returns:
+			Iterator[bytes]: An iterator object which will go through chunk by chunk
+		"""
+		return StreamingChunkIterator(self)
+	def __iter__(self):
+		return self.chunk_iterator()
+	def run_producer(self):
+		pipe = ChunkPipe(self)
+		try:
+			writer = HashingWriter(pipe)
+			self.result = self.produce(writer)
+			pipe.close()
+			self.hash = writer.digest()
+			self.size = writer.size
+			self.total_chunks = pipe.index
+		except BaseException as e:
+			self.error = e
+		finally:
+			self.frames.put(None)
+	def manifest(self):
+		return create_header(Header(self.transfer_id, self.size, MANIFEST_INDEX, self.total_chunks)) + self.hash
+
+class StreamingChunkIterator(Iterator[bytes]):
+	def __init__(self, owner: StreamingChunker) -> None:
+		self.owner = owner
+		self.output: Deque[bytes] = deque()
+		# chunks waiting to be repeated, and how many more times to send them
+		self.waiting: Deque[List] = deque()
+		self.done = False
+	def __enter__(self):
+		self.producer = Thread(target=self.owner.run_producer, daemon=True)
+		self.producer.start()
+		return self
+	def __exit__(self, exception_type, exception_value, exception_traceback):
+		# drain the queue so the producer can finish
+		while not self.done and self.producer.is_alive():
+			if self.owner.frames.get() is None:
+				self.done = True
+		self.producer.join()
+	def __next__(self):
+		while len(self.output) == 0:
+			if self.done:
+				raise StopIteration()
+			self.fill()
+		return self.output.popleft()
+	def fill(self):
+		frame = self.owner.frames.get()
+		if frame is None:
+			self.done = True
+			if self.owner.error is not None:
+				raise self.owner.error
+			# send one manifest before the tail of repeats, and the rest after them
+			manifest = self.owner.manifest()
+			if self.owner.manifest_repeats > 0:
+				self.output.append(manifest)
+			while len(self.waiting) > 0:
+				self.repeat_oldest()
+			self.output.extend([manifest] * (self.owner.manifest_repeats - 1))
+			return
+		self.output.append(frame)
+		if self.owner.repeats > 1:
+			self.waiting.append([frame, self.owner.repeats - 1])
+			if len(self.waiting) > self.owner.repeat_delay:
+				self.repeat_oldest()
+	def repeat_oldest(self):
+		entry = self.waiting.popleft()
+		self.output.append(entry[0])
+		entry[1] -= 1
+		if entry[1] > 0:
+			self.waiting.append(entry)
@@ -0,0 +1,253 @@
+from collections import deque
+from os import PathLike
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from diode_ftp.BatchSender import BatchSender
+from diode_ftp.metadata import FileMetadata
+from diode_ftp.pacer import TokenBucket
+from diode_ftp.RepeatedChunker import NOT_READY
+from gitignore_parser.gitignore_parser import rule_from_pattern, rule_to_path_regex
+from logging import getLogger
+import re
+import time
+
+# files that no rule in the .diodepriority matches
+DEFAULT_PRIORITY = 1
+# files are batched into transfers of about this size, so a big backlog doesn't become one giant tar
+DEFAULT_MAX_TRANSFER_SIZE = 64 * 1024 * 1024
+# how long `run` sends for before handing back to the sender, so it can look for new files
+DEFAULT_TIME_SLICE = 5.0
+# bytes a priority class can send per round, for every point of priority
+DEFAULT_QUANTUM = 1400
+# how long to sleep when no transfer has a chunk due
+IDLE_WAIT = 0.01
+
+class PriorityRules():
+	"""Maps files to priorities, from a .diodepriority file.
+
+	Every line is a priority and a .diodeinclude-style pattern, e.g.
+	```
+	100 status/*.json
+	10 *.log
+	```
+	The last matching line wins, and files that no line matches get DEFAULT_PRIORITY.
+	A class's priority is its weight in the fair share, so here status files get 10 times the bandwidth of logs,
+	and 100 times the bandwidth of everything else (while they all have something to send).
+	"""
+	def __init__(self, lines: Iterable[str] = (), source: str = '.diodepriority') -> None:
+		self.rules: List[Tuple[int, Any]] = []
+		log = getLogger('priority_rules')
+		for line_no, line in enumerate(lines, 1):
+			line = line.strip()
+			if line == '' or line.startswith('#'):
+				continue
+			parts = line.split(None, 1)
+			rule = rule_from_pattern(parts[1]) if len(parts) == 2 else None
+			if rule is None or rule.negation or not parts[0].isdigit() or int(parts[0]) < 1:
+				log.warning(f'Ignoring line {line_no} of {source}, expected "<priority> <pattern>": {line}')
+				continue
+			self.rules.append((int(parts[0]), re.compile(f'(?s){rule_to_path_regex(rule)}')))
+	def priority(self, rel_path: Union[str, Path]):
+		"""Gets the priority of a path relative to the folder"""
+		rel_path = str(rel_path)
+		for priority, regex in reversed(self.rules):
+			if regex.fullmatch(rel_path):
+				return priority
+		return DEFAULT_PRIORITY
+
+def get_priority_rules(root: PathLike):
+	"""Reads the folder's .diodepriority, if it has one"""
+	path = Path(root) / '.diodepriority'
+	try:
+		with open(path) as f:
+			return PriorityRules(f.read().splitlines(), str(path))
+	except FileNotFoundError:
+		return PriorityRules()
+
+class Transfer():
+	"""A tar (or stream) to send, and what to do once all of its chunks are out"""
+	def __init__(self, start: Callable[[], Any], repeats: int, files: List[FileMetadata], priority: int,
+			on_done: Callable[['Transfer'], None]) -> None:
+		"""Creates a transfer
+
+		Args:
+			start (Callable[[], Union[FileChunker, StreamingChunker]]): Creates the chunks to send (e.g. tars the files).
+				Only called once the transfer is first up to send, so queued transfers don't take up any disk
+			repeats (int): Number of times to send every chunk
+			files (List[FileMetadata]): The files in the transfer
+			priority (int): The transfer's priority class
+			on_done (Callable[[Transfer], None]): Called once every chunk has been sent
+		"""
+		self.start = start
+		self.chunker: Any = None
+		self.repeats = repeats
+		self.files = files
+		self.priority = priority
+		self.on_done = on_done
+		self.bytes_sent = 0
+		self.frames = self.iterate()
+	def iterate(self) -> Iterator[Any]:
+		self.chunker = self.start()
+		for _ in range(self.repeats):
+			# the chunks are sent (or copied into a batch) before we ask for the next one, so they can share a buffer
+			with self.chunker.chunk_iterator(zero_copy=True) as chunks:
+				yield from chunks
+	def next_chunk(self):
+		return next(self.frames, None)
+
+class TransferScheduler():
+	"""Sends several transfers at once, sharing the bandwidth between priority classes by weighted fair share.
+
+	Changed files are grouped by their priority (see PriorityRules), and batched (smallest first) into transfers
+	of up to `max_transfer_size` bytes. Within a class transfers go one after another, but the classes are interleaved
+	chunk by chunk with deficit round robin: every round, each class with something to send gets
+	`priority * quantum` bytes of credit, and sends chunks until it runs out.
+	So a small, urgent file that shows up in the middle of a multi-GB backlog starts going out straight away,
+	with most of the bandwidth, instead of waiting for the backlog to finish.
+
+	`run` only sends for `time_slice` seconds at a time, so the sender can keep looking for new files
+	while big transfers are still going. The slice can end in the middle of a class's turn, and the next `run`
+	picks the round up where it left off, so the classes after it in the round still get their turn.
+	"""
+	def __init__(self, folder: PathLike, max_transfer_size=DEFAULT_MAX_TRANSFER_SIZE,
+			time_slice: Optional[float]=DEFAULT_TIME_SLICE, quantum=DEFAULT_QUANTUM) -> None:
+		"""Creates a scheduler
+
+		Args:
+			folder (PathLike): The folder being synced (where the .diodepriority is)
+			max_transfer_size (int, optional): Batch files into transfers of about this many bytes. Defaults to 64 MiB.
+			time_slice (Optional[float], optional): Seconds to send for in each call to `run`.
+				Defaults to 5. None sends until every transfer is done.
+			quantum (int, optional): Bytes each class can send per round, per point of priority. Defaults to 1400.
+		"""
+		self.root = Path(folder)
+		self.max_transfer_size = max_transfer_size
+		self.time_slice = time_slice
+		self.quantum = quantum
+		# priority -> transfers in that class, in the order they'll be sent
+		self.classes: Dict[int, Deque[Transfer]] = {}
+		self.deficits: Dict[int, int] = {}
+		# the classes still to take their turn in the current round, highest priority first
+		self.round: List[int] = []
+		# whether the first class in the round has already been given its credit (its turn was cut short)
+		self.in_turn = False
+		self.round_bytes = 0
+		# path -> the version of the file that is being sent
+		self.in_flight: Dict[Path, FileMetadata] = {}
+
+	def is_idle(self):
+		return len(self.classes) == 0
+
+	def is_in_flight(self, file: FileMetadata):
+		return self.in_flight.get(file.path) == file
+
+	def plan(self, files: List[FileMetadata]) -> List[Tuple[int, List[FileMetadata]]]:
+		"""Splits files into batches of the same priority, highest priority first
+
+		Returns:
+			List[Tuple[int, List[FileMetadata]]]: The priority and files of each batch
+		"""
+		rules = get_priority_rules(self.root)
+		by_priority: Dict[int, List[FileMetadata]] = {}
+		for file in files:
+			by_priority.setdefault(rules.priority(file.path), []).append(file)
+		batches = []
+		for priority in sorted(by_priority, reverse=True):
+			batch: List[FileMetadata] = []
+			batch_size = 0
+			# small files first, so they aren't stuck in a batch behind a big one
+			for file in sorted(by_priority[priority], key=lambda f: f.size):
+				if len(batch) > 0 and batch_size + file.size > self.max_transfer_size:
+					batches.append((priority, batch))
+					batch, batch_size = [], 0
+				batch.append(file)
+				batch_size += file.size
+			batches.append((priority, batch))
+		return batches
+
+	def add(self, transfer: Transfer):
+		"""Queues a transfer behind the others in its priority class"""
+		if transfer.priority not in self.classes:
+			self.classes[transfer.priority] = deque()
+			self.deficits[transfer.priority] = 0
+			self.join_round(transfer.priority)
+		self.classes[transfer.priority].append(transfer)
+		for file in transfer.files:
+			self.in_flight[file.path] = file
+
+	def run(self, sender: BatchSender, pacer: TokenBucket, idle: Optional[Callable[[float], None]] = None):
+		"""Sends chunks from the queued transfers until they are all done, or the time slice is up
+
+		Args:
+			sender (BatchSender): Sends the chunks
+			pacer (TokenBucket): Paces the chunks
+			idle (Optional[Callable[[float], None]], optional): Called with a number of seconds to wait,
+				when no transfer has a chunk due. Defaults to None, which sleeps.
+
+		Returns:
+			int: The number of bytes sent
+		"""
+		deadline = None if self.time_slice is None else time.monotonic() + self.time_slice
+		total_bytes = 0
+		while len(self.classes) > 0:
+			if len(self.round) == 0:
+				self.round = sorted(self.classes, reverse=True)
+				self.in_turn = False
+				self.round_bytes = 0
+			priority = self.round[0]
+			queue = self.classes[priority]
+			if not self.in_turn:
+				self.deficits[priority] += priority * self.quantum
+				self.in_turn = True
+			while len(queue) > 0 and self.deficits[priority] > 0:
+				transfer = queue[0]
+				chunk = transfer.next_chunk()
+				if chunk is None:
+					queue.popleft()
+					# make sure its last chunks are on the wire before we call it done
+					pacer.consume(sender.flush())
+					self.finish(transfer)
+					continue
+				if chunk is NOT_READY:
+					# its repeats aren't due yet. Like an idle class, it doesn't get to save up credit
+					self.deficits[priority] = 0
+					break
+				self.round_bytes += len(chunk)
+				self.deficits[priority] -= len(chunk)
+				transfer.bytes_sent += len(chunk)
+				total_bytes += len(chunk)
+				pacer.consume(sender.send(chunk))
+				# a big class's turn can outlast the whole slice, so it can be cut short
+				if deadline is not None and time.monotonic() >= deadline:
+					pacer.consume(sender.flush())
+					return total_bytes
+			self.round.pop(0)
+			self.in_turn = False
+			if len(queue) == 0:
+				# an idle class doesn't get to save up credit
+				del self.classes[priority]
+				del self.deficits[priority]
+			if deadline is not None and time.monotonic() >= deadline:
+				break
+			if len(self.round) == 0 and self.round_bytes == 0 and len(self.classes) > 0:
+				# everything is waiting on repeats to be due
+				pacer.consume(sender.flush())
+				(idle or time.sleep)(IDLE_WAIT)
+		pacer.consume(sender.flush())
+		return total_bytes
+
+	def join_round(self, priority: int):
+		"""Gives a new class its turn in the current round, in priority order (but after a turn that was cut short)"""
+		if len(self.round) == 0:
+			return
+		start = 1 if self.in_turn else 0
+		position = start
+		while position < len(self.round) and self.round[position] > priority:
+			position += 1
+		self.round.insert(position, priority)
+
+	def finish(self, transfer: Transfer):
+		for file in transfer.files:
+			if self.in_flight.get(file.path) == file:
+				del self.in_flight[file.path]
+		transfer.on_done(transfer)
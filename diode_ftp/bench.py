@@ -0,0 +1,237 @@
+from diode_ftp import __version__
+from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.FolderSender import FolderSender
+from diode_ftp.header import hash_file
+from diode_ftp.LossyLink import Impairments, LossyLink
+from logging import getLogger
+from multiprocessing import get_context
+from pathlib import Path
+from statistics import mean, median
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import os
+import socket
+import tempfile
+import time
+
+# name -> (number of files, size of each file)
+PROFILES = {
+	'one-big': (1, 4 * 1024 * 1024),
+	'few-medium': (16, 256 * 1024),
+	'many-small': (256, 4 * 1024),
+}
+DEFAULT_SEND_RATE = 10 * 1000 * 1000
+# how often to check the received files
+POLL_INTERVAL = 0.05
+MB = 1000 * 1000
+
+TrialConfig = NamedTuple('TrialConfig', [
+	('chunk_size', int),
+	('repeats', int),
+	# a name from PROFILES, or "<files>x<bytes>"
+	('profile', str)])
+
+def parse_profile(profile: str) -> Tuple[int, int]:
+	"""Gets the number of files and their size for a profile
+
+	Raises:
+		ValueError: It isn't in PROFILES, or "<files>x<bytes>"
+	"""
+	if profile in PROFILES:
+		return PROFILES[profile]
+	try:
+		count, size = profile.split('x')
+		return int(count), int(size)
+	except ValueError:
+		raise ValueError(f'Unknown profile {profile}: use one of {sorted(PROFILES)}, or "<files>x<bytes>"')
+
+def create_files(folder: Path, profile: str):
+	"""Fills a folder with random (incompressible) files
+
+	Returns:
+		Dict[str, bytes]: The hash of each file, by relative path
+	"""
+	count, size = parse_profile(profile)
+	hashes = {}
+	for i in range(count):
+		rel_path = f'dir{i % 8}/file{i}.bin'
+		path = folder / rel_path
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(os.urandom(size))
+		hashes[rel_path] = hash_file(path)
+	return hashes
+
+def get_free_port():
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def run_receiver(folder: str, port: int, ready, stopping, results):
+	receiver = FolderReceiver(folder)
+	engine = receiver.start_engine(('127.0.0.1', port))
+	cpu_start = time.process_time()
+	ready.set()
+	stopping.wait()
+	engine.stop()
+	results.put({'cpu_seconds': time.process_time() - cpu_start, 'engine': engine.stats()})
+
+def run_sender(folder: str, address: Tuple[str, int], sender_kwargs: Dict[str, Any], results):
+	sender = FolderSender(folder, send_to=address, **sender_kwargs)
+	cpu_start = time.process_time()
+	started = time.monotonic()
+	sender.perform_sync()
+	results.put({'cpu_seconds': time.process_time() - cpu_start, 'started': started, 'finished': time.monotonic()})
+
+class Verifier():
+	"""Checks which of the expected files have arrived intact"""
+	def __init__(self, folder: Path, hashes: Dict[str, bytes]) -> None:
+		self.folder = folder
+		self.missing = dict(hashes)
+	def check(self):
+		"""Returns: bool: True once every file has arrived"""
+		for rel_path, expected in list(self.missing.items()):
+			path = self.folder / rel_path
+			try:
+				if hash_file(path) == expected:
+					del self.missing[rel_path]
+			except OSError:
+				pass
+		return len(self.missing) == 0
+
+def run_trial(config: TrialConfig, impairments: Impairments, send_rate=DEFAULT_SEND_RATE,
+		timeout: Optional[float]=None, seed: Optional[int]=None) -> Dict[str, Any]:
+	"""Syncs a freshly generated folder through a lossy link.
+	The sender and receiver run in their own processes (so we can measure their CPU time), with the link
+	simulator in this one, and we check the received files' hashes as they arrive.
+
+	Args:
+		config (TrialConfig): The chunk size, repeats and file profile to use
+		impairments (Impairments): What the link does to datagrams
+		send_rate (float, optional): The sender's rate in bytes per second. Defaults to 10 MB/s.
+		timeout (Optional[float], optional): Give up after this many seconds. Defaults to None,
+			five times as long as sending everything should take (and at least 10 seconds).
+		seed (Optional[int], optional): Seeds the link's impairments. Defaults to None.
+
+	Returns:
+		Dict[str, Any]: The trial's results
+	"""
+	log = getLogger('bench')
+	count, size = parse_profile(config.profile)
+	payload_bytes = count * size
+	if timeout is None:
+		timeout = max(10.0, 5 * payload_bytes * config.repeats / send_rate)
+	ctx = get_context('spawn')
+	with tempfile.TemporaryDirectory(prefix='diode_bench_') as tmp:
+		send, rcv = Path(tmp, 'send'), Path(tmp, 'rcv')
+		send.mkdir()
+		rcv.mkdir()
+		verifier = Verifier(rcv, create_files(send, config.profile))
+		port = get_free_port()
+		ready, stopping = ctx.Event(), ctx.Event()
+		receiver_results, sender_results = ctx.Queue(), ctx.Queue()
+		receiver = ctx.Process(target=run_receiver, args=(str(rcv), port, ready, stopping, receiver_results), daemon=True)
+		receiver.start()
+		ready.wait(30)
+		link = LossyLink(('127.0.0.1', port), impairments, seed=seed)
+		link.start()
+		sender_kwargs = {'chunk_size': config.chunk_size, 'transmit_repeats': config.repeats, 'max_bytes_per_second': send_rate}
+		sender = ctx.Process(target=run_sender, args=(str(send), link.address, sender_kwargs, sender_results), daemon=True)
+		sender.start()
+
+		started = time.monotonic()
+		completed_at = None
+		while time.monotonic() - started < timeout:
+			if verifier.check():
+				completed_at = time.monotonic()
+				break
+			time.sleep(POLL_INTERVAL)
+		# let the sender finish its repeats, so its CPU time covers the whole sync
+		sender.join(max(timeout - (time.monotonic() - started), 1))
+		sender_stats = sender_results.get(timeout=1) if sender.exitcode == 0 else None
+		if sender.is_alive():
+			sender.terminate()
+		link.stop()
+		stopping.set()
+		receiver_stats = receiver_results.get(timeout=10)
+		receiver.join(10)
+	completed = completed_at is not None
+	# the sender's clock starts just before it tars the files
+	if completed and sender_stats is not None:
+		time_to_complete = completed_at - sender_stats['started']
+	elif completed:
+		time_to_complete = completed_at - started
+	else:
+		time_to_complete = None
+	result = {
+		'chunk_size': config.chunk_size,
+		'repeats': config.repeats,
+		'profile': config.profile,
+		'files': count,
+		'payload_bytes': payload_bytes,
+		'seed': seed,
+		'completed': completed,
+		'files_missing': len(verifier.missing),
+		'time_to_complete': time_to_complete,
+		'goodput': payload_bytes / time_to_complete if time_to_complete else None,
+		'sender_cpu_per_mb': sender_stats['cpu_seconds'] / (payload_bytes / MB) if sender_stats is not None else None,
+		'receiver_cpu_per_mb': receiver_stats['cpu_seconds'] / (payload_bytes / MB),
+		'link': link.stats(),
+		'receive_engine': receiver_stats['engine'],
+	}
+	log.info(f'{config}: completed={completed} time={time_to_complete} link={link.stats()}')
+	return result
+
+def summarize(results: List[Dict[str, Any]]):
+	"""Aggregates the trials of each config
+
+	Returns:
+		List[Dict[str, Any]]: One summary per config, with the completion probability and medians of the completed trials
+	"""
+	by_config: Dict[Tuple[int, int, str], List[Dict[str, Any]]] = {}
+	for result in results:
+		by_config.setdefault((result['chunk_size'], result['repeats'], result['profile']), []).append(result)
+	summaries = []
+	for (chunk_size, repeats, profile), trials in by_config.items():
+		done = [t for t in trials if t['completed']]
+		def median_of(key: str):
+			values = [t[key] for t in done if t[key] is not None]
+			return median(values) if len(values) > 0 else None
+		def mean_of(key: str):
+			values = [t[key] for t in trials if t[key] is not None]
+			return mean(values) if len(values) > 0 else None
+		summaries.append({
+			'chunk_size': chunk_size,
+			'repeats': repeats,
+			'profile': profile,
+			'trials': len(trials),
+			'completion_probability': len(done) / len(trials),
+			'median_time_to_complete': median_of('time_to_complete'),
+			'median_goodput': median_of('goodput'),
+			'mean_sender_cpu_per_mb': mean_of('sender_cpu_per_mb'),
+			'mean_receiver_cpu_per_mb': mean_of('receiver_cpu_per_mb'),
+		})
+	return summaries
+
+def run_benchmark(configs: Iterable[TrialConfig], impairments: Impairments, trials=1, send_rate=DEFAULT_SEND_RATE,
+		timeout: Optional[float]=None, seed: Optional[int]=None):
+	"""Runs every config `trials` times
+
+	Args:
+		seed (Optional[int], optional): Seeds the link's impairments (each trial gets its own seed from it).
+			Defaults to None.
+
+	Returns:
+		Dict[str, Any]: A JSON-serializable report, with every trial's results and a summary per config
+	"""
+	results = []
+	for config in configs:
+		for trial in range(trials):
+			trial_seed = None if seed is None else seed + len(results)
+			results.append(run_trial(config, impairments, send_rate, timeout, trial_seed))
+	return {
+		'version': __version__,
+		'created': time.time(),
+		'send_rate': send_rate,
+		'impairments': impairments._asdict(),
+		'results': results,
+		'summary': summarize(results),
+	}
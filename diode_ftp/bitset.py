@@ -18,6 +18,12 @@ class bitset():
 			self.zeros -= 1
 	def __len__(self):
 		return self.zeros
+	def resize(self, new_len: int):
+		"""Grows the bitset to hold new_len bits. New bits are unset"""
+		if new_len <= self.len:
+			return
+		self.len = new_len
+		self.bytes.extend(bytes(calc_bitset_length(new_len) - len(self.bytes)))
 
 def calc_bitset_length(len: int):
 	return (len + 7) // 8
\ No newline at end of file
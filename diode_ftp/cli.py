@@ -1,12 +1,37 @@
 import argparse
 from time import sleep
 from diode_ftp import FolderSender, FolderReceiver
+from diode_ftp.compression import CODECS, Compressor
+from diode_ftp.FolderWatcher import FolderWatcher
+from diode_ftp.ScanCache import ScanCache
+from diode_ftp.TransferScheduler import TransferScheduler
+from diode_ftp.Carousel import Carousel
+from diode_ftp.ShardedReceiver import ShardedReceiver
+from diode_ftp.inotify import inotify_supported
+from diode_ftp.LossyLink import make_impairments
+from diode_ftp import bench
+from diode_ftp.transport import CaptureTransport, CaptureWriter, CapturingProtocol, replay_capture
+from diode_ftp.metrics import MetricsRegistry, MetricsServer, parse_metrics_address
 import os
 import asyncio
-from logging import INFO, basicConfig
+import socket
+import json
+import sys
+from logging import INFO, basicConfig, getLogger
 
 basicConfig(level=INFO)
 
+# with --watch and --carousel, how long to rebroadcast for between checking for changes
+IDLE_SLICE = 0.5
+
+def serve_metrics(address: str, register):
+	"""Serves metrics on `address` (a --metrics argument), with whatever `register` adds to the registry"""
+	registry = MetricsRegistry()
+	register(registry)
+	server = MetricsServer(registry, parse_metrics_address(address))
+	getLogger('metrics').info(f'Serving metrics on {server.address}')
+	return server
+
 def start_folder_sender():
 	parser = argparse.ArgumentParser(description='Starts a folder sender')
 	parser.add_argument('-f', '--folder', default=os.getcwd(), help='The folder to sync')
@@ -14,29 +39,159 @@ def start_folder_sender():
 	parser.add_argument('-c', '--chunk-size', default=1400, type=int, help='The maximum size of each chunk')
 	parser.add_argument('-l', '--limit', default=200000, type=int, help='The maxmimum bytes per second')
 	parser.add_argument('-r', '--repeats', default=2, type=int, help='Number of times to duplicate each chunk')
+	parser.add_argument('--repeat-separation', default=None, type=int, help='Interleave repeats so two copies of a chunk are at least this many chunks apart (default: a whole copy apart)')
+	parser.add_argument('--repeat-separation-seconds', default=0.0, type=float, help='Keep two copies of a chunk at least this many seconds apart, to survive fades')
+	parser.add_argument('--shuffle-window', default=0, type=int, help='Shuffle the chunks of each copy, moving them up to this many places (0 disables shuffling)')
+	parser.add_argument('--fec-repairs', default=0, type=int, help='Number of FEC repair chunks to add per block (0 disables FEC)')
+	parser.add_argument('--fec-block-size', default=32, type=int, help='Number of chunks in each FEC block')
+	parser.add_argument('--burst', default=0, type=int, help='The most bytes to send back to back (0 picks 20ms worth)')
+	parser.add_argument('--kernel-pacing', default=False, action='store_true', help='Set flag to also pace in the kernel with SO_MAX_PACING_RATE (needs the fq qdisc)')
+	parser.add_argument('-b', '--batch', default=False, action='store_true', help='Set flag to batch sends with UDP GSO (Linux)')
+	parser.add_argument('-s', '--stream', default=False, action='store_true', help='Set flag to send tars as they are created, instead of writing them to disk first')
+	parser.add_argument('--stream-repeat-delay', default=1024, type=int, help='When streaming, number of chunks to wait before repeating a chunk')
+	parser.add_argument('--dedup', default=False, action='store_true', help='Set flag to only send the parts of big files that have not been sent before')
+	parser.add_argument('--dedup-max-age', default=24 * 3600, type=float, help='With --dedup, send blocks again once this many seconds have passed since they were last sent, in case that transfer was lost')
+	parser.add_argument('-z', '--compress', default=None, choices=sorted(CODECS), help='Compress files with this codec (incompressible files are sent as-is)')
+	parser.add_argument('--compress-level', default=None, type=int, help='The compression level to use')
 	parser.add_argument('-i', '--interval', default=5, type=int, help='Seconds to wait between checking the folder for new files')
+	parser.add_argument('--scan-cache', default=False, action='store_true', help='Set flag to cache directory listings between scans, and only re-list directories that changed')
+	parser.add_argument('-w', '--watch', default=False, action='store_true', help='Set flag to sync as soon as files change (Linux inotify), instead of checking every interval')
+	parser.add_argument('--settle', default=1.0, type=float, help='With --watch, seconds to wait for files to stop changing before syncing')
+	parser.add_argument('-p', '--prioritize', default=False, action='store_true', help='Set flag to send changed files as several interleaved transfers, with bandwidth shared by the priorities in .diodepriority')
+	parser.add_argument('--max-transfer-size', default=64 * 1024 * 1024, type=int, help='With --prioritize, the most bytes of files to put in one transfer')
+	parser.add_argument('--carousel', default=False, action='store_true', help='Set flag to keep recent tars and rebroadcast them whenever there is nothing new to send')
+	parser.add_argument('--carousel-size', default=256 * 1024 * 1024, type=int, help='With --carousel, the most bytes of tars to keep')
+	parser.add_argument('--carousel-age', default=3600, type=float, help='With --carousel, seconds to keep rebroadcasting a tar for')
+	parser.add_argument('--rescan', default=600, type=float, help='With --watch, seconds between full rescans of the folder, in case inotify missed something')
+	parser.add_argument('--capture', default=None, help='Also record every datagram sent (with timestamps) to this capture file')
+	parser.add_argument('--metrics', default=None, help='Serve Prometheus metrics on this [host:]port, or unix:<path>')
 	args = parser.parse_args()
 	send_host, send_port = args.dest.split(':')
 
-	sender = FolderSender(args.folder, (send_host, int(send_port)),
-		max_bytes_per_second=args.limit, transmit_repeats=args.repeats, chunk_size=args.chunk_size)
+	transport = None
+	if args.capture is not None:
+		transport = CaptureTransport(CaptureWriter(args.capture), socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+	sender = FolderSender(args.folder, (send_host, int(send_port)), transmit_socket=transport,
+		max_bytes_per_second=args.limit, transmit_repeats=args.repeats, chunk_size=args.chunk_size,
+		repeat_separation=args.repeat_separation, repeat_separation_seconds=args.repeat_separation_seconds,
+		shuffle_window=args.shuffle_window,
+		fec_repairs=args.fec_repairs, fec_block_size=args.fec_block_size, batch_send=args.batch,
+		burst_bytes=args.burst, kernel_pacing=args.kernel_pacing,
+		streaming=args.stream, stream_repeat_delay=args.stream_repeat_delay, dedup=args.dedup, dedup_max_age=args.dedup_max_age,
+		compressor=Compressor(args.compress, args.compress_level) if args.compress is not None else None,
+		scan_cache=ScanCache(args.folder) if args.scan_cache else None,
+		scheduler=TransferScheduler(args.folder, args.max_transfer_size) if args.prioritize else None,
+		carousel=Carousel(args.carousel_size, args.carousel_age) if args.carousel else None)
+	if args.metrics is not None:
+		serve_metrics(args.metrics, sender.register_metrics)
 	
-	while True:
-		sender.perform_sync()
-		sleep(args.interval)
+	try:
+		if args.watch:
+			if inotify_supported():
+				watcher = FolderWatcher(args.folder, settle=args.settle, rescan_interval=args.rescan)
+				while True:
+					# don't wait for changes while there are still transfers to send, or old ones to rebroadcast
+					busy = sender.has_pending_transfers()
+					changes = watcher.wait_for_changes(0 if busy or sender.carousel is not None else None)
+					if changes == set() and not busy:
+						sender.idle(IDLE_SLICE)
+					else:
+						sender.perform_sync(changes)
+			getLogger('sync-sender').warning('inotify is not available, falling back to checking every interval')
+		while True:
+			sender.perform_sync()
+			if not sender.has_pending_transfers():
+				sender.idle(args.interval)
+	finally:
+		sender.close()
 
 def start_folder_receiver():
 	parser = argparse.ArgumentParser(description='Starts a folder sender')
 	parser.add_argument('-f', '--folder', default=os.getcwd(), help='The folder to sync')
 	parser.add_argument('-k', '--keep-tars', default=False, action='store_true', help='Set flag to truncate files which are sent')
 	parser.add_argument('-p', '--port', default=8963, help='port to listen to')
+	parser.add_argument('-e', '--engine', default=False, action='store_true', help='Set flag to receive on a dedicated thread instead of asyncio, for high packet rates')
+	parser.add_argument('--rcvbuf', default=8 * 1024 * 1024, type=int, help='Socket receive buffer size in bytes (with --engine)')
+	parser.add_argument('--shards', default=0, type=int, help='Handle frames in this many worker processes, sharded by transfer (0 uses one process). Keep it the same for a folder')
+	parser.add_argument('--capture', default=None, help='Also record every datagram received (with timestamps) to this capture file (not with --engine or --shards)')
+	parser.add_argument('--replay', default=None, help='Instead of listening, replay a capture file into the folder, then exit')
+	parser.add_argument('--replay-speed', default=None, type=float, help='With --replay, replay at this multiple of the recorded speed (default: as fast as possible)')
+	parser.add_argument('--metrics', default=None, help='Serve Prometheus metrics on this [host:]port, or unix:<path>')
 	args = parser.parse_args()
 
+	if args.replay is not None:
+		receiver = FolderReceiver(args.folder, delete_tars=not args.keep_tars)
+		replayed = replay_capture(args.replay, receiver, args.replay_speed)
+		receiver.queue.put(None)
+		receiver.worker.join()
+		getLogger('sync-receiver').info(f'Replayed {replayed} datagrams from {args.replay}')
+		return
+
+	if args.shards > 0:
+		sharded = ShardedReceiver(args.folder, shards=args.shards, delete_tars=not args.keep_tars)
+		sharded.start_engine(('0.0.0.0', int(args.port)), rcvbuf=args.rcvbuf)
+		if args.metrics is not None:
+			# the shards' own stats live in their processes, so only the parent's are exposed
+			serve_metrics(args.metrics, lambda registry: registry.add_stats('diode_sharded_receiver', sharded.stats, 'Sharded receiver stat'))
+		while True:
+			sleep(60)
+			getLogger('receive_engine').info(f'Receive stats: {sharded.stats()}')
+
+	if args.engine:
+		receiver = FolderReceiver(args.folder, delete_tars=not args.keep_tars)
+		engine = receiver.start_engine(('0.0.0.0', int(args.port)), rcvbuf=args.rcvbuf)
+		if args.metrics is not None:
+			serve_metrics(args.metrics, receiver.register_metrics)
+		while True:
+			sleep(60)
+			getLogger('receive_engine').info(f'Receive stats: {engine.stats()}')
+
+	receiver = FolderReceiver(args.folder, delete_tars=not args.keep_tars)
+	if args.metrics is not None:
+		serve_metrics(args.metrics, receiver.register_metrics)
 	def make_receiver():
-		return FolderReceiver(args.folder, delete_tars=not args.keep_tars)
+		if args.capture is not None:
+			return CapturingProtocol(CaptureWriter(args.capture), receiver)
+		return receiver
 	
 	while True:
 		loop = asyncio.get_event_loop()
 		t = loop.create_datagram_endpoint(make_receiver, local_addr=('0.0.0.0', args.port))
 		loop.run_until_complete(t) # Server starts listening
-		loop.run_forever()
\ No newline at end of file
+		loop.run_forever()
+
+def start_benchmark():
+	parser = argparse.ArgumentParser(description='Benchmarks folder syncs through a simulated lossy link on loopback')
+	parser.add_argument('--chunk-sizes', default='1400', help='Comma-separated chunk sizes to try')
+	parser.add_argument('--repeats', default='1,2', help='Comma-separated repeat counts to try')
+	parser.add_argument('--profiles', default='one-big,many-small', help=f'Comma-separated file profiles to try: {", ".join(sorted(bench.PROFILES))}, or <files>x<bytes>')
+	parser.add_argument('-n', '--trials', default=3, type=int, help='Number of times to run each combination')
+	parser.add_argument('--send-rate', default=bench.DEFAULT_SEND_RATE, type=float, help='The sender\'s rate in bytes per second')
+	parser.add_argument('--loss', default=0.0, type=float, help='Chance of losing each datagram')
+	parser.add_argument('--burst-enter', default=0.0, type=float, help='Gilbert-Elliott burst loss: chance of the link going bad, per datagram (0 disables burst loss)')
+	parser.add_argument('--burst-exit', default=0.1, type=float, help='Gilbert-Elliott burst loss: chance of the link recovering, per datagram')
+	parser.add_argument('--burst-loss', default=1.0, type=float, help='Gilbert-Elliott burst loss: chance of losing each datagram while the link is bad')
+	parser.add_argument('--reorder', default=0.0, type=float, help='Chance of delaying each datagram so later ones overtake it')
+	parser.add_argument('--reorder-delay', default=0.005, type=float, help='Seconds to delay reordered datagrams by')
+	parser.add_argument('--duplicate', default=0.0, type=float, help='Chance of delivering each datagram twice')
+	parser.add_argument('--link-rate', default=0.0, type=float, help='The link\'s rate in bytes per second (0 is unlimited)')
+	parser.add_argument('--max-queue-delay', default=0.05, type=float, help='With --link-rate, drop datagrams that would queue for longer than this many seconds')
+	parser.add_argument('--timeout', default=None, type=float, help='Give up on a trial after this many seconds (default: 5x the time sending should take)')
+	parser.add_argument('--seed', default=None, type=int, help='Seeds the simulated impairments, for repeatable runs')
+	parser.add_argument('-o', '--output', default=None, help='Write the JSON report here instead of stdout')
+	args = parser.parse_args()
+
+	configs = [bench.TrialConfig(int(chunk_size), int(repeats), profile)
+		for profile in args.profiles.split(',')
+		for chunk_size in args.chunk_sizes.split(',')
+		for repeats in args.repeats.split(',')]
+	impairments = make_impairments(args.loss, args.burst_enter, args.burst_exit, args.burst_loss, args.reorder,
+		args.reorder_delay, args.duplicate, args.link_rate, args.max_queue_delay)
+	report = bench.run_benchmark(configs, impairments, args.trials, args.send_rate, args.timeout, args.seed)
+	for summary in report['summary']:
+		getLogger('bench').info(f'Summary: {summary}')
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+	else:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
@@ -0,0 +1,215 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+import lzma
+import os
+import tarfile
+import tempfile
+import time
+import zlib
+
+# compressed files travel in the tar as .diode_compressed/<codec>/<path>, so they can't collide with real files
+COMPRESSED_PREFIX = '.diode_compressed/'
+READ_SIZE = 1024 * 1024
+DEFAULT_PROBE_SIZE = 64 * 1024
+# files whose sample doesn't shrink by at least this much are sent as-is (e.g. video, JPEGs, zips)
+DEFAULT_MIN_SAVINGS = 0.1
+
+Codec = NamedTuple('Codec', [
+	('name', str),
+	# takes a compression level (None for the default), returns an object with compress(data) and flush()
+	('compressor', Callable[[Optional[int]], Any]),
+	# returns an object with decompress(data) (and optionally flush())
+	('decompressor', Callable[[], Any])])
+
+CODECS: Dict[str, Codec] = {}
+
+def register_codec(codec: Codec):
+	"""Adds a codec that senders and receivers can use.
+	Register it at import time on both sides, so process pool workers (and the receiver) know about it too"""
+	CODECS[codec.name] = codec
+
+register_codec(Codec('zlib',
+	lambda level: zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level),
+	zlib.decompressobj))
+register_codec(Codec('lzma',
+	lambda level: lzma.LZMACompressor(preset=level),
+	lzma.LZMADecompressor))
+
+CompressedFile = NamedTuple('CompressedFile', [
+	('path', Path),
+	('arcname', str),
+	# None if the file wasn't worth compressing
+	('compressed_path', Optional[Path]),
+	('size', int),
+	('compressed_size', int),
+	('cpu_time', float)])
+
+def worth_compressing(sample: bytes, min_savings=DEFAULT_MIN_SAVINGS):
+	"""Checks if a sample of a file compresses well. Uses fast zlib, whatever the real codec is"""
+	if len(sample) == 0:
+		return False
+	return len(zlib.compress(sample, 1)) <= len(sample) * (1 - min_savings)
+
+def compress_file(path: PathLike, arcname: str, codec_name: str, level: Optional[int], tmp_dir: PathLike,
+		probe_size=DEFAULT_PROBE_SIZE, min_savings=DEFAULT_MIN_SAVINGS):
+	"""Compresses a file into a temporary file, unless a sample of it shows it won't compress.
+	Runs in the process pool, so it has to be a top-level function
+
+	Returns:
+		Optional[CompressedFile]: Where the compressed file is, and how much it shrunk. None if we couldn't read the file
+	"""
+	try:
+		return compress_file_unchecked(path, arcname, codec_name, level, tmp_dir, probe_size, min_savings)
+	except OSError:
+		return None
+
+def compress_file_unchecked(path: PathLike, arcname: str, codec_name: str, level: Optional[int], tmp_dir: PathLike,
+		probe_size: int, min_savings: float):
+	start = time.process_time()
+	codec = CODECS[codec_name]
+	size = os.path.getsize(path)
+	with open(path, 'rb') as src:
+		if not worth_compressing(src.read(probe_size), min_savings):
+			return CompressedFile(Path(path), arcname, None, size, size, time.process_time() - start)
+		src.seek(0)
+		compressor = codec.compressor(level)
+		with tempfile.NamedTemporaryFile('wb', dir=tmp_dir, delete=False) as dst:
+			while True:
+				data = src.read(READ_SIZE)
+				if not data:
+					break
+				dst.write(compressor.compress(data))
+			dst.write(compressor.flush())
+			compressed_size = dst.tell()
+	return CompressedFile(Path(path), arcname, Path(dst.name), size, compressed_size, time.process_time() - start)
+
+class CompressionStats():
+	"""What compression saved us, and what it cost"""
+	def __init__(self) -> None:
+		self.files_compressed = 0
+		self.files_skipped = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.cpu_time = 0.0
+	def add(self, result: CompressedFile):
+		if result.compressed_path is None:
+			self.files_skipped += 1
+		else:
+			self.files_compressed += 1
+		self.bytes_in += result.size
+		self.bytes_out += result.compressed_size
+		self.cpu_time += result.cpu_time
+	@property
+	def bytes_saved(self):
+		return self.bytes_in - self.bytes_out
+	def __str__(self) -> str:
+		return (f'compressed {self.files_compressed} files (skipped {self.files_skipped} incompressible), '
+			f'saving {self.bytes_saved} of {self.bytes_in} bytes using {self.cpu_time:.2f}s of CPU')
+
+class Compressor():
+	"""Compresses files for a tar in a process pool, skipping files that are already compressed"""
+	def __init__(self, codec='zlib', level: Optional[int]=None, workers: Optional[int]=None,
+			probe_size=DEFAULT_PROBE_SIZE, min_savings=DEFAULT_MIN_SAVINGS) -> None:
+		"""Creates a compressor
+
+		Args:
+			codec (str, optional): The name of the codec to use (see CODECS). Defaults to 'zlib'.
+			level (Optional[int], optional): The compression level. Defaults to None (the codec's default).
+			workers (Optional[int], optional): The number of worker processes. 0 compresses in this process.
+				Defaults to None (one per CPU).
+			probe_size (int, optional): How much of each file to test compress. Defaults to 64 KiB.
+			min_savings (float, optional): How much the sample has to shrink by to compress the file. Defaults to 0.1.
+
+		Raises:
+			ValueError: The codec doesn't exist
+		"""
+		if codec not in CODECS:
+			raise ValueError(f'Unknown compression codec {codec} (expected one of {", ".join(CODECS)})')
+		self.codec = codec
+		self.level = level
+		self.workers = workers
+		self.probe_size = probe_size
+		self.min_savings = min_savings
+		self.pool: Optional[Executor] = None
+		# stats for the latest tar
+		self.stats = CompressionStats()
+	def compress(self, files: Iterable[Tuple[PathLike, str]], tmp_dir: PathLike) -> Iterator[CompressedFile]:
+		"""Compresses files (path, arcname) into tmp_dir, leaving out files we can't read.
+		The caller must delete the compressed files"""
+		args = (self.codec, self.level, tmp_dir, self.probe_size, self.min_savings)
+		if self.workers == 0:
+			results = (compress_file(path, arcname, *args) for path, arcname in files)
+		else:
+			if self.pool is None:
+				self.pool = ProcessPoolExecutor(self.workers)
+			results = (future.result() for future in
+				[self.pool.submit(compress_file, path, arcname, *args) for path, arcname in files])
+		for result in results:
+			if result is not None:
+				self.stats.add(result)
+				yield result
+	def add_to_tar(self, tarball: tarfile.TarFile, files: Iterable[Tuple[PathLike, str]]):
+		"""Compresses files and adds them to a tar. Files that aren't worth compressing are added as-is
+
+		Returns:
+			Set[str]: The arcnames of the files that made it in (files that vanished are left out)
+		"""
+		self.stats = CompressionStats()
+		added = set()
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			for result in self.compress(files, tmp_dir):
+				try:
+					if result.compressed_path is None:
+						tarball.add(result.path, arcname=result.arcname)
+					else:
+						# keep the original file's mode and mtime
+						info = tarball.gettarinfo(result.path, arcname=f'{COMPRESSED_PREFIX}{self.codec}/{result.arcname}')
+						info.size = result.compressed_size
+						with open(result.compressed_path, 'rb') as f:
+							tarball.addfile(info, f)
+						os.unlink(result.compressed_path)
+					added.add(result.arcname)
+				except OSError:
+					pass
+		return added
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
+
+def is_compressed_member(member: tarfile.TarInfo):
+	return member.name.startswith(COMPRESSED_PREFIX)
+
+def compressed_destination(member: tarfile.TarInfo):
+	"""Gets the path (relative to the root) a compressed member is decompressed to"""
+	return member.name[len(COMPRESSED_PREFIX):].split('/', 1)[-1]
+
+def extract_compressed(tarball: tarfile.TarFile, member: tarfile.TarInfo, root: Path):
+	"""Decompresses a compressed member of a tar into its real path under root
+
+	Raises:
+		ValueError: The member was compressed with a codec we don't know
+	"""
+	codec_name, arcname = member.name[len(COMPRESSED_PREFIX):].split('/', 1)
+	codec = CODECS.get(codec_name)
+	if codec is None:
+		raise ValueError(f'{arcname} was compressed with an unknown codec ({codec_name})')
+	path = root / arcname
+	path.parent.mkdir(parents=True, exist_ok=True)
+	tmp_path = path.with_name(path.name + '.diode_tmp')
+	decompressor = codec.decompressor()
+	src = tarball.extractfile(member)
+	with open(tmp_path, 'wb') as dst:
+		while True:
+			data = src.read(READ_SIZE)
+			if not data:
+				break
+			dst.write(decompressor.decompress(data))
+		if hasattr(decompressor, 'flush'):
+			dst.write(decompressor.flush())
+	os.chmod(tmp_path, member.mode)
+	os.utime(tmp_path, (member.mtime, member.mtime))
+	os.replace(tmp_path, path)
+	return path
@@ -0,0 +1,286 @@
+from os import PathLike
+from pathlib import Path
+from logging import Logger, getLogger
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set
+import dbm
+import hashlib
+import io
+import json
+import os
+import struct
+import tarfile
+import tempfile
+import time
+
+# deduplicated files travel in the tar as a recipe (the list of blocks that make up each file),
+# plus a single member holding every block the receiver hasn't seen before, in recipe order
+DEDUP_PREFIX = '.diode_dedup/'
+RECIPES_NAME = DEDUP_PREFIX + 'recipes.json'
+BLOCKS_NAME = DEDUP_PREFIX + 'blocks'
+
+DEFAULT_MIN_BLOCK = 2 * 1024
+DEFAULT_AVG_BLOCK = 8 * 1024
+DEFAULT_MAX_BLOCK = 64 * 1024
+# files smaller than this are cheaper to just send whole
+DEFAULT_MIN_FILE_SIZE = 64 * 1024
+# resend blocks we last sent longer ago than this, in case the tar that carried them never arrived
+DEFAULT_MAX_BLOCK_AGE = 24 * 3600
+READ_SIZE = 1024 * 1024
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+# the gear table has to be the same on every run, or block boundaries would move and nothing would dedup
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([b])).digest()[:8], 'big') for b in range(256))
+
+def gear_masks(avg_size: int):
+	"""Gets FastCDC's normalized chunking masks: a stricter one before the average size, and a looser one after.
+	We test the high bits of the hash, since those depend on the last 64 bytes (the low bits only see the last few)"""
+	bits = max(avg_size.bit_length() - 1, 3)
+	mask_s = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+	mask_l = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+	return mask_s, mask_l
+
+def cut_point(data: memoryview, min_size=DEFAULT_MIN_BLOCK, avg_size=DEFAULT_AVG_BLOCK, max_size=DEFAULT_MAX_BLOCK):
+	"""Finds where the first content-defined block of data ends, with a gear rolling hash (FastCDC).
+
+	Because boundaries depend only on the bytes around them, inserting or deleting data only moves
+	the boundaries near the edit, and the blocks after it are unchanged.
+
+	Returns:
+		int: The length of the first block
+	"""
+	n = len(data)
+	if n <= min_size:
+		return n
+	limit = min(n, max_size)
+	normal = min(limit, avg_size)
+	mask_s, mask_l = gear_masks(avg_size)
+	gear = GEAR
+	h = 0
+	for i, b in enumerate(data[min_size:normal], min_size):
+		h = ((h << 1) + gear[b]) & MASK64
+		if not h & mask_s:
+			return i + 1
+	for i, b in enumerate(data[normal:limit], normal):
+		h = ((h << 1) + gear[b]) & MASK64
+		if not h & mask_l:
+			return i + 1
+	return limit
+
+def iter_blocks(file: BinaryIO, min_size=DEFAULT_MIN_BLOCK, avg_size=DEFAULT_AVG_BLOCK, max_size=DEFAULT_MAX_BLOCK) -> Iterator[bytes]:
+	"""Splits a file into content-defined blocks"""
+	buffer = b''
+	eof = False
+	while True:
+		while not eof and len(buffer) < max_size:
+			data = file.read(READ_SIZE)
+			if not data:
+				eof = True
+			buffer += data
+		if len(buffer) == 0:
+			return
+		view = memoryview(buffer)
+		pos = 0
+		# cut as many blocks as we can without running into the end of what we've read
+		while len(buffer) - pos >= max_size or (eof and pos < len(buffer)):
+			size = cut_point(view[pos:], min_size, avg_size, max_size)
+			yield buffer[pos:pos + size]
+			pos += size
+		view.release()
+		buffer = buffer[pos:]
+
+def block_hash(block: bytes):
+	return hashlib.sha1(block).digest()
+
+BLOCK_SENT_AT = struct.Struct('!d')
+
+class BlockIndex():
+	"""A persistent set of the blocks we have already sent (and when), kept in a dbm file.
+
+	New blocks are staged per tar while it is written, and only committed once that tar has been transmitted.
+	Over a one-way link we never learn if a tar was lost, and if it was, every recipe using its blocks fails to rebuild.
+	So blocks are forgotten `max_age` seconds after they were last sent, and the next tar that uses them sends them again.
+	"""
+	def __init__(self, path: PathLike, max_age: float = DEFAULT_MAX_BLOCK_AGE) -> None:
+		"""Opens (or creates) a block index
+
+		Args:
+			path (PathLike): The dbm file
+			max_age (float, optional): Seconds after which a block counts as unsent again. Defaults to a day.
+		"""
+		self.db = dbm.open(str(path), 'c')
+		self.max_age = max_age
+		# the blocks staged for each tar that hasn't been sent yet
+		self.pending: Dict[Any, Set[bytes]] = {}
+	def __contains__(self, hash: bytes):
+		sent_at = self.db.get(hash)
+		# entries from before blocks had ages are treated as expired
+		if sent_at is None or len(sent_at) != BLOCK_SENT_AT.size:
+			return False
+		return time.time() - BLOCK_SENT_AT.unpack(sent_at)[0] < self.max_age
+	def stage(self, hashes: Set[bytes], key: Any = None):
+		"""Stages the new blocks of a tar about to be sent
+
+		Args:
+			hashes (Set[bytes]): The blocks
+			key (Any, optional): Identifies the tar, for `commit`. Staging the same key again replaces its blocks
+				(e.g. for a tar that was never sent). Defaults to None.
+		"""
+		self.pending[key] = set(hashes)
+	def commit(self, key: Any = None):
+		"""Records the blocks staged for a tar as sent, once it has been transmitted"""
+		hashes = self.pending.pop(key, None)
+		if hashes is None:
+			return
+		sent_at = BLOCK_SENT_AT.pack(time.time())
+		for hash in hashes:
+			self.db[hash] = sent_at
+		if hasattr(self.db, 'sync'):
+			self.db.sync()
+	def close(self):
+		self.db.close()
+
+class DedupTarWriter():
+	"""Adds files to a tar as recipes of content-defined blocks, leaving out blocks the receiver already has"""
+	def __init__(self, tarball: tarfile.TarFile, index: BlockIndex, min_file_size=DEFAULT_MIN_FILE_SIZE,
+			min_block=DEFAULT_MIN_BLOCK, avg_block=DEFAULT_AVG_BLOCK, max_block=DEFAULT_MAX_BLOCK, stage_key: Any = None) -> None:
+		"""Creates a dedup tar writer
+
+		Args:
+			tarball (tarfile.TarFile): The tar being written
+			index (BlockIndex): The blocks we have already sent
+			min_file_size (int, optional): Smaller files are left for the caller to add whole. Defaults to 64 KiB.
+			min_block (int, optional): The minimum block size. Defaults to 2 KiB.
+			avg_block (int, optional): The average block size to aim for. Should be a power of 2. Defaults to 8 KiB.
+			max_block (int, optional): The maximum block size. Defaults to 64 KiB.
+			stage_key (Any, optional): Identifies this tar when its new blocks are staged in the index. Defaults to None.
+		"""
+		self.tarball = tarball
+		self.index = index
+		self.stage_key = stage_key
+		self.min_file_size = min_file_size
+		self.block_sizes = (min_block, avg_block, max_block)
+		self.recipes: Dict[str, dict] = {}
+		self.new_blocks: List[List] = []
+		self.new_hashes: Set[bytes] = set()
+		# blocks have to be counted before the member holding them can be added, so we spool them first
+		self.spool = tempfile.TemporaryFile()
+		# stats
+		self.bytes_in = 0
+		self.bytes_deduped = 0
+	def add(self, path: PathLike, arcname: str):
+		"""Adds a file to the tar as a recipe, if it's big enough
+
+		Returns:
+			bool: False if the file is too small, and should be added to the tar some other way
+		"""
+		stat = os.stat(path)
+		if stat.st_size < self.min_file_size:
+			return False
+		blocks = []
+		with open(path, 'rb') as f:
+			for block in iter_blocks(f, *self.block_sizes):
+				hash = block_hash(block)
+				blocks.append(hash.hex())
+				self.bytes_in += len(block)
+				if hash in self.new_hashes or hash in self.index:
+					self.bytes_deduped += len(block)
+					continue
+				self.new_hashes.add(hash)
+				self.new_blocks.append([hash.hex(), len(block)])
+				self.spool.write(block)
+		self.recipes[arcname] = {
+			'size': stat.st_size,
+			'mtime': stat.st_mtime,
+			'mode': stat.st_mode & 0o7777,
+			'blocks': blocks,
+		}
+		return True
+	def finish(self):
+		"""Adds the recipes and new blocks to the tar, and stages the new blocks in the index"""
+		if len(self.recipes) > 0:
+			recipes = json.dumps({'blocks': self.new_blocks, 'files': self.recipes}).encode()
+			info = tarfile.TarInfo(RECIPES_NAME)
+			info.size = len(recipes)
+			self.tarball.addfile(info, io.BytesIO(recipes))
+			info = tarfile.TarInfo(BLOCKS_NAME)
+			info.size = self.spool.tell()
+			self.spool.seek(0)
+			self.tarball.addfile(info, self.spool)
+		self.spool.close()
+		self.index.stage(self.new_hashes, self.stage_key)
+
+BLOCK_LOCATION = struct.Struct('!QI')
+
+class BlockStore():
+	"""The receiver's store of every block it has received, so deduplicated files can be rebuilt.
+	Blocks are appended to a pack file, and located with a dbm index"""
+	def __init__(self, root: PathLike) -> None:
+		root = Path(root)
+		self.pack = open(root / '.diode_blocks', 'a+b')
+		self.db = dbm.open(str(root / '.diode_block_index'), 'c')
+	def __contains__(self, hash: bytes):
+		return hash in self.db
+	def put(self, hash: bytes, block: bytes):
+		if hash in self.db:
+			return
+		self.pack.seek(0, os.SEEK_END)
+		offset = self.pack.tell()
+		self.pack.write(block)
+		self.db[hash] = BLOCK_LOCATION.pack(offset, len(block))
+	def get(self, hash: bytes):
+		location = self.db.get(hash)
+		if location is None:
+			return None
+		offset, length = BLOCK_LOCATION.unpack(location)
+		self.pack.seek(offset)
+		return self.pack.read(length)
+	def flush(self):
+		self.pack.flush()
+		if hasattr(self.db, 'sync'):
+			self.db.sync()
+	def close(self):
+		self.pack.close()
+		self.db.close()
+
+def is_dedup_member(member: tarfile.TarInfo):
+	return member.name.startswith(DEDUP_PREFIX)
+
+def deduplicated_destinations(tarball: tarfile.TarFile):
+	"""Gets the paths (relative to the root) of the files a tar's recipes rebuild"""
+	recipes = json.load(tarball.extractfile(tarball.getmember(RECIPES_NAME)))
+	return list(recipes['files'])
+
+def restore_deduplicated(tarball: tarfile.TarFile, root: Path, store: BlockStore, log: Logger=getLogger('dedup')):
+	"""Stores the new blocks from a tar, and rebuilds its deduplicated files from their recipes
+
+	Returns:
+		int: The number of files rebuilt
+	"""
+	recipes_member = tarball.getmember(RECIPES_NAME)
+	recipes = json.load(tarball.extractfile(recipes_member))
+	blocks = tarball.extractfile(tarball.getmember(BLOCKS_NAME))
+	for hex_hash, length in recipes['blocks']:
+		block = blocks.read(length)
+		hash = bytes.fromhex(hex_hash)
+		if block_hash(block) != hash:
+			log.warning(f'Block {hex_hash} is corrupt, dropping it')
+			continue
+		store.put(hash, block)
+	store.flush()
+	rebuilt = 0
+	for arcname, recipe in recipes['files'].items():
+		path = root / arcname
+		missing = [h for h in recipe['blocks'] if bytes.fromhex(h) not in store]
+		if len(missing) > 0:
+			log.error(f'Cannot rebuild {arcname}: missing {len(missing)} blocks (was an earlier transfer lost?)')
+			continue
+		path.parent.mkdir(parents=True, exist_ok=True)
+		tmp_path = path.with_name(path.name + '.diode_tmp')
+		with open(tmp_path, 'wb') as f:
+			for hex_hash in recipe['blocks']:
+				f.write(store.get(bytes.fromhex(hex_hash)))
+		os.chmod(tmp_path, recipe['mode'])
+		os.utime(tmp_path, (recipe['mtime'], recipe['mtime']))
+		os.replace(tmp_path, path)
+		rebuilt += 1
+	return rebuilt
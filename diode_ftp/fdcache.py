@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from os import PathLike
+import os
+from typing import Hashable, Union
+
+OPEN_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+def pwrite(fd: int, data: Union[bytes, memoryview], offset: int):
+	"""Writes data at an offset without moving the file position (where the OS supports it)"""
+	if hasattr(os, 'pwrite'):
+		return os.pwrite(fd, data, offset)
+	os.lseek(fd, offset, os.SEEK_SET)
+	return os.write(fd, data)
+
+def pread(fd: int, length: int, offset: int):
+	"""Reads up to length bytes at an offset without moving the file position (where the OS supports it)"""
+	if hasattr(os, 'pread'):
+		return os.pread(fd, length, offset)
+	os.lseek(fd, offset, os.SEEK_SET)
+	return os.read(fd, length)
+
+def preallocate(fd: int, size: int):
+	"""Reserves disk space for a file up front, so it doesn't fragment as it is written out of order.
+	Does nothing if the OS doesn't support it, or the file is already big enough"""
+	if not hasattr(os, 'posix_fallocate') or size <= 0:
+		return
+	if os.fstat(fd).st_size >= size:
+		return
+	try:
+		os.posix_fallocate(fd, 0, size)
+	except OSError:
+		# not every filesystem supports fallocate, and it's only an optimization
+		pass
+
+class FileDescriptorCache():
+	"""An LRU cache of open file descriptors for files being reassembled.
+
+	Receivers write a chunk at a time to many files, and opening and closing the file for every
+	chunk costs more than the write itself. Instead we keep the most recently used files open.
+	"""
+	def __init__(self, max_open=32) -> None:
+		"""Creates a file descriptor cache
+
+		Args:
+			max_open (int, optional): The maximum number of files to keep open. Defaults to 32.
+		"""
+		self.max_open = max_open
+		self.fds: 'OrderedDict[Hashable, int]' = OrderedDict()
+	def get(self, key: Hashable, path: PathLike, preallocate_size=0):
+		"""Gets the file descriptor for a file, opening (and creating) it if needed
+
+		Args:
+			key (Hashable): What to cache the file by, e.g. the transfer hash
+			path (PathLike): The file to open if it is not already open
+			preallocate_size (int, optional): If we have to open the file, preallocate it to this size. Defaults to 0.
+
+		Returns:
+			int: The file descriptor
+		"""
+		fd = self.fds.get(key)
+		if fd is not None:
+			self.fds.move_to_end(key)
+			return fd
+		fd = os.open(path, OPEN_FLAGS, 0o666)
+		preallocate(fd, preallocate_size)
+		self.fds[key] = fd
+		while len(self.fds) > self.max_open:
+			_, evicted = self.fds.popitem(last=False)
+			os.close(evicted)
+		return fd
+	def truncate(self, key: Hashable, path: PathLike, size: int):
+		"""Trims a file to its real size, e.g. to remove preallocated space past the end of the data"""
+		os.ftruncate(self.get(key, path), size)
+	def close(self, key: Hashable):
+		"""Closes a file if it is open"""
+		fd = self.fds.pop(key, None)
+		if fd is not None:
+			os.close(fd)
+	def close_all(self):
+		for fd in self.fds.values():
+			os.close(fd)
+		self.fds.clear()
@@ -0,0 +1,226 @@
+"""Forward error correction for chunked files.
+
+We use a systematic Reed-Solomon style erasure code over GF(2^8) built from a Cauchy matrix.
+The file's data chunks are grouped into blocks of `block_size` chunks, and each block gets
+`repairs` extra repair chunks. Any `block_size` of the `block_size + repairs` chunks of a block
+are enough to rebuild the whole block.
+
+Repair chunks reuse the normal header:
+	- index: `total + block * repairs + j`, so any index >= total is a repair chunk
+	- offset: the FEC parameters packed by `pack_fec_offset` (block size, repairs, file size),
+		since a repair chunk has no offset of its own in the original file
+	- data: the repair symbols, always a full `chunk_data_size` long
+"""
+from typing import Callable, Dict, List, NamedTuple
+from diode_ftp.bitset import bitset
+
+FEC_MAX_SYMBOLS = 255
+FEC_MAX_FILE_SIZE = (1 << 48) - 1
+
+FecParams = NamedTuple('FecParams', [
+	('block_size', int),
+	('repairs', int),
+	('file_size', int)])
+
+def pack_fec_offset(params: FecParams):
+	if params.block_size + params.repairs > FEC_MAX_SYMBOLS:
+		raise ValueError(f'block_size + repairs must be at most {FEC_MAX_SYMBOLS}')
+	if params.file_size > FEC_MAX_FILE_SIZE:
+		raise ValueError('File is too large to be protected by FEC')
+	return (params.block_size << 56) | (params.repairs << 48) | params.file_size
+
+def unpack_fec_offset(offset: int):
+	return FecParams((offset >> 56) & 0xFF, (offset >> 48) & 0xFF, offset & FEC_MAX_FILE_SIZE)
+
+# GF(2^8) arithmetic with the 0x11d polynomial
+_EXP = bytearray(512)
+_LOG = bytearray(256)
+_x = 1
+for _i in range(255):
+	_EXP[_i] = _x
+	_LOG[_x] = _i
+	_x <<= 1
+	if _x & 0x100:
+		_x ^= 0x11d
+for _i in range(255, 512):
+	_EXP[_i] = _EXP[_i - 255]
+del _x, _i
+
+def gf_mul(a: int, b: int):
+	if a == 0 or b == 0:
+		return 0
+	return _EXP[_LOG[a] + _LOG[b]]
+
+def gf_inv(a: int):
+	if a == 0:
+		raise ZeroDivisionError('0 has no inverse in GF(256)')
+	return _EXP[255 - _LOG[a]]
+
+_mul_tables: Dict[int, bytes] = {}
+def _mul_table(c: int):
+	"""A 256-byte translation table that multiplies every byte by c, for use with bytes.translate"""
+	table = _mul_tables.get(c)
+	if table is None:
+		table = bytes(gf_mul(c, x) for x in range(256))
+		_mul_tables[c] = table
+	return table
+
+def cauchy_coefficient(repair: int, index: int):
+	"""The coefficient of data chunk `index` in repair chunk `repair`.
+	Every square submatrix of a Cauchy matrix is invertible, which is what makes any K-of-N recoverable"""
+	return gf_inv((FEC_MAX_SYMBOLS - repair) ^ index)
+
+def _to_int(data: bytes):
+	return int.from_bytes(data, 'little')
+
+def _from_int(value: int, length: int):
+	return value.to_bytes(length, 'little')
+
+class FecEncoder():
+	"""Incrementally computes the repair chunks of a block as its data chunks stream past"""
+
+	def __init__(self, repairs: int, symbol_size: int) -> None:
+		self.repairs = repairs
+		self.symbol_size = symbol_size
+		self.reset()
+	def reset(self):
+		self.count = 0
+		self.accumulators = [0] * self.repairs
+	def add(self, data: bytes):
+		"""Adds the next data chunk of the block. Short chunks are zero-padded"""
+		data = bytes(data).ljust(self.symbol_size, b'\0')
+		for j in range(self.repairs):
+			self.accumulators[j] ^= _to_int(data.translate(_mul_table(cauchy_coefficient(j, self.count))))
+		self.count += 1
+	def finish(self):
+		"""Returns the repair chunks for the block, and resets the encoder for the next block
+
+		Returns:
+			List[bytes]: The repair chunks
+		"""
+		repairs = [_from_int(acc, self.symbol_size) for acc in self.accumulators]
+		self.reset()
+		return repairs
+
+def _invert(matrix: List[List[int]]):
+	n = len(matrix)
+	aug = [row[:] + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+	for col in range(n):
+		pivot = next(r for r in range(col, n) if aug[r][col] != 0)
+		aug[col], aug[pivot] = aug[pivot], aug[col]
+		inv = gf_inv(aug[col][col])
+		aug[col] = [gf_mul(inv, v) for v in aug[col]]
+		for r in range(n):
+			if r != col and aug[r][col] != 0:
+				factor = aug[r][col]
+				aug[r] = [v ^ gf_mul(factor, p) for v, p in zip(aug[r], aug[col])]
+	return [row[n:] for row in aug]
+
+def fec_decode(data: Dict[int, bytes], repairs: Dict[int, bytes], block_size: int, symbol_size: int):
+	"""Rebuilds the missing data chunks of a block
+
+	Args:
+		data (Dict[int, bytes]): The data chunks we have, keyed by their index within the block
+		repairs (Dict[int, bytes]): The repair chunks we have, keyed by their index within the block's repairs
+		block_size (int): The number of data chunks in this block (the last block may be short)
+		symbol_size (int): The size of each data chunk. Short chunks are zero-padded to this
+
+	Raises:
+		ValueError: Not enough chunks to rebuild the block
+
+	Returns:
+		Dict[int, bytes]: The rebuilt data chunks, keyed by their index within the block (zero-padded)
+	"""
+	missing = [i for i in range(block_size) if i not in data]
+	if len(missing) == 0:
+		return {}
+	if len(missing) > len(repairs):
+		raise ValueError(f'Need {len(missing)} repair chunks to rebuild the block, but only have {len(repairs)}')
+	used = sorted(repairs)[:len(missing)]
+	# remove the contributions of the data chunks we already have from each repair chunk
+	known = [(i, bytes(d).ljust(symbol_size, b'\0')) for i, d in data.items()]
+	syndromes: List[int] = []
+	for j in used:
+		acc = _to_int(repairs[j])
+		for i, d in known:
+			acc ^= _to_int(d.translate(_mul_table(cauchy_coefficient(j, i))))
+		syndromes.append(acc)
+	inverse = _invert([[cauchy_coefficient(j, i) for i in missing] for j in used])
+	rebuilt: Dict[int, bytes] = {}
+	for row, i in zip(inverse, missing):
+		acc = 0
+		for coef, syndrome in zip(row, syndromes):
+			if coef != 0:
+				acc ^= _to_int(_from_int(syndrome, symbol_size).translate(_mul_table(coef)))
+		rebuilt[i] = _from_int(acc, symbol_size)
+	return rebuilt
+
+def block_of(index: int, block_size: int):
+	return index // block_size
+
+def block_range(block: int, block_size: int, total: int):
+	"""The data chunk indices in the given block"""
+	start = block * block_size
+	return range(start, min(start + block_size, total))
+
+def repair_location(index: int, total: int, repairs: int):
+	"""Splits the index of a repair chunk into (block, repair number within the block)"""
+	return divmod(index - total, repairs)
+
+class FecBlockState():
+	"""Receive-side FEC bookkeeping for a single file: which repair chunks we have, and when a block can be rebuilt"""
+
+	def __init__(self, total: int, params: FecParams, symbol_size: int) -> None:
+		self.total = total
+		self.params = params
+		self.symbol_size = symbol_size
+		num_blocks = (total + params.block_size - 1) // params.block_size
+		self.received_repairs = bitset(num_blocks * params.repairs)
+	def accept_repair(self, index: int):
+		"""Marks a repair chunk as received
+
+		Returns:
+			Tuple[int, int]: (block, repair number within the block), or None if we already had it
+		"""
+		block, j = repair_location(index, self.total, self.params.repairs)
+		seq = block * self.params.repairs + j
+		if self.received_repairs[seq]:
+			return None
+		self.received_repairs[seq] = True
+		return block, j
+	def repair_offset(self, block: int, j: int):
+		"""Where to store a repair chunk in the repair sidecar file"""
+		return (block * self.params.repairs + j) * self.symbol_size
+	def try_rebuild(self, block: int, have_data: bitset,
+			read_data: Callable[[int], bytes], read_repair: Callable[[int], bytes]):
+		"""Rebuilds the missing data chunks of a block if we have enough chunks
+
+		Args:
+			block (int): The block to check
+			have_data (bitset): The data chunks we have already received
+			read_data (Callable[[int], bytes]): Reads a data chunk back by its index in the file
+			read_repair (Callable[[int], bytes]): Reads a repair chunk back by its offset in the sidecar file
+
+		Returns:
+			Dict[int, bytes]: The rebuilt data chunks keyed by index in the file, trimmed to their real length.
+				Empty if nothing could be (or needed to be) rebuilt
+		"""
+		indices = block_range(block, self.params.block_size, self.total)
+		missing = [i for i in indices if not have_data[i]]
+		if len(missing) == 0:
+			return {}
+		repairs = [j for j in range(self.params.repairs)
+			if self.received_repairs[block * self.params.repairs + j]]
+		if len(repairs) < len(missing):
+			return {}
+		start = indices.start
+		data = {i - start: read_data(i) for i in indices if have_data[i]}
+		repair_data = {j: read_repair(self.repair_offset(block, j)) for j in repairs[:len(missing)]}
+		rebuilt = fec_decode(data, repair_data, len(indices), self.symbol_size)
+		result: Dict[int, bytes] = {}
+		for i, chunk in rebuilt.items():
+			index = start + i
+			if index == self.total - 1:
+				chunk = chunk[:self.params.file_size - index * self.symbol_size]
+			result[index] = chunk
+		return result
@@ -7,6 +7,12 @@ HEADER_FMT = '!20sQII'
 HEADER_STRUCT = struct.Struct(HEADER_FMT)
 HEADER_SIZE = HEADER_STRUCT.size
 
+# streaming transfers don't know how many chunks they have up front, so their chunks have a total of 0.
+# Instead, they end with a manifest chunk (index MANIFEST_INDEX), whose offset is the size of the stream,
+# total is the real number of chunks, and data is the SHA-1 of the stream
+STREAM_TOTAL = 0
+MANIFEST_INDEX = 0xFFFFFFFF
+
 Header = NamedTuple('DiodeFTPHeader', [
 	('hash', bytes),
 	('offset', int),
@@ -38,4 +44,22 @@ def hash_file(path: Union[PathLike, str]):
 			if not data:
 				break
 			sha1.update(data)
-	return sha1.digest()
\ No newline at end of file
+	return sha1.digest()
+
+class HashingWriter():
+	"""Wraps a writable file, and hashes everything written through it.
+	Lets us get a file's hash as we create it, instead of reading the whole thing back"""
+	def __init__(self, file) -> None:
+		self.file = file
+		self.sha1 = hashlib.sha1()
+		self.size = 0
+	def write(self, data):
+		self.sha1.update(data)
+		self.size += len(data)
+		return self.file.write(data)
+	def tell(self):
+		return self.file.tell()
+	def flush(self):
+		self.file.flush()
+	def digest(self):
+		return self.sha1.digest()
@@ -0,0 +1,95 @@
+from os import PathLike
+from typing import Iterator, NamedTuple, Optional
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+EVENT_STRUCT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+InotifyEvent = NamedTuple('InotifyEvent', [
+	('wd', int),
+	('mask', int),
+	('cookie', int),
+	# the name of the file in the watched directory, empty for events on the directory itself
+	('name', str)])
+
+_libc = None
+def get_libc():
+	global _libc
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		_libc.inotify_init1.argtypes = [ctypes.c_int]
+		_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+	return _libc
+
+def inotify_supported():
+	"""Checks if we can use inotify (Linux only)"""
+	if not sys.platform.startswith('linux'):
+		return False
+	try:
+		return hasattr(get_libc(), 'inotify_init1')
+	except OSError:
+		return False
+
+def check_errno(result: int):
+	if result < 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+	return result
+
+class Inotify():
+	"""A thin ctypes wrapper around a Linux inotify instance"""
+	def __init__(self) -> None:
+		self.libc = get_libc()
+		self.fd = check_errno(self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+	def add_watch(self, path: PathLike, mask: int):
+		"""Watches a path for events
+
+		Returns:
+			int: The watch descriptor, which events for this path will carry
+
+		Raises:
+			OSError: We couldn't add the watch, e.g. ENOSPC if we hit fs.inotify.max_user_watches
+		"""
+		return check_errno(self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+	def rm_watch(self, wd: int):
+		self.libc.inotify_rm_watch(self.fd, wd)
+	def read_events(self, timeout: Optional[float] = None) -> Iterator[InotifyEvent]:
+		"""Waits up to timeout seconds (None waits forever) for events, and reads everything waiting"""
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if len(readable) == 0:
+			return
+		while True:
+			try:
+				data = os.read(self.fd, READ_SIZE)
+			except BlockingIOError:
+				return
+			offset = 0
+			while offset < len(data):
+				wd, mask, cookie, length = EVENT_STRUCT.unpack_from(data, offset)
+				offset += EVENT_STRUCT.size
+				name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+				offset += length
+				yield InotifyEvent(wd, mask, cookie, name)
+	def close(self):
+		os.close(self.fd)
@@ -0,0 +1,59 @@
+from pathlib import Path
+from typing import Iterable, NamedTuple, Set
+from stat import S_ISREG
+from gitignore_parser.gitignore_parser import compile_gitignore
+import os
+
+FileMetadata = NamedTuple('FileMetadata', [('path', Path), ('size', int), ('mtime', float)])
+
+def get_all_file_metadata(root: Path, rel_to_root=True, find_diodeinclude=True, ignore_hidden=True, follow_links=True):
+	def file_to_metadata(dir_name: str, rel_dir: str, name: str):
+		stat = os.stat(os.path.join(dir_name, name))
+		path = Path(rel_dir, name) if rel_to_root else Path(dir_name, name).resolve()
+		return FileMetadata(path, stat.st_size, stat.st_mtime)
+	
+	metadata: Set[FileMetadata] = set()
+	matcher = get_diodeinclude_matcher(root) if find_diodeinclude else None
+	root_str = str(root)
+	for dir_name, dirs, files in os.walk(root, followlinks=follow_links):
+		rel_dir = dir_name[len(root_str) + 1:]
+		if ignore_hidden:
+			files = filter(lambda p: not p.startswith('.'), files)
+		if matcher is not None:
+			files = filter(lambda p: matcher.match(os.path.join(rel_dir, p)), files)
+			# don't even list directories that can't have anything we want in them
+			dirs[:] = [d for d in dirs if matcher.could_match_under(os.path.join(rel_dir, d))]
+		files_metadata = map(lambda p: file_to_metadata(dir_name, rel_dir, p), files)
+		metadata.update(files_metadata)
+	return metadata
+
+def get_file_metadata(root: Path, paths: Iterable[Path], rel_to_root=True, find_diodeinclude=True, ignore_hidden=True):
+	"""Like get_all_file_metadata, but only looks at the given paths (e.g. from a FolderWatcher) instead of walking the folder.
+	Paths that no longer exist, aren't files, or are filtered out are skipped"""
+	metadata: Set[FileMetadata] = set()
+	matcher = get_diodeinclude_matcher(root) if find_diodeinclude else None
+	for path in paths:
+		path = Path(path)
+		if ignore_hidden and path.name.startswith('.'):
+			continue
+		if matcher is not None and not matcher.match(str(path.relative_to(root))):
+			continue
+		try:
+			stat = path.stat()
+		except OSError:
+			continue
+		if not S_ISREG(stat.st_mode):
+			continue
+		metadata.add(FileMetadata(path.relative_to(root) if rel_to_root else path.resolve(), stat.st_size, stat.st_mtime))
+	return metadata
+
+def get_diodeinclude_matcher(root: Path):
+	"""Compiles the folder's .diodeinclude, if it has one
+
+	Returns:
+		Optional[GitignoreMatcher]: Matches paths relative to the folder
+	"""
+	diodeinclude_path = Path(root) / '.diodeinclude'
+	if diodeinclude_path.exists():
+		return compile_gitignore(diodeinclude_path)
+	return None
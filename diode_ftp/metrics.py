@@ -0,0 +1,129 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+import os
+import socketserver
+
+# the version of the Prometheus text format we write
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+Metric = NamedTuple('Metric', [
+	('name', str),
+	# counter, gauge or summary (for a summary, `value` returns (sum, count))
+	('kind', str),
+	('help', str),
+	('value', Callable[[], Any])])
+
+class MetricsRegistry():
+	"""The metrics to expose, read from their owners only when they are scraped.
+
+	The hot paths just bump plain int attributes (`self.frames_received += 1`), which costs next to nothing,
+	so metrics can stay on in production. The registry holds a function per metric that reads the attribute.
+	"""
+	def __init__(self) -> None:
+		self.metrics: List[Metric] = []
+		self.lock = Lock()
+	def add(self, name: str, kind: str, help: str, value: Callable[[], Any]):
+		"""Adds a metric
+
+		Args:
+			name (str): The metric's name, e.g. diode_receiver_frames_received_total
+			kind (str): counter, gauge or summary
+			help (str): What it measures
+			value (Callable[[], Any]): Reads its current value (for a summary, a (sum, count) tuple)
+		"""
+		with self.lock:
+			self.metrics.append(Metric(name, kind, help, value))
+	def add_stats(self, prefix: str, stats: Callable[[], Dict[str, Any]], help: str):
+		"""Exposes every number in a stats dict (e.g. ReceiveEngine.stats) as a gauge named `<prefix>_<key>`"""
+		keys = [key for key, value in stats().items() if isinstance(value, (int, float)) and not isinstance(value, bool)]
+		for key in keys:
+			self.add(f'{prefix}_{key}', 'gauge', f'{help}: {key}', lambda key=key: stats().get(key))
+	def render(self):
+		"""Writes every metric in the Prometheus text format
+
+		Returns:
+			str: The metrics
+		"""
+		with self.lock:
+			metrics = list(self.metrics)
+		lines = []
+		for metric in metrics:
+			try:
+				value = metric.value()
+			except Exception:
+				getLogger('metrics').exception(f'Could not read {metric.name}')
+				continue
+			if value is None:
+				continue
+			lines.append(f'# HELP {metric.name} {metric.help}')
+			lines.append(f'# TYPE {metric.name} {metric.kind}')
+			if metric.kind == 'summary':
+				total, count = value
+				lines.append(f'{metric.name}_sum {format_value(total)}')
+				lines.append(f'{metric.name}_count {format_value(count)}')
+			else:
+				lines.append(f'{metric.name} {format_value(value)}')
+		return '\n'.join(lines) + '\n'
+
+def format_value(value: Union[int, float]):
+	if isinstance(value, float):
+		return repr(value)
+	return str(int(value))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	registry: MetricsRegistry
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+		body = self.registry.render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', CONTENT_TYPE)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	def address_string(self):
+		# unix socket clients don't have an address
+		return str(self.client_address[0]) if isinstance(self.client_address, tuple) else 'unix'
+	def log_message(self, format: str, *args):
+		getLogger('metrics').debug(format % args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class MetricsServer():
+	"""Serves a registry's metrics over HTTP (at /metrics), on a local TCP port or a unix socket"""
+	def __init__(self, registry: MetricsRegistry, address: Union[Tuple[str, int], str]) -> None:
+		"""Starts serving on a background thread
+
+		Args:
+			registry (MetricsRegistry): The metrics to serve
+			address (Union[Tuple[str, int], str]): A (host, port) to listen on, or the path of a unix socket to create
+		"""
+		handler = type('Handler', (MetricsHandler,), {'registry': registry})
+		if isinstance(address, str):
+			if os.path.exists(address):
+				# left over from a previous run
+				os.unlink(address)
+			self.server: socketserver.BaseServer = UnixHTTPServer(address, handler)
+		else:
+			self.server = ThreadingHTTPServer(address, handler)
+		self.address = self.server.server_address
+		self.thread = Thread(target=self.server.serve_forever, daemon=True, name='metrics')
+		self.thread.start()
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if isinstance(self.address, str) and os.path.exists(self.address):
+			os.unlink(self.address)
+
+def parse_metrics_address(address: str) -> Union[Tuple[str, int], str]:
+	"""Parses a --metrics argument: `unix:<path>`, `<host>:<port>`, or just a port (on localhost)"""
+	if address.startswith('unix:'):
+		return address[len('unix:'):]
+	if ':' in address:
+		host, port = address.rsplit(':', 1)
+		return host, int(port)
+	return '127.0.0.1', int(address)
@@ -0,0 +1,61 @@
+from logging import Logger, getLogger
+import socket
+import sys
+import time
+
+# python doesn't expose this linux constant
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47 if sys.platform.startswith('linux') else None)
+MAX_PACING_RATE = 0xFFFFFFFF
+# sleeping for less than this is mostly timer overhead, so we let debt build up a little first
+MIN_SLEEP = 0.001
+
+class TokenBucket():
+	"""Paces sending to a byte rate with a token bucket.
+
+	The bucket fills at `rate` bytes per second, up to `burst` bytes. Sending takes tokens out,
+	and if that leaves the bucket in debt we sleep until it is paid off.
+	Because tokens are refilled from `time.monotonic`, time spent elsewhere (disk reads, logging, timer overshoot)
+	counts towards the budget instead of slowing us down, so the achieved rate stays on target.
+	"""
+	def __init__(self, rate: float, burst: int = 0) -> None:
+		"""Creates a token bucket
+
+		Args:
+			rate (float): The rate in bytes per second. 0 means unlimited
+			burst (int, optional): The most bytes we can send back to back after being idle.
+				Defaults to 0, which picks 20ms worth of data (at least 4 KiB).
+		"""
+		self.rate = rate
+		self.burst = burst if burst > 0 else max(int(rate / 50), 4096)
+		self.tokens = float(self.burst)
+		self.last = time.monotonic()
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+	def consume(self, nbytes: int):
+		"""Takes nbytes out of the bucket, sleeping if we are over budget"""
+		if self.rate == 0 or nbytes == 0:
+			return
+		self.refill()
+		self.tokens -= nbytes
+		if self.tokens < 0:
+			debt = -self.tokens / self.rate
+			if debt >= MIN_SLEEP:
+				time.sleep(debt)
+
+def set_kernel_pacing(sock: socket.socket, rate: float, log: Logger=getLogger('pacer')):
+	"""Asks the kernel to pace the socket with SO_MAX_PACING_RATE.
+	For UDP, this only has an effect if the interface uses the fq qdisc (`tc qdisc replace dev eth0 root fq`)
+
+	Returns:
+		bool: True if the kernel accepted the rate
+	"""
+	if SO_MAX_PACING_RATE is None or rate == 0:
+		return False
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, min(int(rate), MAX_PACING_RATE))
+		return True
+	except OSError as e:
+		log.warning(f'Could not set kernel pacing rate: {e}')
+		return False
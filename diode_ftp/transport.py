@@ -0,0 +1,183 @@
+from abc import ABC, abstractmethod
+from diode_ftp.header import HEADER_SIZE
+from os import PathLike
+from queue import Empty, Queue
+from typing import Any, BinaryIO, Iterator, Optional, Tuple, Union
+import asyncio
+import struct
+import time
+
+# capture files start with a magic number and version, followed by a record per datagram:
+# nanoseconds since the capture started, the datagram's length, then the datagram
+CAPTURE_MAGIC = b'DIODECAP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER_STRUCT = struct.Struct('!8sH')
+CAPTURE_RECORD_STRUCT = struct.Struct('!QI')
+# while replaying into a running receiver, wait if it has this many frames queued
+DEFAULT_MAX_BACKLOG = 4096
+
+class Transport(ABC):
+	"""Where a sender's datagrams go.
+
+	FolderSender (and BatchSender) send through anything with a socket-like `sendto`, so a UDP socket is the
+	default transport. The others let you sync without a network (QueueTransport), or record the traffic (CaptureTransport).
+	"""
+	@abstractmethod
+	def sendto(self, datagram: Union[bytes, bytearray, memoryview], address: Any) -> int:
+		"""Sends a datagram
+
+		Returns:
+			int: The number of bytes sent
+		"""
+	def close(self):
+		pass
+
+class QueueTransport(Transport):
+	"""An in-process link: datagrams are queued in memory, and delivered to a receiver in the same process with `deliver`.
+	Nothing is ever lost, which makes it handy for tests and for profiling the receiver on its own"""
+	def __init__(self, max_datagrams=0) -> None:
+		"""Creates an empty link
+
+		Args:
+			max_datagrams (int, optional): The most datagrams to queue. Sending blocks while it is full. Defaults to 0 (unlimited).
+		"""
+		self.queue: 'Queue[bytes]' = Queue(max_datagrams)
+	def sendto(self, datagram: Union[bytes, bytearray, memoryview], address: Any):
+		# the sender reuses its buffers, so we need our own copy
+		self.queue.put(bytes(datagram))
+		return len(datagram)
+	def deliver(self, receiver, timeout: Optional[float] = None):
+		"""Hands every queued datagram to a receiver (see `feed`)
+
+		Args:
+			receiver (FolderReceiver): The receiver to deliver to
+			timeout (Optional[float], optional): Wait up to this long for the first datagram. Defaults to None (don't wait).
+
+		Returns:
+			int: The number of datagrams delivered
+		"""
+		delivered = 0
+		try:
+			datagram = self.queue.get(timeout=timeout) if timeout is not None else self.queue.get_nowait()
+			while True:
+				feed(receiver, datagram)
+				delivered += 1
+				datagram = self.queue.get_nowait()
+		except Empty:
+			return delivered
+
+class CaptureWriter():
+	"""Records datagrams to a capture file, with the time each one was seen"""
+	def __init__(self, path: PathLike) -> None:
+		self.file: BinaryIO = open(path, 'wb')
+		self.file.write(CAPTURE_HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+		self.start = time.monotonic_ns()
+		self.count = 0
+	def write(self, datagram: Union[bytes, bytearray, memoryview]):
+		self.file.write(CAPTURE_RECORD_STRUCT.pack(time.monotonic_ns() - self.start, len(datagram)))
+		self.file.write(datagram)
+		self.count += 1
+	def close(self):
+		self.file.close()
+	def __enter__(self):
+		return self
+	def __exit__(self, exception_type, exception_value, exception_traceback):
+		self.close()
+
+class CaptureTransport(Transport):
+	"""Records everything a sender sends, and passes it on to another transport (if there is one)"""
+	def __init__(self, writer: CaptureWriter, inner: Optional[Any] = None) -> None:
+		"""Wraps a transport
+
+		Args:
+			writer (CaptureWriter): Where to record the datagrams
+			inner (Optional[Union[socket.socket, Transport]], optional): Where to send them. Defaults to None (only record them).
+		"""
+		self.writer = writer
+		self.inner = inner
+	def sendto(self, datagram: Union[bytes, bytearray, memoryview], address: Any):
+		self.writer.write(datagram)
+		if self.inner is not None:
+			self.inner.sendto(datagram, address)
+		return len(datagram)
+	def close(self):
+		self.writer.close()
+
+class CapturingProtocol(asyncio.DatagramProtocol):
+	"""Records everything that arrives on an asyncio endpoint, and passes it on to a receiver"""
+	def __init__(self, writer: CaptureWriter, receiver: asyncio.DatagramProtocol) -> None:
+		super().__init__()
+		self.writer = writer
+		self.receiver = receiver
+	def connection_made(self, transport) -> None:
+		self.receiver.connection_made(transport)
+	def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+		self.writer.write(data)
+		self.receiver.datagram_received(data, addr)
+
+def read_capture(path: PathLike) -> Iterator[Tuple[float, bytes]]:
+	"""Reads a capture file
+
+	Raises:
+		ValueError: It isn't a capture file (or it's from a newer version)
+
+	Returns:
+		Iterator[Tuple[float, bytes]]: Each datagram, and when it was seen (seconds since the capture started)
+	"""
+	with open(path, 'rb') as f:
+		header = f.read(CAPTURE_HEADER_STRUCT.size)
+		if len(header) < CAPTURE_HEADER_STRUCT.size:
+			raise ValueError(f'{path} is not a capture file')
+		magic, version = CAPTURE_HEADER_STRUCT.unpack(header)
+		if magic != CAPTURE_MAGIC or version > CAPTURE_VERSION:
+			raise ValueError(f'{path} is not a capture file we can read')
+		while True:
+			record = f.read(CAPTURE_RECORD_STRUCT.size)
+			if len(record) < CAPTURE_RECORD_STRUCT.size:
+				# a capture cut short by a crash ends with a torn record
+				return
+			timestamp, length = CAPTURE_RECORD_STRUCT.unpack(record)
+			datagram = f.read(length)
+			if len(datagram) < length:
+				return
+			yield timestamp / 1e9, datagram
+
+def feed(receiver, datagram: bytes):
+	"""Hands a datagram to a receiver. If its worker isn't running, the frame is handled right here"""
+	worker = getattr(receiver, 'worker', None)
+	if worker is not None and not worker.is_alive():
+		if len(datagram) >= HEADER_SIZE:
+			worker.handle_frame(memoryview(datagram))
+			receiver.state.idle()
+		return
+	receiver.datagram_received(datagram, ('replay', 0))
+
+def replay_capture(path: PathLike, receiver, speed: Optional[float] = None, max_backlog=DEFAULT_MAX_BACKLOG):
+	"""Replays a capture file into a receiver
+
+	Args:
+		path (PathLike): The capture file
+		receiver (Union[FolderReceiver, ShardedReceiver]): The receiver to replay into. If it is a FolderReceiver
+			created with `start_worker=False`, every frame is handled on this thread, which is handy for profiling
+		speed (Optional[float], optional): Replay at this multiple of the recorded speed (1.0 is as recorded).
+			Defaults to None, as fast as the receiver can take them.
+		max_backlog (int, optional): Wait while a running FolderReceiver has this many frames queued. Defaults to 4096.
+
+	Returns:
+		int: The number of datagrams replayed
+	"""
+	queue = getattr(receiver, 'queue', None)
+	start = time.monotonic()
+	replayed = 0
+	for timestamp, datagram in read_capture(path):
+		if speed is not None:
+			delay = start + timestamp / speed - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		elif queue is not None and hasattr(queue, 'qsize'):
+			# don't run ahead of the receiver, or its queue grows without bound
+			while queue.qsize() >= max_backlog:
+				time.sleep(0.001)
+		feed(receiver, datagram)
+		replayed += 1
+	return replayed
@@ -35,6 +35,92 @@ def parse_gitignore(full_path, base_dir=None):
         # Later rules override earlier rules.
         return lambda file_path: handle_negation(file_path, rules)
 
+def compile_gitignore(full_path):
+    """
+    Parse a .gitignore file into a GitignoreMatcher, which matches paths
+    relative to the file's directory without touching the filesystem.
+    """
+    rules = []
+    with open(full_path) as ignore_file:
+        counter = 0
+        for line in ignore_file:
+            counter += 1
+            rule = rule_from_pattern(line.rstrip('\n'), source=(full_path, counter))
+            if rule:
+                rules.append(rule)
+    return GitignoreMatcher(rules)
+
+
+class GitignoreMatcher(object):
+    """
+    A set of rules compiled into as few regexes as possible.
+
+    Without negations, the whole rule set is a single regex. With them,
+    later rules override earlier ones, so consecutive rules with the same
+    negation are compiled into one regex each, and checked last to first.
+
+    Paths are relative to the directory of the .gitignore, with os.sep as
+    the separator. Like git, a rule that matches a directory also matches
+    everything under it.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.groups = []
+        for rule in self.rules:
+            if self.groups and self.groups[-1][0] == rule.negation:
+                self.groups[-1][1].append(rule)
+            else:
+                self.groups.append((rule.negation, [rule]))
+        self.compiled = [
+            (negation, re.compile(''.join(
+                ['(?s)(?:', '|'.join(rule_to_path_regex(r) for r in group), ')'])))
+            for negation, group in self.groups
+        ]
+        self.positive = [rule for rule in self.rules if not rule.negation]
+
+    def __call__(self, rel_path):
+        return self.match(rel_path)
+
+    def match(self, rel_path):
+        for negation, regex in reversed(self.compiled):
+            if regex.fullmatch(rel_path):
+                return not negation
+        return False
+
+    def could_match_under(self, rel_dir):
+        """
+        Check if any path under a directory could match, so walks can skip
+        directories that can't. Only rules tied to the base directory (with
+        a slash in them) can rule a directory out.
+        """
+        parts = [part for part in rel_dir.split(os.sep) if part]
+        return any(rule_could_match_under(rule, parts) for rule in self.positive)
+
+
+def rule_to_path_regex(rule):
+    body = fnmatch_pathname_to_regex(rule.glob, True)[len('(?ms)'):]
+    sep = re.escape(os.sep)
+    # a matched directory matches everything beneath it
+    below = ''.join([sep, '.*']) if rule.directory_only else ''.join(['(?:', sep, '.*)?'])
+    prefix = '' if rule.anchored else ''.join(['(?:.*', sep, ')?'])
+    return ''.join([prefix, body, below])
+
+
+def rule_could_match_under(rule, dir_parts):
+    if not rule.anchored:
+        return True
+    glob_parts = rule.glob.split('/')
+    for i, part in enumerate(dir_parts):
+        if i >= len(glob_parts):
+            # the directory is under a directory the rule matches
+            return True
+        if '**' in glob_parts[i]:
+            return True
+        if not re.fullmatch(fnmatch_pathname_to_regex(glob_parts[i], True)[len('(?ms)'):], part, re.S):
+            return False
+    return True
+
+
 def rule_from_pattern(pattern, base_path=None, source=None):
     """
     Take a .gitignore match pattern, such as "*.py[cod]" or "**/*.bak",
@@ -107,6 +193,7 @@ def rule_from_pattern(pattern, base_path=None, source=None):
         regex = ''.join(['^', regex])
     return IgnoreRule(
         pattern=orig_pattern,
+        glob=pattern,
         regex=regex,
         negation=negation,
         directory_only=directory_only,
@@ -118,7 +205,7 @@ def rule_from_pattern(pattern, base_path=None, source=None):
 whitespace_re = re.compile(r'(\\ )+$')
 
 IGNORE_RULE_FIELDS = [
-    'pattern', 'regex',  # Basic values
+    'pattern', 'glob', 'regex',  # Basic values
     'negation', 'directory_only', 'anchored',  # Behavior flags
     'base_path',  # Meaningful for gitignore-style behavior
     'source'  # (file, line) tuple for reporting
@@ -3,9 +3,11 @@ from diode_ftp.FolderReceiver import FolderReceiver
 from diode_ftp.header import hash_file
 from diode_ftp.FolderSender import FolderSender
 from pathlib import Path
+from typing import Callable
 import os
 import threading
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 
@@ -22,6 +24,22 @@ def create_big_file(path: os.PathLike, kilobytes: int):
 			contents = os.urandom(1024)
 			file.write(contents)
 
+def hash_if_exists(path: os.PathLike):
+	"""Hashes a file the receiver may not have written yet (None if it hasn't)"""
+	return hash_file(path) if Path(path).exists() else None
+
+def wait_until(check: Callable[[], None], timeout=60.0, interval=0.05):
+	"""Runs `check` until its asserts pass, e.g. to wait for a background sync to finish.
+	Once the timeout is up, its AssertionError is raised. Any other error is raised straight away"""
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			return check()
+		except AssertionError:
+			if time.monotonic() >= deadline:
+				raise
+		time.sleep(interval)
+
 def get_available_port():
 	global TEST_PORT_START
 	port = TEST_PORT_START
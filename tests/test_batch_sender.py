@@ -0,0 +1,36 @@
+from diode_ftp.BatchSender import BatchSender
+import os
+import socket
+
+def receive_all(rcv: socket.socket):
+	datagrams = []
+	try:
+		while True:
+			datagrams.append(rcv.recv(65536))
+	except socket.timeout:
+		return datagrams
+
+def check_batch_sender(use_gso: bool):
+	rcv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	rcv.bind(('127.0.0.1', 0))
+	rcv.settimeout(0.5)
+	send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sender = BatchSender(send, rcv.getsockname(), use_gso=use_gso, max_segments=8)
+
+	chunks = [os.urandom(100) for _ in range(20)] + [os.urandom(30)] + [os.urandom(200)]
+	sent = sum(sender.send(chunk) for chunk in chunks) + sender.flush()
+	assert sent == sum(len(chunk) for chunk in chunks)
+	# every chunk should arrive as its own datagram, whether or not GSO batched them
+	assert receive_all(rcv) == chunks
+	rcv.close()
+	send.close()
+	return sender
+
+def test_batch_sender_gso():
+	sender = check_batch_sender(True)
+	if sender.use_gso:
+		assert sender.syscalls < 22
+
+def test_batch_sender_fallback():
+	sender = check_batch_sender(False)
+	assert sender.syscalls == 22
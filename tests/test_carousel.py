@@ -0,0 +1,97 @@
+from diode_ftp.Carousel import Carousel
+from diode_ftp.FileChunker import FileChunker
+from diode_ftp.pacer import TokenBucket
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+import time
+
+class ListSender():
+	def __init__(self) -> None:
+		self.sent = []
+	def send(self, chunk):
+		self.sent.append(bytes(chunk))
+		return len(chunk)
+	def flush(self):
+		return 0
+
+def make_tar(tmp_path: Path, name: str, kilobytes=1):
+	path = tmp_path / name
+	create_big_file(path, kilobytes)
+	return path, hash_file(path)
+
+def test_eviction(tmp_path: Path):
+	carousel = Carousel(max_bytes=3 * 1024, max_transfers=2, directory=tmp_path / 'carousel')
+	tars = [make_tar(tmp_path, f'{i}.tar') for i in range(3)]
+	for i, (path, tar_hash) in enumerate(tars):
+		carousel.add(path, tar_hash, [Path(f'file{i}')])
+		assert not path.exists(), 'The tar should be moved into the carousel'
+	# only the newest 2 fit
+	assert [e.hash for e in carousel.entries] == [tars[1][1], tars[2][1]]
+	assert len(list((tmp_path / 'carousel').iterdir())) == 2
+	# too many bytes
+	path, tar_hash = make_tar(tmp_path, 'big.tar', 3)
+	carousel.add(path, tar_hash, [Path('big')])
+	assert [e.hash for e in carousel.entries] == [tar_hash]
+	# too old
+	carousel.evict(time.time() + carousel.max_age + 1)
+	assert len(carousel.entries) == 0
+
+def test_superseded(tmp_path: Path):
+	carousel = Carousel(directory=tmp_path / 'carousel')
+	old_path, old_hash = make_tar(tmp_path, 'old.tar')
+	carousel.add(old_path, old_hash, [Path('a'), Path('b')])
+	new_path, new_hash = make_tar(tmp_path, 'new.tar')
+	carousel.add(new_path, new_hash, [Path('b')])
+	# a receiver that missed the old tar must not get the old version of b after the new one
+	assert [e.hash for e in carousel.entries] == [new_hash]
+
+def test_rebroadcast_cycles(tmp_path: Path):
+	carousel = Carousel(directory=tmp_path / 'carousel')
+	tars = [make_tar(tmp_path, f'{i}.tar') for i in range(2)]
+	for i, (path, tar_hash) in enumerate(tars):
+		carousel.add(path, tar_hash, [Path(f'file{i}')])
+	get_chunker = lambda path, tar_hash, size: FileChunker(path, chunk_size=148, file_hash=tar_hash, file_size=size)
+	chunks_per_tar = get_chunker(*carousel.entries[0][:3]).total_chunks
+	sender = ListSender()
+	while len(sender.sent) < chunks_per_tar * 4:
+		sender.sent.append(bytes(carousel.next_chunk(get_chunker)))
+	# the newest tar first, then the older one, then around again
+	hashes = [chunk[:20] for chunk in sender.sent[:chunks_per_tar * 4:chunks_per_tar]]
+	assert hashes == [tars[1][1], tars[0][1], tars[1][1], tars[0][1]]
+	sent = carousel.rebroadcast(sender, TokenBucket(0), 0.01, get_chunker)
+	assert sent > 0
+	carousel.close()
+
+def test_rebroadcast_recovers_lost_transfer(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	port = get_available_port()
+	receiver = FolderReceiver(rcv)
+	engine = receiver.start_engine(('127.0.0.1', port))
+	# as if every chunk of the original transfer was lost
+	sender = FolderSender(send, send_to=('127.0.0.1', port), max_bytes_per_second=2000000, transmit_repeats=0,
+		carousel=Carousel(directory=tmp_path / 'carousel'))
+	sender.perform_sync()
+	assert not (rcv / 'payload.txt').exists()
+	def rebroadcast():
+		sender.idle(0.1)
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+	wait_until(rebroadcast)
+	engine.stop()
+
+def test_close(tmp_path: Path):
+	carousel = Carousel()
+	path, tar_hash = make_tar(tmp_path, 'a.tar')
+	carousel.add(path, tar_hash, [Path('a')])
+	carousel.close()
+	# the temporary directory (and the tar in it) is gone
+	assert not carousel.dir.exists()
+
+	given = tmp_path / 'carousel'
+	carousel = Carousel(directory=given)
+	path, tar_hash = make_tar(tmp_path, 'b.tar')
+	carousel.add(path, tar_hash, [Path('b')])
+	carousel.close()
+	# a directory we were given is left, but emptied
+	assert given.is_dir() and list(given.iterdir()) == []
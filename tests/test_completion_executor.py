@@ -0,0 +1,63 @@
+from diode_ftp.CompletionExecutor import CompletionExecutor
+from threading import Event, Thread
+import time
+
+def test_same_paths_in_order():
+	executor = CompletionExecutor(workers=4)
+	applied = []
+	def job(i: int):
+		def prepare():
+			# the later jobs finish preparing first
+			time.sleep(0.05 * (3 - i))
+			return ['a.txt']
+		return prepare, lambda: applied.append(i)
+	for i in range(4):
+		executor.submit(*job(i))
+	executor.wait()
+	assert applied == [0, 1, 2, 3]
+	executor.shutdown()
+
+def test_other_paths_in_parallel():
+	executor = CompletionExecutor(workers=2)
+	release = Event()
+	applied = []
+	executor.submit(lambda: ['big/'], lambda: release.wait(5) and applied.append('big'))
+	executor.submit(lambda: ['small.txt'], lambda: applied.append('small'))
+	start = time.monotonic()
+	while 'small' not in applied and time.monotonic() - start < 5:
+		time.sleep(0.01)
+	# the small tar didn't wait for the big one
+	assert applied == ['small']
+	assert executor.pending == 1
+	release.set()
+	executor.wait()
+	assert applied == ['small', 'big']
+	executor.shutdown()
+
+def test_failures_dont_block_later_jobs():
+	executor = CompletionExecutor(workers=1)
+	applied = []
+	def fail():
+		raise OSError('corrupt tar')
+	executor.submit(fail, lambda: applied.append('never'))
+	executor.submit(lambda: ['a.txt'], lambda: applied.append('ok'))
+	executor.wait()
+	assert applied == ['ok']
+	assert executor.failed == 1 and executor.completed == 1
+	executor.shutdown()
+
+def test_submit_blocks_when_full():
+	executor = CompletionExecutor(workers=1, max_pending=2)
+	release = Event()
+	executor.submit(lambda: ['a.txt'], lambda: release.wait(5))
+	executor.submit(lambda: ['b.txt'], lambda: None)
+	submitted = Event()
+	Thread(target=lambda: executor.submit(lambda: ['c.txt'], submitted.set), daemon=True).start()
+	time.sleep(0.1)
+	# the third job has to wait for a slot
+	assert executor.pending == 2 and not submitted.is_set()
+	release.set()
+	assert submitted.wait(5)
+	executor.wait()
+	assert executor.completed == 3
+	executor.shutdown()
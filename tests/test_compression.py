@@ -0,0 +1,52 @@
+from diode_ftp.header import hash_file
+from diode_ftp.compression import COMPRESSED_PREFIX, Compressor, extract_compressed, is_compressed_member
+from diode_ftp.transport import QueueTransport
+from diode_ftp.FolderSender import FolderSender, get_all_file_metadata, tarball_files
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder, do_sync_in_bkgd
+import tarfile
+
+def test_incompressible_files_are_skipped(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	# random data won't compress, like a video or a JPEG
+	create_big_file(send / 'random.bin', 128)
+	compressor = Compressor('lzma', workers=0)
+	files = get_all_file_metadata(send)
+	tarball = tarball_files({lambda p: (send / p, str(p)): files}, tar_dir=tmp_path, compressor=compressor)
+	assert tarball.included == files
+	assert compressor.stats.files_compressed == 1
+	assert compressor.stats.files_skipped == 1
+	assert compressor.stats.bytes_saved > 0
+
+	with tarfile.open(tarball.path) as tar:
+		names = tar.getnames()
+		assert f'{COMPRESSED_PREFIX}lzma/payload.txt' in names
+		assert 'random.bin' in names
+		tar.extractall(rcv, members=[m for m in tar.getmembers() if not is_compressed_member(m)])
+		for member in tar.getmembers():
+			if is_compressed_member(member):
+				extract_compressed(tar, member, rcv)
+	assert hash_file(rcv / 'payload.txt') == PAYLOAD_HASH
+	assert (rcv / 'payload.txt').stat().st_mtime == int((send / 'payload.txt').stat().st_mtime)
+
+def test_folder_sync_compressed(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	do_sync_in_bkgd(send, rcv, compressor=Compressor('zlib', workers=2))
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
+
+def test_sender_close_stops_workers(tmp_path: Path):
+	send, _ = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	compressor = Compressor('zlib', workers=1)
+	sender = FolderSender(send, send_to=('diode', 0), transmit_socket=QueueTransport(), max_bytes_per_second=0, compressor=compressor)
+	sender.perform_sync()
+	assert compressor.pool is not None
+	sender.close()
+	assert compressor.pool is None
@@ -0,0 +1,92 @@
+from diode_ftp.header import hash_file
+from diode_ftp.dedup import BlockIndex, BlockStore, block_hash, is_dedup_member, iter_blocks, restore_deduplicated
+from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.FolderSender import FolderSender, get_all_file_metadata, tarball_files
+from diode_ftp.TransferScheduler import TransferScheduler
+from diode_ftp.transport import QueueTransport
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder, do_sync_in_bkgd
+import tarfile
+import time
+
+def receive_tarball(tar_path: Path, rcv: Path, store: BlockStore):
+	with tarfile.open(tar_path) as tarball:
+		tarball.extractall(rcv, members=[m for m in tarball.getmembers() if not is_dedup_member(m)])
+		restore_deduplicated(tarball, rcv, store)
+
+def test_only_changed_blocks_are_sent(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	create_big_file(send / 'data.bin', 512)
+	index = BlockIndex(tmp_path / 'index')
+	store = BlockStore(rcv)
+
+	files = get_all_file_metadata(send)
+	first = tarball_files({lambda p: (send / p, str(p)): files}, tar_dir=tmp_path, block_index=index)
+	index.commit()
+	receive_tarball(first.path, rcv, store)
+	assert hash_file(rcv / 'data.bin') == hash_file(send / 'data.bin')
+
+	# insert some bytes in the middle of the file, which shifts everything after them
+	data = (send / 'data.bin').read_bytes()
+	(send / 'data.bin').write_bytes(data[:200000] + b'an edit' + data[200000:])
+	files = get_all_file_metadata(send)
+	second = tarball_files({lambda p: (send / p, str(p)): files}, tar_dir=tmp_path, block_index=index)
+	index.commit()
+	assert second.size < first.size / 4, 'Only the blocks around the edit should be sent again'
+	receive_tarball(second.path, rcv, store)
+	assert hash_file(rcv / 'data.bin') == hash_file(send / 'data.bin')
+
+def test_folder_sync_dedup(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	create_big_file(send / 'data.bin', 256)
+	# a duplicate file shouldn't need any of its blocks sent
+	copy2(send / 'data.bin', send / 'copy.bin')
+	data_hash = hash_file(send / 'data.bin')
+	do_sync_in_bkgd(send, rcv, max_bytes_per_second=2000000, dedup=True)
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'data.bin') == data_hash, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'copy.bin') == data_hash, "File hashes should be the same"
+	wait_until(synced)
+
+def test_blocks_are_staged_per_tar(tmp_path: Path):
+	index = BlockIndex(tmp_path / 'index')
+	index.stage({b'a' * 20}, key=1)
+	index.stage({b'b' * 20}, key=2)
+	# the second tar was sent first
+	index.commit(2)
+	assert b'b' * 20 in index and b'a' * 20 not in index
+	index.commit(1)
+	assert b'a' * 20 in index
+
+def test_blocks_expire(tmp_path: Path):
+	index = BlockIndex(tmp_path / 'index', max_age=0.1)
+	index.stage({b'a' * 20})
+	index.commit()
+	assert b'a' * 20 in index
+	time.sleep(0.2)
+	# the tar that carried it may have been lost, so it's sent again
+	assert b'a' * 20 not in index
+
+def test_scheduled_tars_commit_their_blocks(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	create_big_file(send / 'a.bin', 128)
+	create_big_file(send / 'b.bin', 128)
+	link = QueueTransport()
+	# one transfer per file, sent interleaved
+	sender = FolderSender(send, send_to=('diode', 0), transmit_socket=link, max_bytes_per_second=0, dedup=True,
+		scheduler=TransferScheduler(send, max_transfer_size=1, time_slice=None))
+	sender.perform_sync()
+	assert not sender.has_pending_transfers()
+	index = sender.block_index
+	assert len(index.pending) == 0
+	for name in ('a.bin', 'b.bin'):
+		with open(send / name, 'rb') as f:
+			assert all(block_hash(block) in index for block in iter_blocks(f)), f'Every block of {name} should be committed'
+	receiver = FolderReceiver(rcv, start_worker=False)
+	link.deliver(receiver)
+	receiver.completions.wait()
+	assert hash_file(rcv / 'a.bin') == hash_file(send / 'a.bin')
+	assert hash_file(rcv / 'b.bin') == hash_file(send / 'b.bin')
@@ -0,0 +1,38 @@
+from diode_ftp.metadata import get_all_file_metadata, get_diodeinclude_matcher
+from tests.common import *
+import os
+
+def make_matcher(tmp_path: Path, rules: str):
+	(tmp_path / '.diodeinclude').write_text(rules)
+	return get_diodeinclude_matcher(tmp_path)
+
+def test_matching(tmp_path: Path):
+	matcher = make_matcher(tmp_path, '*.md\ndata/*.csv\nlogs/\n!logs/debug.log\n')
+	assert matcher.match('README.md')
+	assert matcher.match(os.path.join('docs', 'deep', 'notes.md'))
+	# anchored rules only match from the folder root
+	assert matcher.match(os.path.join('data', 'a.csv'))
+	assert not matcher.match(os.path.join('data', 'sub', 'a.csv'))
+	assert not matcher.match(os.path.join('other', 'data', 'a.csv'))
+	# a directory rule takes everything under it, except what a later rule negates
+	assert matcher.match(os.path.join('logs', 'today', 'app.log'))
+	assert not matcher.match(os.path.join('logs', 'debug.log'))
+	assert not matcher.match('payload.txt')
+
+def test_pruning(tmp_path: Path):
+	matcher = make_matcher(tmp_path, 'data/*.csv\nimages/**/*.png\n')
+	assert matcher.could_match_under('data')
+	assert not matcher.could_match_under(os.path.join('data', 'sub'))
+	assert not matcher.could_match_under('other')
+	assert matcher.could_match_under(os.path.join('images', 'a', 'b'))
+	# unanchored rules could match anywhere
+	matcher = make_matcher(tmp_path, 'data/*.csv\n*.md\n')
+	assert matcher.could_match_under('other')
+
+def test_walk_with_diodeinclude(tmp_path: Path):
+	for rel in ['data/a.csv', 'data/b.txt', 'data/sub/c.csv', 'other/d.csv', 'top.csv']:
+		(tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+		(tmp_path / rel).write_text(rel)
+	(tmp_path / '.diodeinclude').write_text('data/*.csv\n')
+	paths = {f.path for f in get_all_file_metadata(tmp_path)}
+	assert paths == {Path('data/a.csv')}
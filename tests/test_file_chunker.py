@@ -1,5 +1,6 @@
 from tests.common import *
-from diode_ftp.header import hash_file
+from diode_ftp.header import MANIFEST_INDEX, STREAM_TOTAL, hash_file, parse_header
+from diode_ftp.StreamingChunker import StreamingChunker
 from diode_ftp import FileChunker, FileReassembler, HEADER_SIZE
 from pathlib import Path
 import random
@@ -57,4 +58,94 @@ def test_large_file(tmp_path: Path):
 			if i % 100 == 0:
 				print(f'Sent {i} chunks')
 			reassembler.accept_chunk(chunk, check_for_complete=False)
-	assert BIG_HASH == hash_file(copy), "File hashes should be the same"
\ No newline at end of file
+	assert BIG_HASH == hash_file(copy), "File hashes should be the same"
+
+def test_fec_recovers_lost_chunks(tmp_path: Path):
+	chunker = FileChunker(BIG_FILE, chunk_size=HEADER_SIZE + 100, fec_repairs=3, fec_block_size=8)
+	copy = tmp_path / 'big.bin'
+	def get_file_by_hash(hash: bytes):
+		return copy
+
+	reassembler = FileReassembler(get_file_by_hash)
+	with chunker.chunk_iterator() as chunk_it:
+		chunks = list(chunk_it)
+	assert len(chunks) == chunker.total_frames
+	data_chunks = {parse_header(chunk[:HEADER_SIZE]).index: chunk for chunk in chunks}
+	# lose 3 chunks of every block, including the short last chunk
+	lost = set()
+	for block_start in range(0, chunker.total_chunks, 8):
+		block = list(range(block_start, min(block_start + 8, chunker.total_chunks)))
+		if block[-1] == chunker.total_chunks - 1:
+			lost.add(block.pop())
+			lost.update(random.sample(block, 2))
+		else:
+			lost.update(random.sample(block, 3))
+	transmit = [chunk for i, chunk in data_chunks.items() if i not in lost]
+	random.shuffle(transmit)
+	for chunk in transmit:
+		reassembler.accept_chunk(chunk, check_for_complete=False)
+
+	assert BIG_HASH == hash_file(copy), "File hashes should be the same"
+	assert not Path(str(copy) + '.fec').exists(), "Repair chunks should be cleaned up"
+
+def test_duplicate_chunks(tmp_path: Path):
+	chunker = FileChunker(PAYLOAD, chunk_size=1024)
+	reassembled = tmp_path / 'payload_reassembled.txt'
+	reassembler = FileReassembler(lambda hash: reassembled)
+	with chunker.chunk_iterator() as chunk_it:
+		chunks = list(chunk_it)
+	transmit = chunks + chunks
+	random.shuffle(transmit)
+	completions = [reassembler.accept_chunk(chunk) for chunk in transmit]
+	assert completions.count(True) == 1, "The file should complete exactly once"
+	assert hash_file(PAYLOAD) == hash_file(reassembled), "File hashes should be the same"
+
+	# chunks for a completed file should not be written again
+	reassembled.write_bytes(b'overwritten')
+	assert not reassembler.accept_chunk(chunks[0])
+	assert reassembled.read_bytes() == b'overwritten'
+
+def test_out_of_order(tmp_path: Path):
+	chunker = FileChunker(BIG_FILE, chunk_size=1024)
+	copy = tmp_path / 'big.bin'
+	reassembler = FileReassembler(lambda hash: copy, max_open_files=1)
+	with chunker.chunk_iterator() as chunk_it:
+		chunks = list(chunk_it)
+	# the last chunk arriving first should not leave the file too big (or too small)
+	for chunk in reversed(chunks):
+		reassembler.accept_chunk(chunk, check_for_complete=False)
+	assert copy.stat().st_size == BIG_FILE.stat().st_size
+	assert BIG_HASH == hash_file(copy), "File hashes should be the same"
+
+def test_zero_copy(tmp_path: Path):
+	chunker = FileChunker(BIG_FILE, chunk_size=1000, fec_repairs=2, fec_block_size=4)
+	with chunker.chunk_iterator() as chunk_it:
+		expected = list(chunk_it)
+	with chunker.chunk_iterator(zero_copy=True) as chunk_it:
+		# the chunks share a buffer, so we have to copy them as we go
+		chunks = [bytes(chunk) for chunk in chunk_it]
+	assert chunks == expected
+
+def test_streaming_chunker():
+	payload = Path(PAYLOAD).read_bytes()
+	chunker = StreamingChunker(lambda f: f.write(payload), chunk_size=1024, repeats=2, repeat_delay=4)
+	with chunker.chunk_iterator() as chunk_it:
+		chunks = list(chunk_it)
+	data = {}
+	manifests = []
+	for chunk in chunks:
+		header = parse_header(chunk[:HEADER_SIZE])
+		assert header.hash == chunker.transfer_id
+		if header.index == MANIFEST_INDEX:
+			manifests.append((header, chunk[HEADER_SIZE:]))
+		else:
+			assert header.total == STREAM_TOTAL
+			data.setdefault(header.index, []).append((header.offset, chunk[HEADER_SIZE:]))
+	# every chunk is sent twice, and the manifest tells us how to check the stream
+	assert all(len(copies) == 2 for copies in data.values())
+	assert len(manifests) == 3
+	header, stream_hash = manifests[0]
+	assert header.total == len(data)
+	assert header.offset == len(payload)
+	assert stream_hash == PAYLOAD_HASH
+	assert b''.join(copies[0][1] for _, copies in sorted(data.items())) == payload
@@ -1,11 +1,11 @@
-from diode_ftp.header import hash_file
-from diode_ftp.FolderSender import FolderSender
+from diode_ftp.header import HEADER_SIZE, MANIFEST_INDEX, hash_file, parse_header
+from diode_ftp.FolderSender import FolderSender, get_all_file_metadata, tarball_files
 from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.transport import QueueTransport, feed
 from pathlib import Path
 from shutil import Error, copy2
 from tests.common import *
 import asyncio
-import time
 
 def create_send_rcv_folder(root: Path):
 	send = root / 'send'
@@ -15,9 +15,9 @@ def create_send_rcv_folder(root: Path):
 	print(send, rcv)
 	return send, rcv
 
-def do_sync_in_bkgd(send: Path, rcv: Path):
+def do_sync_in_bkgd(send: Path, rcv: Path, **sender_kwargs):
 	port = get_available_port()
-	sender = FolderSender(send, send_to=('127.0.0.1', port))
+	sender = FolderSender(send, send_to=('127.0.0.1', port), **sender_kwargs)
 	receiver = FolderReceiver(rcv)
 
 	def sender_thread():
@@ -35,23 +35,26 @@ def do_sync_in_bkgd(send: Path, rcv: Path):
 	send_proc.start()
 	rcv_proc.start()
 
+def test_tarball_hash(tmp_path: Path):
+	send, _ = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	files = get_all_file_metadata(send)
+	tarball = tarball_files({lambda p: (send / p, str(p)): files}, tar_dir=tmp_path)
+	assert tarball.included == files
+	# the hash computed while writing should match hashing the file afterwards
+	assert tarball.hash == hash_file(tarball.path)
+	assert tarball.size == tarball.path.stat().st_size
+
 def test_folder_sync(tmp_path: Path):
 	send, rcv = create_send_rcv_folder(tmp_path)
 	copy2(PAYLOAD, send / 'payload.txt')
 	copy2(BIG_FILE, send / 'big.bin')
 	do_sync_in_bkgd(send, rcv)
-	start = time.monotonic()
-	while time.monotonic() - start < 60:
-		# give it up to 60 seconds to sync
-		try:
-			assert hash_file(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
-			assert hash_file(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
-			return
-		except Exception as e:
-			pass
-			# print('Could not check hashes because of: ', e)
-		
-	assert False, "timeout for the folder sync to complete"
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
 
 def test_diodeinclude(tmp_path: Path):
 	send, rcv = create_send_rcv_folder(tmp_path)
@@ -61,15 +64,63 @@ def test_diodeinclude(tmp_path: Path):
 	(send / '.diodeinclude').write_text('*.md')
 	
 	do_sync_in_bkgd(send, rcv)
-	start = time.monotonic()
-	while time.monotonic() - start < 60:
-		# give it up to 60 seconds to sync
-		try:
-			assert hash_file(rcv / 'payload.md') == PAYLOAD_HASH, "File hashes should be the same"
-			assert not (rcv / 'payload.txt').exists(), "We should not send *.txt files"
-			return
-		except Exception as e:
-			pass
-			# print('Could not check hashes because of: ', e)
-		
-	assert False, "timeout for the folder sync to complete"
\ No newline at end of file
+	def synced():
+		assert hash_if_exists(rcv / 'payload.md') == PAYLOAD_HASH, "File hashes should be the same"
+	wait_until(synced)
+	assert not (rcv / 'payload.txt').exists(), "We should not send *.txt files"
+
+def test_folder_sync_fec(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(BIG_FILE, send / 'big.bin')
+	do_sync_in_bkgd(send, rcv, transmit_repeats=1, fec_repairs=4, fec_block_size=16)
+	def synced():
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
+
+def test_folder_sync_engine(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	port = get_available_port()
+	receiver = FolderReceiver(rcv)
+	engine = receiver.start_engine(('127.0.0.1', port), pool_size=64)
+	sender = FolderSender(send, send_to=('127.0.0.1', port), max_bytes_per_second=0, batch_send=True)
+	threading.Thread(target=sender.perform_sync, daemon=True).start()
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
+	assert engine.stats()['frames_received'] > 0
+	engine.stop()
+
+def test_folder_sync_streaming(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	do_sync_in_bkgd(send, rcv, streaming=True, stream_repeat_delay=16)
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
+
+def test_folder_sync_streaming_manifest_first(tmp_path: Path, caplog):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	link = QueueTransport()
+	FolderSender(send, send_to=('diode', 0), transmit_socket=link, max_bytes_per_second=0,
+		transmit_repeats=1, streaming=True).perform_sync()
+	datagrams = []
+	while not link.queue.empty():
+		datagrams.append(link.queue.get_nowait())
+	# deliver the manifest before any of the stream's chunks
+	manifests = [d for d in datagrams if parse_header(d[:HEADER_SIZE]).index == MANIFEST_INDEX]
+	assert len(manifests) > 0
+	receiver = FolderReceiver(rcv, start_worker=False)
+	for datagram in manifests + [d for d in datagrams if d not in manifests]:
+		feed(receiver, datagram)
+	receiver.completions.wait()
+	# the stream is checked against the hash in its manifest, not its transfer ID
+	assert 'HASHES DO NOT MATCH' not in caplog.text
+	assert hash_file(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+	assert hash_file(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
@@ -0,0 +1,37 @@
+from diode_ftp.FolderSender import get_file_metadata
+from diode_ftp.FolderWatcher import FolderWatcher
+from diode_ftp.inotify import inotify_supported
+from tests.common import *
+import pytest
+import time
+
+pytestmark = pytest.mark.skipif(not inotify_supported(), reason='inotify is Linux only')
+
+def test_watcher_collects_changes(tmp_path: Path):
+	(tmp_path / 'old.txt').write_text('old')
+	watcher = FolderWatcher(tmp_path, settle=0.2)
+	# the first sync is a full scan
+	assert watcher.wait_for_changes() is None
+
+	(tmp_path / 'new.txt').write_text('new')
+	(tmp_path / '.hidden').write_text('hidden')
+	# files in new folders are picked up, even if they were written before we could watch the folder
+	(tmp_path / 'sub').mkdir()
+	(tmp_path / 'sub' / 'nested.txt').write_text('nested')
+	start = time.monotonic()
+	changed = watcher.wait_for_changes()
+	assert time.monotonic() - start >= 0.2, 'We should wait for the files to settle'
+	assert changed == {tmp_path.resolve() / 'new.txt', tmp_path.resolve() / 'sub' / 'nested.txt'}
+
+	metadata = get_file_metadata(tmp_path.resolve(), changed)
+	assert {m.path for m in metadata} == {Path('new.txt'), Path('sub') / 'nested.txt'}
+	watcher.close()
+
+def test_watcher_rescans(tmp_path: Path):
+	watcher = FolderWatcher(tmp_path, settle=0.1, rescan_interval=0.3)
+	assert watcher.wait_for_changes() is None
+	# giving up early returns no changes
+	assert watcher.wait_for_changes(0.05) == set()
+	# nothing changed, so the next thing that happens is the periodic rescan
+	assert watcher.wait_for_changes() is None
+	watcher.close()
@@ -0,0 +1,55 @@
+from diode_ftp.bench import TrialConfig, run_benchmark
+from diode_ftp.LossyLink import GilbertElliott, LossyLink, make_impairments
+from tests.common import *
+import json
+import random
+import socket
+import time
+
+def test_gilbert_elliott_bursts():
+	model = GilbertElliott(0.01, 0.25, rng=random.Random(1))
+	losses = [model.lose() for _ in range(100000)]
+	# bad 0.01 / (0.01 + 0.25) of the time
+	assert abs(sum(losses) / len(losses) - 0.01 / 0.26) < 0.01
+	bursts = [run for run in ''.join('x' if l else ' ' for l in losses).split()]
+	# bursts last 1 / 0.25 datagrams on average
+	assert 3 < sum(len(b) for b in bursts) / len(bursts) < 5
+
+def test_link_impairments():
+	link = LossyLink(('127.0.0.1', 9), make_impairments(loss=0.5, duplicate=0.5), seed=1)
+	for _ in range(1000):
+		link.accept(b'x', 0.0)
+	assert 400 < link.lost < 600
+	assert len(link.pending) == 1000 - link.lost + link.duplicated
+	link.sock.close()
+
+def test_link_rate_cap():
+	link = LossyLink(('127.0.0.1', 9), make_impairments(rate=1000, max_queue_delay=0.5))
+	for _ in range(10):
+		link.accept(bytes(100), 0.0)
+	# 0.1 seconds per datagram, so only the first 6 fit in the queue
+	assert link.queue_drops == 4
+	assert [round(p[0], 3) for p in sorted(link.pending)] == [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+	link.sock.close()
+
+def test_link_forwards():
+	dest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	dest.bind(('127.0.0.1', 0))
+	dest.settimeout(5)
+	link = LossyLink(dest.getsockname())
+	link.start()
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as src:
+		src.sendto(b'hello', link.address)
+		assert dest.recv(100) == b'hello'
+	link.stop()
+	dest.close()
+
+def test_benchmark_report():
+	report = run_benchmark([TrialConfig(1400, 2, '4x2048')], make_impairments(loss=0.05), trials=1,
+		send_rate=1000000, seed=1)
+	result = report['results'][0]
+	assert result['completed'] and result['files_missing'] == 0
+	assert result['goodput'] > 0 and result['receiver_cpu_per_mb'] >= 0
+	assert report['summary'][0]['completion_probability'] == 1.0
+	# it's machine-readable
+	json.dumps(report)
@@ -0,0 +1,100 @@
+from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.FolderSender import FolderSender
+from diode_ftp.metrics import CONTENT_TYPE, MetricsRegistry, MetricsServer, parse_metrics_address
+from diode_ftp.transport import QueueTransport
+from http.client import HTTPConnection
+from pathlib import Path
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+import re
+import socket
+
+def parse_metrics(text: str):
+	return {line.split(' ')[0]: float(line.split(' ')[1]) for line in text.splitlines() if not line.startswith('#')}
+
+def test_render():
+	registry = MetricsRegistry()
+	registry.add('frames_total', 'counter', 'Frames', lambda: 3)
+	registry.add('seconds', 'summary', 'Time', lambda: (1.5, 2))
+	registry.add('missing', 'gauge', 'Not known yet', lambda: None)
+	registry.add_stats('engine', lambda: {'drops': 1, 'per_shard': [1, 2], 'kernel': None}, 'Engine')
+	text = registry.render()
+	assert '# TYPE frames_total counter\nframes_total 3\n' in text
+	assert 'seconds_sum 1.5\nseconds_count 2\n' in text
+	assert 'engine_drops 1' in text
+	assert 'missing' not in text and 'per_shard' not in text and 'kernel' not in text
+
+def test_parse_address():
+	assert parse_metrics_address('9100') == ('127.0.0.1', 9100)
+	assert parse_metrics_address('0.0.0.0:9100') == ('0.0.0.0', 9100)
+	assert parse_metrics_address('unix:/tmp/diode.sock') == '/tmp/diode.sock'
+
+def test_serve_tcp():
+	registry = MetricsRegistry()
+	registry.add('up', 'gauge', 'Up', lambda: 1)
+	server = MetricsServer(registry, ('127.0.0.1', 0))
+	try:
+		conn = HTTPConnection(*server.address, timeout=5)
+		conn.request('GET', '/metrics')
+		response = conn.getresponse()
+		assert response.status == 200
+		assert response.getheader('Content-Type') == CONTENT_TYPE
+		assert parse_metrics(response.read().decode()) == {'up': 1}
+		conn.close()
+	finally:
+		server.close()
+
+def test_serve_unix(tmp_path: Path):
+	registry = MetricsRegistry()
+	registry.add('up', 'gauge', 'Up', lambda: 1)
+	path = str(tmp_path / 'metrics.sock')
+	server = MetricsServer(registry, path)
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.settimeout(5)
+			sock.connect(path)
+			sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+			response = b''
+			while True:
+				data = sock.recv(4096)
+				if not data:
+					break
+				response += data
+		assert response.startswith(b'HTTP/1.0 200')
+		assert response.endswith(b'up 1\n')
+	finally:
+		server.close()
+	assert not Path(path).exists()
+
+def test_sync_metrics(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	link = QueueTransport()
+	sender = FolderSender(send, send_to=('diode', 0), transmit_socket=link, max_bytes_per_second=0, transmit_repeats=2)
+	receiver = FolderReceiver(rcv, start_worker=False)
+	registry = MetricsRegistry()
+	sender.register_metrics(registry)
+	receiver.register_metrics(registry)
+	sender.perform_sync()
+	link.deliver(receiver)
+	receiver.completions.wait()
+	metrics = parse_metrics(registry.render())
+
+	frames = metrics['diode_sender_frames_sent_total']
+	assert frames > 0
+	assert metrics['diode_receiver_frames_received_total'] == frames
+	assert metrics['diode_receiver_bytes_received_total'] == metrics['diode_sender_bytes_sent_total']
+	# every chunk was sent twice, so the second copies are dropped one way or another
+	dropped = metrics['diode_receiver_duplicate_frames_total'] + metrics['diode_receiver_complete_frames_total']
+	assert dropped == frames / 2
+	assert metrics['diode_receiver_transfers_completed_total'] == 1
+	assert metrics['diode_receiver_extraction_seconds_count'] == 1
+	assert metrics['diode_receiver_bytes_written_total'] > BIG_FILE.stat().st_size
+	assert metrics['diode_sender_files_sent_total'] == 2
+	assert metrics['diode_sender_tar_build_seconds_count'] == 1
+	assert metrics['diode_sender_scan_seconds_count'] == 1
+	assert metrics['diode_receiver_active_transfers'] == 0
+	assert metrics['diode_receiver_pending_extractions'] == 0
+	assert re.search(r'# TYPE diode_receiver_queue_depth gauge', registry.render())
@@ -0,0 +1,27 @@
+from diode_ftp.pacer import TokenBucket
+import time
+
+def check_rate(rate: int, chunk: int, duration: float):
+	pacer = TokenBucket(rate)
+	sent = 0
+	start = time.monotonic()
+	while sent < rate * duration:
+		pacer.consume(chunk)
+		sent += chunk
+	elapsed = time.monotonic() - start
+	achieved = (sent - pacer.burst) / elapsed
+	assert abs(achieved - rate) / rate < 0.05, f'Achieved {achieved} bytes/s, wanted {rate} bytes/s'
+
+def test_pacer_low_rate():
+	check_rate(20000, 1400, 1)
+
+def test_pacer_high_rate():
+	# at 100MB/s, each chunk is only ~14us, far below sleep granularity
+	check_rate(100 * 1000 * 1000, 1400, 0.5)
+
+def test_pacer_unlimited():
+	pacer = TokenBucket(0)
+	start = time.monotonic()
+	for _ in range(10000):
+		pacer.consume(1400)
+	assert time.monotonic() - start < 0.5
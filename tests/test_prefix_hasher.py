@@ -0,0 +1,67 @@
+from diode_ftp.FileChunker import FileChunker
+from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.header import HEADER_SIZE, hash_file, parse_header
+from diode_ftp.PrefixHasher import PrefixHasher
+from pathlib import Path
+from tests.common import *
+import random
+
+def get_chunks():
+	with FileChunker(BIG_FILE, chunk_size=500).chunk_iterator() as chunks:
+		return list(chunks)
+
+def receive_in_order(rcv: Path, chunks, order):
+	receiver = FolderReceiver(rcv, start_worker=False)
+	worker = receiver.worker
+	for i in order:
+		frame = memoryview(chunks[i])
+		header = parse_header(frame[:HEADER_SIZE])
+		worker.accept_chunk(header, frame[HEADER_SIZE:])
+	hasher = worker.hashers[header.hash]
+	return hasher, receiver.get_tar_path(header)
+
+def test_hashes_prefix_as_it_arrives(tmp_path: Path):
+	chunks = get_chunks()
+	hasher, tar_path = receive_in_order(tmp_path, chunks, range(len(chunks)))
+	# everything came in order, so nothing had to be read back
+	assert hasher.from_disk == 0
+	assert hasher.finish(tar_path) == BIG_HASH
+
+def test_reads_back_gaps(tmp_path: Path):
+	chunks = get_chunks()
+	order = list(range(len(chunks)))
+	random.Random(1).shuffle(order)
+	hasher, tar_path = receive_in_order(tmp_path, chunks, order)
+	assert hasher.from_memory > 0 and hasher.from_disk > 0
+	assert hasher.finish(tar_path) == BIG_HASH
+
+def test_restart_reads_back_prefix(tmp_path: Path):
+	chunks = get_chunks()
+	half = len(chunks) // 2
+	receiver = FolderReceiver(tmp_path, start_worker=False)
+	for chunk in chunks[:half]:
+		frame = memoryview(chunk)
+		receiver.worker.accept_chunk(parse_header(frame[:HEADER_SIZE]), frame[HEADER_SIZE:])
+	receiver.worker.files.close_all()
+	receiver.state.close()
+	# a new receiver doesn't have the hash state, so it reads the prefix back
+	hasher, tar_path = receive_in_order(tmp_path, chunks, range(half, len(chunks)))
+	assert hasher.finish(tar_path) == BIG_HASH
+	assert hash_file(tar_path) == BIG_HASH
+
+def test_short_read_leaves_rest_to_finish(tmp_path: Path):
+	path = tmp_path / 'stream'
+	path.write_bytes(b'a' * 10 + b'b' * 3)
+	hasher = PrefixHasher()
+	hasher.learn_chunk_size(10, 1)
+	received = [True, True]
+	class Received():
+		len = 2
+		def __getitem__(self, i):
+			return received[i]
+	with open(path, 'rb') as f:
+		hasher.catch_up(Received(), 2, lambda length, offset: os.pread(f.fileno(), length, offset))
+	assert hasher.hashed == 13
+	# we're mid-chunk, so later chunks aren't hashed from memory
+	hasher.update(2, 20, b'c')
+	assert hasher.finish(path) == hash_file(path)
@@ -0,0 +1,65 @@
+from diode_ftp.ReceiverState import ReceiverState
+from diode_ftp.header import MANIFEST_INDEX, STREAM_TOTAL, Header
+from pathlib import Path
+
+HASH_A = b'a' * 20
+HASH_B = b'b' * 20
+
+def test_journal_recovery(tmp_path: Path):
+	state = ReceiverState(tmp_path)
+	header = Header(HASH_A, 0, 0, 10)
+	state.get_transfer(header)
+	for i in (0, 3, 9):
+		state.mark_chunk(header, i)
+	state.get_transfer(Header(HASH_B, 0, 0, 1))
+	state.mark_complete(HASH_B)
+	state.close()
+
+	recovered = ReceiverState(tmp_path)
+	assert recovered.is_complete(HASH_B)
+	transfer = recovered.transfers[HASH_A]
+	assert [transfer.received[i] for i in range(10)] == [i in (0, 3, 9) for i in range(10)]
+
+def test_journal_compaction(tmp_path: Path):
+	state = ReceiverState(tmp_path, flush_after=1, compact_after=4)
+	header = Header(HASH_A, 0, 0, 10)
+	state.get_transfer(header)
+	for i in range(6):
+		state.mark_chunk(header, i)
+	# the first 4 records were compacted into the snapshot
+	assert (tmp_path / '.receiver_journal').stat().st_size < 4 * 41
+	state.close()
+
+	recovered = ReceiverState(tmp_path)
+	assert len(recovered.transfers[HASH_A].received) == 6
+
+def test_torn_journal_record(tmp_path: Path):
+	state = ReceiverState(tmp_path)
+	header = Header(HASH_A, 0, 0, 10)
+	state.get_transfer(header)
+	state.mark_chunk(header, 1)
+	state.mark_chunk(header, 2)
+	state.close()
+	journal = tmp_path / '.receiver_journal'
+	journal.write_bytes(journal.read_bytes()[:-5])
+
+	recovered = ReceiverState(tmp_path)
+	assert len(recovered.transfers[HASH_A].received) == 1
+
+def test_manifest_first(tmp_path: Path):
+	state = ReceiverState(tmp_path)
+	stream_hash = b's' * 20
+	# the manifest of a 3 chunk stream arrives before any of its chunks
+	manifest = Header(HASH_A, 3000, MANIFEST_INDEX, 3)
+	assert state.mark_manifest(manifest, stream_hash)
+	assert not state.mark_manifest(manifest, stream_hash)
+	transfer = state.transfers[HASH_A]
+	assert transfer.expected_hash == stream_hash and transfer.total == 3
+	for i in range(3):
+		state.mark_chunk(Header(HASH_A, i * 1000, i, STREAM_TOTAL), i)
+	assert len(transfer.received) == 3
+	state.close()
+
+	recovered = ReceiverState(tmp_path).transfers[HASH_A]
+	assert recovered.expected_hash == stream_hash and recovered.has_manifest
+	assert len(recovered.received) == 3
@@ -0,0 +1,98 @@
+from diode_ftp.FileChunker import FileChunker
+from diode_ftp.RepeatedChunker import NOT_READY, RepeatedChunker
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+from shutil import copy2
+from collections import Counter
+import contextlib
+import time
+
+class ListChunker():
+	def __init__(self, count: int) -> None:
+		self.chunks = [i.to_bytes(4, 'big') for i in range(count)]
+		self.total_frames = count
+	def chunk_iterator(self, zero_copy=False):
+		return contextlib.nullcontext(iter(self.chunks))
+
+def positions(chunks):
+	seen = {}
+	for i, chunk in enumerate(chunks):
+		seen.setdefault(chunk, []).append(i)
+	return seen
+
+def test_default_is_back_to_back():
+	chunker = ListChunker(50)
+	with RepeatedChunker(chunker, repeats=3).chunk_iterator() as chunks:
+		assert list(chunks) == chunker.chunks * 3
+
+def test_separation_in_chunks():
+	chunker = ListChunker(1000)
+	with RepeatedChunker(chunker, repeats=3, separation=100).chunk_iterator() as chunks:
+		sent = list(chunks)
+	assert len(sent) == 3000
+	for chunk, where in positions(sent).items():
+		assert len(where) == 3
+		gaps = [b - a for a, b in zip(where, where[1:])]
+		if int.from_bytes(chunk, 'big') < 950:
+			assert min(gaps) >= 100, "Copies should be at least 100 chunks apart"
+		else:
+			# at the very end only the last pass is left, so there's nothing to put between the copies
+			assert min(gaps) >= 50
+	# the passes are interleaved, not sent one after another
+	assert sent.index(chunker.chunks[0], 1) < 1000
+
+def test_separation_in_seconds():
+	chunker = ListChunker(5)
+	repeated = RepeatedChunker(chunker, repeats=2, separation=0, separation_seconds=0.1, blocking=False)
+	sent = []
+	with repeated.chunk_iterator() as chunks:
+		for chunk in chunks:
+			if chunk is not NOT_READY:
+				sent.append((chunk, time.monotonic()))
+	assert Counter(chunk for chunk, _ in sent) == Counter(chunker.chunks * 2)
+	for chunk, where in positions([chunk for chunk, _ in sent]).items():
+		# (the clock is read just before each chunk is handed out)
+		assert sent[where[1]][1] - sent[where[0]][1] >= 0.099
+
+def test_shuffle():
+	chunker = ListChunker(500)
+	# (with a whole pass of separation, the second pass would have to keep to the first one's order)
+	with RepeatedChunker(chunker, repeats=2, separation=100, shuffle_window=64, seed=1).chunk_iterator() as chunks:
+		sent = list(chunks)
+	assert Counter(sent) == Counter(chunker.chunks * 2)
+	first = sorted(chunker.chunks, key=lambda chunk: positions(sent)[chunk][0])
+	second = sorted(chunker.chunks, key=lambda chunk: positions(sent)[chunk][1])
+	assert first != chunker.chunks and first != second, "Each copy should be shuffled differently"
+
+def test_separation_survives_shuffle():
+	chunker = ListChunker(1000)
+	# chunks can move further than the separation, but two copies of a chunk still can't get closer than it
+	with RepeatedChunker(chunker, repeats=3, separation=16, shuffle_window=128, seed=1).chunk_iterator() as chunks:
+		sent = list(chunks)
+	assert Counter(sent) == Counter(chunker.chunks * 3)
+	# at the very end only the last pass is left, so there's nothing to put between the copies
+	gaps = [b - a for where in positions(sent).values() if where[-1] < len(sent) - 32 for a, b in zip(where, where[1:])]
+	assert min(gaps) >= 16, "Copies should be at least 16 chunks apart"
+
+def test_file_chunker_repeats(tmp_path: Path):
+	chunker = FileChunker(BIG_FILE, chunk_size=148)
+	with chunker.chunk_iterator() as chunks:
+		expected = Counter(list(chunks) * 2)
+	with RepeatedChunker(chunker, separation=8, shuffle_window=16).chunk_iterator(zero_copy=True) as chunks:
+		assert Counter(bytes(chunk) for chunk in chunks) == expected
+
+def test_folder_sync_spaced_repeats(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	port = get_available_port()
+	receiver = FolderReceiver(rcv)
+	engine = receiver.start_engine(('127.0.0.1', port))
+	sender = FolderSender(send, send_to=('127.0.0.1', port), max_bytes_per_second=2000000,
+		repeat_separation=4, repeat_separation_seconds=0.01, shuffle_window=8)
+	threading.Thread(target=sender.perform_sync, daemon=True).start()
+	def synced():
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced)
+	engine.stop()
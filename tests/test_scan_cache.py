@@ -0,0 +1,79 @@
+from diode_ftp.FolderSender import FolderSender
+from diode_ftp.metadata import FileMetadata, get_all_file_metadata
+from diode_ftp.ScanCache import ScanCache
+from diode_ftp.TransferScheduler import TransferScheduler
+from diode_ftp.transport import QueueTransport
+from tests.common import *
+import os
+import pytest
+import tarfile
+
+def age_folder(folder: Path):
+	"""Backdates the folders' mtimes, so the cache trusts them (recently modified folders are always re-listed)"""
+	past = 1600000000
+	for dir_name, _, _ in os.walk(folder):
+		os.utime(dir_name, (past, past))
+
+def test_scan_cache(tmp_path: Path):
+	(tmp_path / 'a').mkdir()
+	(tmp_path / 'a' / 'one.txt').write_text('one')
+	(tmp_path / 'b').mkdir()
+	(tmp_path / 'b' / 'two.txt').write_text('two')
+	(tmp_path / '.hidden').write_text('hidden')
+	age_folder(tmp_path)
+
+	cache = ScanCache(tmp_path)
+	diff = cache.scan()
+	assert diff.changed == get_all_file_metadata(tmp_path)
+	cache.commit()
+	# creating the cache file touched the root
+	age_folder(tmp_path)
+	# a fresh cache loads the committed scan
+	cache = ScanCache(tmp_path)
+	assert cache.scan().changed == set()
+	assert cache.dirs_listed == 0
+	cache.commit()
+
+	# in-place edits don't change the folder's mtime, but are still found
+	(tmp_path / 'a' / 'one.txt').write_text('one, edited')
+	(tmp_path / 'b' / 'three.txt').write_text('three')
+	os.unlink(tmp_path / 'b' / 'two.txt')
+	diff = cache.scan()
+	assert {m.path for m in diff.changed} == {Path('a/one.txt'), Path('b/three.txt')}
+	assert diff.removed == {Path('b/two.txt')}
+	# only b changed, so a was reused
+	assert cache.dirs_listed == 1
+
+def test_scan_cache_uncommitted(tmp_path: Path):
+	(tmp_path / 'one.txt').write_text('one')
+	cache = ScanCache(tmp_path)
+	assert len(cache.scan().changed) == 1
+	# the sync failed, so the file should still be reported
+	assert len(cache.scan().changed) == 1
+	cache.commit()
+	assert len(cache.scan().changed) == 0
+
+@pytest.mark.parametrize('scheduled', [False, True])
+def test_scan_cache_unreadable(tmp_path: Path, monkeypatch, scheduled: bool):
+	(tmp_path / 'a.txt').write_text('a')
+	(tmp_path / 'b.txt').write_text('b')
+	age_folder(tmp_path)
+	add = tarfile.TarFile.add
+	def add_unless_b(self: tarfile.TarFile, name, *args, **kwargs):
+		if Path(name).name == 'b.txt':
+			raise PermissionError(name)
+		return add(self, name, *args, **kwargs)
+	monkeypatch.setattr(tarfile.TarFile, 'add', add_unless_b)
+	sender = FolderSender(tmp_path, send_to=('diode', 0), transmit_socket=QueueTransport(), max_bytes_per_second=0,
+		scan_cache=ScanCache(tmp_path, verify_files=False),
+		scheduler=TransferScheduler(tmp_path, time_slice=None) if scheduled else None)
+	sender.perform_sync()
+	assert sender.files_sent == 1
+	# b.txt wasn't sent, so it's still a change, even though the folder looks untouched
+	age_folder(tmp_path)
+	assert {m.path for m in ScanCache(tmp_path, verify_files=False).scan().changed} == {Path('b.txt')}
+
+	monkeypatch.setattr(tarfile.TarFile, 'add', add)
+	sender.perform_sync()
+	assert sender.files_sent == 2
+	assert ScanCache(tmp_path, verify_files=False).scan().changed == set()
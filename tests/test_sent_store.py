@@ -0,0 +1,31 @@
+from diode_ftp.metadata import FileMetadata
+from diode_ftp.SentStore import LOOKUP_THRESHOLD, SentStore
+from tests.common import *
+import shelve
+
+def make_files(count: int, prefix='dir'):
+	return [FileMetadata(Path(f'{prefix}{i % 7}') / f'file{i}.txt', i, 1.0) for i in range(count)]
+
+def test_changed_files(tmp_path: Path):
+	store = SentStore(tmp_path / 'sent.sqlite')
+	# enough files to use the merge, and few enough to look them up one by one
+	for count in (LOOKUP_THRESHOLD * 2, 10):
+		files = make_files(count, prefix=f'{count}-')
+		assert len(store.changed(files)) == count
+		store.mark_sent(files)
+		assert store.changed(files) == []
+		touched = [f._replace(mtime=2.0) for f in files[::3]]
+		new = [FileMetadata(Path('new') / f'{count}.txt', 1, 1.0)]
+		assert set(store.changed(files[1::3] + touched + new)) == set(touched + new)
+	store.close()
+
+def test_import_shelf(tmp_path: Path):
+	old = make_files(10)
+	with shelve.open(str(tmp_path / '.sender_sync_data')) as db:
+		# older versions kept every version of a file they ever sent
+		db['sent'] = set(old + [old[0]._replace(mtime=0.5)])
+	store = SentStore(tmp_path / 'sent.sqlite')
+	assert store.is_empty()
+	assert store.import_shelf(tmp_path / '.sender_sync_data') == 10
+	assert store.changed(old) == []
+	store.close()
@@ -0,0 +1,60 @@
+from diode_ftp.header import hash_file
+from diode_ftp.FolderSender import FolderSender
+from diode_ftp.ShardedReceiver import FrameRing, ShardedReceiver
+from diode_ftp.TransferScheduler import TransferScheduler
+from multiprocessing import get_context
+from pathlib import Path
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+
+def test_ring_round_trip():
+	ring = FrameRing(get_context('spawn'), slots=4, max_frame_size=16)
+	frames = [bytes([i]) * (i + 1) for i in range(4)]
+	for frame in frames:
+		assert ring.push(frame)
+	# full
+	assert not ring.push(b'x')
+	assert [bytes(f) for f in ring.frames()] == frames
+	# the consumer freed the slots, and the ring wraps around
+	assert ring.push(b'again')
+	assert [bytes(f) for f in ring.frames()] == [b'again']
+
+def test_ring_rejects_big_frames():
+	ring = FrameRing(get_context('spawn'), slots=4, max_frame_size=16)
+	assert not ring.push(bytes(17))
+	assert list(ring.frames()) == []
+
+def test_ring_shares_memory():
+	ring = FrameRing(get_context('spawn'), slots=4, max_frame_size=16)
+	ring.push(b'hello')
+	# the copy a shard gets (it's sent to the shard with __getstate__) sees the same frames
+	consumer = FrameRing.__new__(FrameRing)
+	consumer.__setstate__(ring.__getstate__())
+	assert [bytes(f) for f in consumer.frames()] == [b'hello']
+	assert ring.push(b'a') and ring.push(b'b') and ring.push(b'c') and ring.push(b'd')
+	assert not ring.push(b'e')
+
+def test_folder_sync_sharded(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	(send / 'status.json').write_text('{"ok": true}')
+	port = get_available_port()
+	receiver = ShardedReceiver(rcv, shards=2)
+	receiver.start_engine(('127.0.0.1', port))
+	# one transfer per file, so they land on different shards
+	sender = FolderSender(send, send_to=('127.0.0.1', port), max_bytes_per_second=2000000,
+		scheduler=TransferScheduler(send, max_transfer_size=1, time_slice=None))
+	def synced():
+		sender.perform_sync()
+		assert (rcv / 'status.json').exists() and (rcv / 'status.json').read_text() == '{"ok": true}'
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	try:
+		wait_until(synced, interval=0.1)
+	finally:
+		receiver.stop()
+	assert receiver.stats()['shards_alive'] == 0
+	# every shard keeps its own state
+	assert (rcv / '.receiver_shard0_journal').exists() and (rcv / '.receiver_shard1_journal').exists()
@@ -0,0 +1,126 @@
+from diode_ftp.metadata import FileMetadata, get_all_file_metadata
+from diode_ftp.pacer import TokenBucket
+from diode_ftp.RepeatedChunker import RepeatedChunker
+from diode_ftp.TransferScheduler import DEFAULT_PRIORITY, PriorityRules, Transfer, TransferScheduler
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+import contextlib
+import time
+
+class ListChunker():
+	def __init__(self, chunks) -> None:
+		self.chunks = chunks
+	def chunk_iterator(self, zero_copy=False):
+		return contextlib.nullcontext(iter(self.chunks))
+
+class ListSender():
+	def __init__(self) -> None:
+		self.sent = []
+	def send(self, chunk):
+		self.sent.append(chunk)
+		return len(chunk)
+	def flush(self):
+		return 0
+
+def test_priority_rules():
+	rules = PriorityRules(['# urgent stuff', '100 status/*.json', '10 *.log', '50 status/debug.log', 'oops'])
+	assert rules.priority('status/now.json') == 100
+	assert rules.priority('logs/app.log') == 10
+	# the last matching rule wins
+	assert rules.priority('status/debug.log') == 50
+	assert rules.priority('image.png') == DEFAULT_PRIORITY
+
+def test_plan_batches(tmp_path: Path):
+	(tmp_path / '.diodepriority').write_text('10 *.json\n')
+	scheduler = TransferScheduler(tmp_path, max_transfer_size=100)
+	files = [FileMetadata(Path(f'{i}.bin'), size, 1.0) for i, size in enumerate([90, 10, 500, 20])]
+	status = FileMetadata(Path('status.json'), 1000, 1.0)
+	batches = scheduler.plan(files + [status])
+	assert batches == [(10, [status]), (1, [files[1], files[3]]), (1, [files[0]]), (1, [files[2]])]
+
+def test_weighted_interleave(tmp_path: Path):
+	scheduler = TransferScheduler(tmp_path, time_slice=None, quantum=10)
+	done = []
+	bulk = Transfer(lambda: ListChunker([b'b' * 10] * 1000), 2, [FileMetadata(Path('bulk'), 10000, 1.0)], 1, done.append)
+	urgent = Transfer(lambda: ListChunker([b'u' * 10] * 20), 1, [FileMetadata(Path('urgent'), 200, 1.0)], 10, done.append)
+	scheduler.add(bulk)
+	scheduler.add(urgent)
+	assert scheduler.is_in_flight(urgent.files[0])
+	sender = ListSender()
+	scheduler.run(sender, TokenBucket(0))
+	assert done == [urgent, bulk]
+	assert scheduler.is_idle() and not scheduler.is_in_flight(urgent.files[0])
+	assert len(sender.sent) == 2020
+	# the urgent transfer gets 10 times the share of the bulk one, so it's done after about 22 chunks
+	last_urgent = max(i for i, chunk in enumerate(sender.sent) if chunk[:1] == b'u')
+	assert last_urgent < 25
+
+def test_time_slice(tmp_path: Path):
+	scheduler = TransferScheduler(tmp_path, time_slice=0)
+	scheduler.add(Transfer(lambda: ListChunker([b'x'] * 100000), 1, [], 1, lambda t: None))
+	scheduler.run(ListSender(), TokenBucket(0))
+	assert not scheduler.is_idle()
+
+def test_folder_sync_prioritized(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	(send / 'status.json').write_text('{"ok": true}')
+	(send / '.diodepriority').write_text('100 *.json\n')
+	port = get_available_port()
+	receiver = FolderReceiver(rcv)
+	engine = receiver.start_engine(('127.0.0.1', port))
+	# one transfer per file
+	sender = FolderSender(send, send_to=('127.0.0.1', port), max_bytes_per_second=2000000,
+		scheduler=TransferScheduler(send, max_transfer_size=1, time_slice=0.05))
+	def sync():
+		sender.perform_sync()
+		while sender.has_pending_transfers():
+			sender.perform_sync()
+	thread = threading.Thread(target=sync, daemon=True)
+	thread.start()
+	def synced():
+		assert (rcv / 'status.json').exists() and (rcv / 'status.json').read_text() == '{"ok": true}'
+		assert hash_if_exists(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+		assert hash_if_exists(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+	wait_until(synced, interval=0.1)
+	thread.join(10)
+	engine.stop()
+	# every transfer was marked as sent once it was done
+	assert sender.sent.changed(get_all_file_metadata(send)) == []
+
+def test_waits_on_spaced_repeats(tmp_path: Path):
+	scheduler = TransferScheduler(tmp_path, time_slice=None)
+	done = []
+	spaced = lambda: RepeatedChunker(ListChunker([b's'] * 5), separation=0, separation_seconds=0.05, blocking=False)
+	scheduler.add(Transfer(spaced, 1, [], 10, done.append))
+	scheduler.add(Transfer(lambda: ListChunker([b'b'] * 10), 1, [], 1, done.append))
+	sender = ListSender()
+	start = time.monotonic()
+	scheduler.run(sender, TokenBucket(0))
+	assert time.monotonic() - start >= 0.05
+	# the bulk transfer goes out while the repeats wait
+	assert done[0].priority == 1 and len(done) == 2
+	assert sender.sent.count(b's') == 10
+
+def test_time_slice_cuts_turns_short(tmp_path: Path):
+	# a round would take this class 100 * 1400 bytes, 14 seconds at this rate
+	scheduler = TransferScheduler(tmp_path, time_slice=0.2)
+	scheduler.add(Transfer(lambda: ListChunker([b'x' * 1400] * 1000), 1, [], 100, lambda t: None))
+	start = time.monotonic()
+	scheduler.run(ListSender(), TokenBucket(10000, 1400))
+	assert time.monotonic() - start < 1
+
+def test_cut_short_rounds_resume(tmp_path: Path):
+	scheduler = TransferScheduler(tmp_path, time_slice=0, quantum=10)
+	scheduler.add(Transfer(lambda: ListChunker([b'h' * 10] * 4), 1, [], 2, lambda t: None))
+	scheduler.add(Transfer(lambda: ListChunker([b'l' * 10] * 2), 1, [], 1, lambda t: None))
+	sender = ListSender()
+	runs = 0
+	while not scheduler.is_idle():
+		scheduler.run(sender, TokenBucket(0))
+		runs += 1
+	# one chunk per run, but every class still gets its share of each round
+	assert [chunk[:1] for chunk in sender.sent] == [b'h', b'h', b'l', b'h', b'h', b'l']
+	assert runs >= 6
@@ -0,0 +1,80 @@
+from diode_ftp.FolderReceiver import FolderReceiver
+from diode_ftp.FolderSender import FolderSender
+from diode_ftp.header import hash_file
+from diode_ftp.transport import CaptureTransport, CaptureWriter, QueueTransport, Transport, read_capture, replay_capture
+from pathlib import Path
+from shutil import copy2
+from tests.common import *
+from tests.test_folder_sync import create_send_rcv_folder
+import pytest
+import time
+
+def assert_synced(rcv: Path):
+	assert hash_file(rcv / 'payload.txt') == PAYLOAD_HASH, "File hashes should be the same"
+	assert hash_file(rcv / 'big.bin') == BIG_HASH, "File hashes should be the same"
+
+def test_sync_in_process(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	link = QueueTransport()
+	sender = FolderSender(send, send_to=('diode', 0), transmit_socket=link, max_bytes_per_second=0)
+	receiver = FolderReceiver(rcv, start_worker=False)
+	sender.perform_sync()
+	# the frames are handled right here, so there's no network or worker thread involved
+	assert link.deliver(receiver) > 0
+	receiver.completions.wait()
+	assert_synced(rcv)
+
+def test_capture_and_replay(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	capture = tmp_path / 'flight.cap'
+	with CaptureWriter(capture) as writer:
+		sender = FolderSender(send, send_to=('diode', 0), transmit_socket=CaptureTransport(writer), max_bytes_per_second=200000)
+		sender.perform_sync()
+	records = list(read_capture(capture))
+	assert len(records) == writer.count
+	# the sender was paced, and the timestamps show it
+	assert records[-1][0] > records[0][0]
+
+	receiver = FolderReceiver(rcv)
+	start = time.monotonic()
+	assert replay_capture(capture, receiver, speed=1.0) == len(records)
+	assert time.monotonic() - start >= records[-1][0]
+	receiver.queue.put(None)
+	receiver.worker.join(10)
+	assert_synced(rcv)
+
+def test_replay_as_fast_as_possible(tmp_path: Path):
+	send, rcv = create_send_rcv_folder(tmp_path)
+	copy2(PAYLOAD, send / 'payload.txt')
+	copy2(BIG_FILE, send / 'big.bin')
+	capture = tmp_path / 'flight.cap'
+	with CaptureWriter(capture) as writer:
+		FolderSender(send, send_to=('diode', 0), transmit_socket=CaptureTransport(writer), max_bytes_per_second=200000).perform_sync()
+	receiver = FolderReceiver(rcv, start_worker=False)
+	start = time.monotonic()
+	replay_capture(capture, receiver)
+	assert time.monotonic() - start < list(read_capture(capture))[-1][0]
+	receiver.completions.wait()
+	assert_synced(rcv)
+
+def test_torn_capture(tmp_path: Path):
+	capture = tmp_path / 'torn.cap'
+	with CaptureWriter(capture) as writer:
+		writer.write(b'first')
+		writer.write(b'second')
+	with open(capture, 'r+b') as f:
+		f.truncate(capture.stat().st_size - 2)
+	assert [d for _, d in read_capture(capture)] == [b'first']
+	(tmp_path / 'junk').write_bytes(b'not a capture')
+	with pytest.raises(ValueError):
+		list(read_capture(tmp_path / 'junk'))
+
+def test_transport_must_send():
+	class NoSend(Transport):
+		pass
+	with pytest.raises(TypeError):
+		NoSend()